@@ -3,6 +3,29 @@ Qwen-CLIP ComfyUI Plugin
 图片提示词反推插件
 """
 
-from .qwen_clip_node import NODE_CLASS_MAPPINGS, NODE_DISPLAY_NAME_MAPPINGS
+from .qwen_clip_node import NODE_CLASS_MAPPINGS, NODE_DISPLAY_NAME_MAPPINGS, PRELOAD_MODEL, PRELOAD_ON, start_preload
+
+# 可选：插件导入时就在后台开始加载模型
+if PRELOAD_MODEL and PRELOAD_ON == "import":
+    start_preload(PRELOAD_MODEL)
+
+# 在ComfyUI服务中提供 /qwen_clip/status，查询模型常驻、预加载和批处理调度状态
+try:
+    # 先导入server：不在ComfyUI中运行时立即失败，不会额外加载aiohttp
+    from server import PromptServer
+    from aiohttp import web
+    from .model_pool import get_model_pool
+    from .batch_scheduler import get_batch_scheduler
+
+    @PromptServer.instance.routes.get("/qwen_clip/status")
+    async def qwen_clip_status(request):
+        pool = get_model_pool()
+        return web.json_response({
+            "models": pool.stats(),
+            "preload": pool.preload_status(),
+            "scheduler": get_batch_scheduler().stats(),
+        })
+except Exception:
+    pass
 
 __all__ = ['NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS']
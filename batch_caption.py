@@ -0,0 +1,588 @@
+"""
+批量反推提示词（离线数据集标注）
+在ComfyUI之外为一个目录或清单中的图像生成中英文提示词，结果逐批追加写入JSONL。
+解码和缩放在线程池中提前进行，与模型生成重叠；输出文件同时作为断点，中断后重新运行会跳过已完成的图像。
+--processes 大于1时按CPU分组启动多个工作进程，权重通过内存映射共享，主进程分发任务并统一写入结果。
+
+清单格式：
+    .jsonl  每行一个对象，图像路径放在 image / path / file_name 字段，其余字段原样写入结果
+    .txt    每行一个图像路径
+相对路径相对于清单所在目录。
+
+用法：
+    python custom_nodes/qwen-clip/batch_caption.py /data/images --output /data/captions.jsonl
+    python custom_nodes/qwen-clip/batch_caption.py /data/manifest.jsonl --batch-size 4 --resolution fast
+    python custom_nodes/qwen-clip/batch_caption.py /data/images --processes 4 --quantization int8_weight_only
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from standalone import import_plugin_module, load_plugin
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+MANIFEST_PATH_KEYS = ("image", "path", "file_name")
+
+
+def list_directory(directory, recursive=False):
+    """目录中的图像，按相对路径排序：[(相对路径, 绝对路径, {})]"""
+    entries = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                entries.append((os.path.relpath(path, directory), path, {}))
+        if not recursive:
+            break
+    return entries
+
+
+def read_manifest(manifest_path):
+    """清单中的图像：[(清单中的路径, 绝对路径, 附加字段)]"""
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    entries = []
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if manifest_path.endswith(".jsonl"):
+                record = json.loads(line)
+                key = next((record.pop(name) for name in MANIFEST_PATH_KEYS if name in record), None)
+                if key is None:
+                    raise Exception(f"清单第 {line_number} 行缺少图像路径（{' / '.join(MANIFEST_PATH_KEYS)}）")
+            else:
+                key, record = line, {}
+            entries.append((key, os.path.join(base_dir, key), record))
+    return entries
+
+
+def read_finished(output_path, retry_errors=False):
+    """从已有的输出文件中读取完成的图像；最后一行可能在中断时只写了一半，直接忽略"""
+    finished = set()
+    if not os.path.isfile(output_path):
+        return finished
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if retry_errors and "error" in record:
+                continue
+            finished.add(record["image"])
+    return finished
+
+
+def decode_image(path, budget, fit_to_budget, Image):
+    """解码并按像素预算缩放；JPEG直接按缩小的尺寸解码，大图不需要先解码到原始分辨率"""
+    with Image.open(path) as image:
+        height, width = fit_to_budget(image.height, image.width, *budget)
+        image.draft("RGB", (width, height))
+        image = image.convert("RGB")
+    if image.size != (width, height):
+        image = image.resize((width, height), Image.BICUBIC)
+    return image
+
+
+class Throughput:
+    """累计和最近一段时间的吞吐（图/秒）"""
+
+    def __init__(self, interval=10.0):
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.images = 0
+        self.decode_wait = 0.0
+        self._window_start = self.started
+        self._window_images = 0
+
+    def add(self, count):
+        self.images += count
+        self._window_images += count
+
+    def report(self, done, total, force=False):
+        now = time.perf_counter()
+        if not force and now - self._window_start < self.interval:
+            return False
+        recent = self._window_images / max(now - self._window_start, 1e-9)
+        overall = self.images / max(now - self.started, 1e-9)
+        print(f"[{done}/{total}] {overall:.2f} 图/秒（最近 {recent:.2f} 图/秒），等待解码 {self.decode_wait:.1f}s",
+              flush=True)
+        self._window_start = now
+        self._window_images = 0
+        return True
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "images": self.images,
+            "seconds": round(elapsed, 3),
+            "images_per_second": round(self.images / elapsed, 3) if elapsed > 0 else 0.0,
+            "decode_wait_seconds": round(self.decode_wait, 3),
+        }
+
+
+def prefetch(entries, decode, workers, depth):
+    """在线程池中按顺序提前解码，最多领先 depth 张；产出 (条目, 图像或None, 错误或None)"""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qwen-clip-decode") as executor:
+        pending = collections.deque()
+        entries = iter(entries)
+        for entry in entries:
+            pending.append((entry, executor.submit(decode, entry[1])))
+            if len(pending) >= depth:
+                break
+        while pending:
+            entry, future = pending.popleft()
+            next_entry = next(entries, None)
+            if next_entry is not None:
+                pending.append((next_entry, executor.submit(decode, next_entry[1])))
+            try:
+                yield entry, future.result(), None
+            except Exception as e:
+                yield entry, None, e
+
+
+class CaptionRunner:
+    """加载模型并按批生成；单进程模式和每个工作进程各持有一个"""
+
+    def __init__(self, args):
+        self.args = args
+        prompts = import_plugin_module("prompts")
+        self.precision_module = import_plugin_module("precision")
+        self.resolution_module = import_plugin_module("resolution")
+        self.batch_size = args.batch_size or prompts.DEFAULT_BATCH_SIZE
+        self.precision = args.precision or self.precision_module.DEFAULT_PRECISION
+        self.quantization = args.quantization or self.precision_module.DEFAULT_QUANTIZATION
+        self.precision_module.check_precision(self.precision, self.quantization)
+        self.budget = self.resolution_module.pixel_budget(
+            args.resolution or self.resolution_module.DEFAULT_RESOLUTION, args.min_pixels, args.max_pixels
+        )
+        self.generator = None
+        self.decode_wait = 0.0
+
+    def load(self):
+        """加载模型，返回加载统计"""
+        # torch/transformers 在确定有图像需要处理后才导入
+        utils = import_plugin_module("utils")
+        model_manager = import_plugin_module("model_manager").ModelManager()
+        model_path = model_manager.resolve_model(self.args.model_type, self.args.custom_model_path)
+        self.generator = utils.ImageCaptionGenerator()
+        self.generator.load_model(
+            model_path, self.args.model_type, torch_dtype=self.precision,
+            device_map=self.precision_module.quantized_device_map("auto", self.quantization),
+            allow_remote=model_manager.allow_hub_load, quantization=self.quantization,
+        )
+        return self.generator.load_stats
+
+    def close(self):
+        if self.generator is not None:
+            self.generator.unload_model()
+
+    def _decode(self, path):
+        from PIL import Image
+        return decode_image(path, self.budget, self.resolution_module.fit_to_budget, Image)
+
+    def _generate(self, batch):
+        cancellation = import_plugin_module("cancellation")
+        images = [image for _, image in batch]
+        try:
+            captions = self.generator.generate_captions(
+                images, self.args.detail_level, batch_size=self.batch_size, deterministic=self.args.deterministic,
+                max_new_tokens=self.args.max_new_tokens, budget=self.budget,
+            )
+        except Exception as e:
+            if cancellation.is_cancellation(e):
+                raise
+            print(f"生成失败（{len(batch)} 张）: {str(e)}")
+            return [{"image": entry[0], **entry[2], "error": str(e)} for entry, _ in batch]
+        return [
+            {"image": entry[0], **entry[2], "caption_chinese": chinese, "caption_english": english}
+            for (entry, _), (chinese, english) in zip(batch, captions)
+        ]
+
+    def run(self, entries):
+        """边解码边生成，产出 (结果列表, 本批生成的图像数)；读取失败的图像单独产出，生成数为0"""
+        stream = prefetch(entries, self._decode, self.args.workers, self.args.prefetch or self.batch_size * 4)
+        batch = []
+        while True:
+            wait_start = time.perf_counter()
+            item = next(stream, None)
+            self.decode_wait += time.perf_counter() - wait_start
+            if item is not None:
+                entry, image, error = item
+                if error is not None:
+                    print(f"无法读取图像 {entry[0]}: {str(error)}")
+                    yield [{"image": entry[0], **entry[2], "error": f"无法读取图像: {str(error)}"}], 0
+                    continue
+                batch.append((entry, image))
+                if len(batch) < self.batch_size:
+                    continue
+            if not batch:
+                return
+            yield self._generate(batch), len(batch)
+            batch = []
+
+
+def truncate_partial_line(path, block_size=65536):
+    """中断时最后一行可能只写了一半：截断到最后一个换行符，否则新结果会接在残缺的行后面"""
+    if not os.path.isfile(path):
+        return
+    with open(path, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            block = f.read(position - start)
+            newline = block.rfind(b"\n")
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            print(f"输出文件最后一行不完整，已截断 {end - position} 字节")
+            f.truncate(position)
+
+
+class ResultWriter:
+    """追加写入JSONL；每批都落盘，中断后最多重做一批"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        truncate_partial_line(path)
+        self.file = open(path, "a", encoding="utf-8")
+        self.errors = 0
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.errors += "error" in record
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def _cpu_sort_key(cpu):
+    """按 (物理CPU, 物理核心) 排序，同一核心的超线程相邻，分组时不会被拆到两个进程"""
+    topology = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+    try:
+        with open(os.path.join(topology, "physical_package_id"), "r") as f:
+            package = int(f.read())
+        with open(os.path.join(topology, "core_id"), "r") as f:
+            core = int(f.read())
+    except (OSError, ValueError):
+        return (0, cpu, cpu)
+    return (package, core, cpu)
+
+
+def core_groups(count):
+    """把当前进程可用的CPU分成 count 组连续的核心；不支持绑核的平台返回 None"""
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * count
+    cpus = sorted(os.sched_getaffinity(0), key=_cpu_sort_key)
+    if count > len(cpus):
+        print(f"警告：进程数 {count} 多于可用的CPU数 {len(cpus)}，部分进程将共用CPU")
+        return [[cpus[i % len(cpus)]] for i in range(count)]
+    size, extra = divmod(len(cpus), count)
+    groups = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
+
+
+def worker_main(worker_id, cores, threads, args, tasks, results):
+    """工作进程：绑定到一组CPU，从任务队列取图像生成，结果交给协调进程写入"""
+    import signal
+
+    # 中断由协调进程统一处理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cores:
+        os.sched_setaffinity(0, cores)
+    # 必须在导入torch之前设置，OpenMP线程池按此创建
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    runner = None
+    try:
+        load_plugin(args.comfyui_root, args.models_dir)
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+        runner = CaptionRunner(args)
+        results.put(("ready", worker_id, runner.load()))
+        entries = (entry for chunk in iter(tasks.get, None) for entry in chunk)
+        for records, generated in runner.run(entries):
+            results.put(("records", worker_id, records, generated, runner.decode_wait))
+        results.put(("done", worker_id, runner.decode_wait))
+    except Exception as e:
+        results.put(("error", worker_id, str(e)))
+    finally:
+        if runner is not None:
+            runner.close()
+
+
+class WorkerStats:
+    def __init__(self, worker_id, cores, threads):
+        self.worker_id = worker_id
+        self.cores = cores
+        self.threads = threads
+        self.images = 0
+        self.ready_at = None
+        self.finished_at = None
+        self.decode_wait = 0.0
+        self.load = None
+        self.error = None
+
+    def images_per_second(self, now=None):
+        if self.ready_at is None:
+            return 0.0
+        elapsed = (self.finished_at or now or time.perf_counter()) - self.ready_at
+        return self.images / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            "worker": self.worker_id,
+            "cores": self.cores,
+            "threads": self.threads,
+            "images": self.images,
+            "images_per_second": round(self.images_per_second(), 3),
+            "decode_wait_seconds": round(self.decode_wait, 3),
+            "load": self.load,
+            "error": self.error,
+        }
+
+
+def run_parallel(args, runner, todo, writer, done, total):
+    """多进程数据并行：每个进程绑定一组CPU，权重通过内存映射共享，协调进程分发任务并写入结果"""
+    import multiprocessing
+    import queue
+
+    # spawn：子进程重新导入torch，不继承父进程的线程池状态
+    context = multiprocessing.get_context("spawn")
+    batch_size = runner.batch_size
+    groups = core_groups(args.processes)
+    default_threads = max(1, (os.cpu_count() or 1) // args.processes)
+    workers = [
+        WorkerStats(index, cores, args.threads_per_worker or (len(cores) if cores else default_threads))
+        for index, cores in enumerate(groups)
+    ]
+    tasks = context.Queue()
+    results = context.Queue()
+    for start in range(0, len(todo), batch_size):
+        tasks.put(todo[start:start + batch_size])
+    for _ in workers:
+        tasks.put(None)
+
+    def start_worker(stats):
+        process = context.Process(
+            target=worker_main, name=f"qwen-clip-worker-{stats.worker_id}",
+            args=(stats.worker_id, stats.cores, stats.threads, args, tasks, results), daemon=True,
+        )
+        process.start()
+        print(f"工作进程 {stats.worker_id}: CPU {stats.cores}，{stats.threads} 个线程")
+        return process
+
+    # 量化时先启动一个进程：首次量化由它生成并保存量化权重，其余进程直接映射已保存的文件
+    first = 1 if runner.quantization != "none" else len(workers)
+    processes = [start_worker(stats) for stats in workers[:first]]
+    started = time.perf_counter()
+    # progress 覆盖整个运行过程，用于进度报告；steady 在所有进程加载完成后才开始计时，
+    # 量化时其余进程的启动和加载不计入聚合吞吐
+    progress = Throughput(args.log_interval)
+    steady = None
+    startup_images = 0
+    startup_seconds = None
+    first_ready = None
+    running = len(workers)
+
+    def all_ready():
+        return all(stats.ready_at is not None or stats.finished_at is not None for stats in workers)
+    try:
+        while running:
+            try:
+                message = results.get(timeout=1.0)
+            except queue.Empty:
+                for stats, process in zip(workers, processes):
+                    if not process.is_alive() and stats.finished_at is None:
+                        stats.error = stats.error or f"工作进程异常退出（退出码 {process.exitcode}）"
+                        stats.finished_at = time.perf_counter()
+                        running -= 1
+                        print(f"工作进程 {stats.worker_id} {stats.error}")
+                if steady is None and first_ready is not None and all_ready():
+                    steady = Throughput(args.log_interval)
+                    startup_seconds = time.perf_counter() - started
+                continue
+            kind, worker_id, payload = message[0], message[1], message[2:]
+            stats = workers[worker_id]
+            now = time.perf_counter()
+            if kind == "ready":
+                stats.ready_at = now
+                stats.load = payload[0]
+                first_ready = first_ready or now
+                if len(processes) < len(workers):
+                    processes.extend(start_worker(other) for other in workers[len(processes):])
+            elif kind == "records":
+                records, generated, stats.decode_wait = payload
+                writer.write(records)
+                stats.images += generated
+                done += len(records)
+                if steady is not None:
+                    steady.add(generated)
+                else:
+                    startup_images += generated
+                progress.add(generated)
+                progress.decode_wait = sum(item.decode_wait for item in workers)
+                if progress.report(done, total):
+                    print("  " + "，".join(
+                        f"进程{item.worker_id} {item.images_per_second(now):.2f} 图/秒" for item in workers
+                    ), flush=True)
+            elif kind in ("done", "error"):
+                if kind == "done":
+                    stats.decode_wait = payload[0]
+                else:
+                    stats.error = payload[0]
+                    print(f"工作进程 {worker_id} 失败: {payload[0]}")
+                    if stats.ready_at is None and len(processes) < len(workers):
+                        # 第一个进程加载失败时其余进程也不会成功
+                        return None
+                stats.finished_at = now
+                running -= 1
+            if steady is None and first_ready is not None and all_ready():
+                steady = Throughput(args.log_interval)
+                startup_seconds = now - started
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        raise
+    for process in processes:
+        process.join()
+    if first_ready is None:
+        return None
+    if steady is None or steady.images == 0:
+        # 图像在其余进程加载完成之前就已处理完：从第一个进程加载完成开始计算
+        steady = Throughput(args.log_interval)
+        steady.started = first_ready
+        steady.add(startup_images)
+        startup_images = 0
+        startup_seconds = first_ready - started
+
+    progress.report(done, total, force=True)
+    steady.decode_wait = progress.decode_wait
+    steady_summary = steady.summary()
+    summary = dict(
+        steady_summary,
+        images=steady_summary["images"] + startup_images,
+        seconds=round(time.perf_counter() - started, 3),
+        steady_images=steady_summary["images"],
+        steady_seconds=steady_summary["seconds"],
+        startup_images=startup_images,
+        startup_seconds=round(startup_seconds, 3),
+        workers=[stats.to_dict() for stats in workers],
+    )
+    print(f"启动耗时 {startup_seconds:.1f}s（期间完成 {startup_images} 张），"
+          f"所有进程就绪后 {steady_summary['images_per_second']:.2f} 图/秒")
+    for stats in workers:
+        load = stats.load or {}
+        print(f"进程{stats.worker_id}: {stats.images} 张，{stats.images_per_second():.2f} 图/秒，"
+              f"CPU {len(stats.cores or [])} 个，{stats.threads} 个线程，"
+              f"映射权重 {load.get('mapped_bytes', 0) / 1024 ** 2:.0f} MB，"
+              f"私有权重 {load.get('materialized_bytes', 0) / 1024 ** 2:.0f} MB")
+    if any((stats.load or {}).get("materialized_bytes") for stats in workers):
+        print("提示：需要转换精度的权重每个进程各有一份，使用与权重文件一致的 --precision 可以让所有进程共用同一份")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Qwen-CLIP 批量反推提示词")
+    parser.add_argument("input", help="图像目录，或 .jsonl / .txt 清单")
+    parser.add_argument("--output", default=None, help="结果JSONL，默认写在输入旁边的 captions.jsonl")
+    parser.add_argument("--recursive", action="store_true", help="包含子目录中的图像")
+    parser.add_argument("--model-type", default="qwen2.5-vl-7b-instruct")
+    parser.add_argument("--custom-model-path", default="", help="model-type 为 custom 时的模型路径")
+    parser.add_argument("--detail-level", default="detailed", choices=["simple", "detailed"])
+    parser.add_argument("--batch-size", type=int, default=None, help="每次批量生成的图像数量")
+    parser.add_argument("--deterministic", action="store_true", help="使用贪心解码")
+    parser.add_argument("--max-new-tokens", type=int, default=None)
+    parser.add_argument("--resolution", default=None, help="分辨率预设 fast / balanced / max_detail")
+    parser.add_argument("--min-pixels", type=int, default=0)
+    parser.add_argument("--max-pixels", type=int, default=0)
+    parser.add_argument("--precision", default=None, help="auto / float16 / bfloat16 / float32")
+    parser.add_argument("--quantization", default=None, help="none / int8_dynamic / int8_weight_only")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="解码线程数（每个进程）")
+    parser.add_argument("--prefetch", type=int, default=0, help="最多提前解码的图像数，默认为批大小的4倍")
+    parser.add_argument("--processes", type=int, default=1, help="工作进程数，大于1时每个进程绑定一组CPU")
+    parser.add_argument("--threads-per-worker", type=int, default=0,
+                        help="每个工作进程的torch线程数，默认等于分到的CPU数")
+    parser.add_argument("--log-interval", type=float, default=10.0, help="打印吞吐的间隔（秒）")
+    parser.add_argument("--retry-errors", action="store_true", help="重新处理之前失败的图像")
+    parser.add_argument("--limit", type=int, default=0, help="最多处理的图像数量，0表示不限制")
+    parser.add_argument("--comfyui-root", default=None, help="ComfyUI根目录，用于共享模型目录")
+    parser.add_argument("--models-dir", default=None, help="模型目录（不在ComfyUI中运行时）")
+    args = parser.parse_args()
+
+    load_plugin(args.comfyui_root, args.models_dir)
+    # 参数有误时在加载模型之前报错
+    runner = CaptionRunner(args)
+
+    if os.path.isdir(args.input):
+        entries = list_directory(args.input, args.recursive)
+        default_output = os.path.join(args.input, "captions.jsonl")
+    else:
+        entries = read_manifest(args.input)
+        default_output = os.path.splitext(args.input)[0] + ".captions.jsonl"
+    output_path = args.output or default_output
+    finished = read_finished(output_path, args.retry_errors)
+    todo = [entry for entry in entries if entry[0] not in finished]
+    done = len(entries) - len(todo)
+    if args.limit > 0:
+        todo = todo[:args.limit]
+    print(f"共 {len(entries)} 张图像，已完成 {done} 张，本次处理 {len(todo)} 张，结果写入: {output_path}")
+    if not todo:
+        return 0
+
+    total = done + len(todo)
+    writer = ResultWriter(output_path)
+    try:
+        if args.processes > 1:
+            summary = run_parallel(args, runner, todo, writer, done, total)
+            if summary is None:
+                return 1
+        else:
+            try:
+                runner.load()
+                throughput = Throughput(args.log_interval)
+                for records, generated in runner.run(todo):
+                    writer.write(records)
+                    done += len(records)
+                    throughput.add(generated)
+                    throughput.decode_wait = runner.decode_wait
+                    throughput.report(done, total)
+            finally:
+                runner.close()
+            throughput.report(done, total, force=True)
+            summary = throughput.summary()
+    except KeyboardInterrupt:
+        print("已中断，已完成的结果已保存；重新运行相同的命令即可继续")
+        return 130
+    finally:
+        writer.close()
+
+    summary.update(errors=writer.errors, output=output_path)
+    print(f"完成: {summary['images']} 张，{summary['seconds']:.1f}s，{summary['images_per_second']:.2f} 图/秒，"
+          f"失败 {writer.errors} 张")
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
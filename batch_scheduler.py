@@ -0,0 +1,151 @@
+"""
+动态批处理调度
+并发的生成请求先进入队列，在最长等待时间内把参数相同的请求合并成一批，
+只调用一次 model.generate，再把结果按顺序分给各个调用方。
+"""
+
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+from .config import env_float
+from .metrics import CaptionMetrics
+
+# 第一个请求入队后最多等待多久以凑满一批（毫秒），0 表示只合并已经在排队的请求
+DEFAULT_MAX_WAIT_MS = env_float("QWEN_CLIP_BATCH_WAIT_MS", 5.0)
+
+
+class _BatchRequest:
+    def __init__(self, key, items, run, max_batch_size, metrics):
+        self.key = key
+        self.items = items
+        self.run = run
+        self.max_batch_size = max(1, max_batch_size)
+        self.metrics = metrics
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class BatchScheduler:
+    """按 key 合并请求；同一个 key 的请求使用同一个 run(items, metrics) 生成结果"""
+
+    def __init__(self, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._worker = None
+        self._batches = 0
+        self._requests = 0
+        self._items = 0
+        self._queue_wait = 0.0
+        self._max_queue_depth = 0
+        self._batch_sizes = collections.Counter()
+
+    def submit(self, key, items, run, max_batch_size, metrics=None):
+        """提交一组待生成的项目，返回 Future，结果与 items 一一对应"""
+        request = _BatchRequest(key, list(items), run, max_batch_size, metrics)
+        if not request.items:
+            request.future.set_result([])
+            return request.future
+        with self._cond:
+            self._pending.append(request)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._pending))
+            self._ensure_worker()
+            self._cond.notify_all()
+        return request.future
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queue_depth": len(self._pending),
+                "queued_items": sum(len(request.items) for request in self._pending),
+                "max_queue_depth": self._max_queue_depth,
+                "batches": self._batches,
+                "requests": self._requests,
+                "items": self._items,
+                "avg_batch_size": self._items / self._batches if self._batches else 0.0,
+                "batch_sizes": {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                "avg_queue_wait_ms": self._queue_wait / self._requests * 1000 if self._requests else 0.0,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run_forever, name="qwen-clip-batcher", daemon=True)
+            self._worker.start()
+
+    def _run_forever(self):
+        while True:
+            batch = self._next_batch()
+            self._run_batch(batch)
+
+    def _compatible(self, key, limit):
+        """按入队顺序取出与 key 相同、总数量不超过 limit 的请求（至少包含第一个）"""
+        selected = []
+        count = 0
+        for request in self._pending:
+            if request.key != key:
+                continue
+            if selected and count + len(request.items) > limit:
+                break
+            selected.append(request)
+            count += len(request.items)
+        return selected, count
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            first = self._pending[0]
+            deadline = first.enqueued + self.max_wait
+            while True:
+                selected, count = self._compatible(first.key, first.max_batch_size)
+                remaining = deadline - time.perf_counter()
+                if count >= first.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            for request in selected:
+                self._pending.remove(request)
+            return selected
+
+    def _run_batch(self, batch):
+        started = time.perf_counter()
+        items = [item for request in batch for item in request.items]
+        tracked = [request for request in batch if request.metrics is not None and request.metrics.enabled]
+        batch_metrics = CaptionMetrics(reset_peak=False) if tracked else None
+        try:
+            results = batch[0].run(items, batch_metrics)
+        except BaseException as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        finally:
+            with self._cond:
+                self._batches += 1
+                self._requests += len(batch)
+                self._items += len(items)
+                self._batch_sizes[len(items)] += 1
+                self._queue_wait += sum(started - request.enqueued for request in batch)
+
+        offset = 0
+        for request in batch:
+            if request in tracked:
+                request.metrics.merge(batch_metrics)
+                request.metrics.add_stage("queue_wait", started - request.enqueued)
+                request.metrics.set("scheduled_batch_size", len(items))
+            request.future.set_result(results[offset:offset + len(request.items)])
+            offset += len(request.items)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_batch_scheduler():
+    """进程级的调度器单例，节点和提示词服务共用"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = BatchScheduler()
+        return _scheduler
@@ -0,0 +1,524 @@
+"""
+离线性能基准
+在本地生成一个与 Qwen2.5-VL 结构相同、随机初始化的小模型，不需要网络和GPU，
+通过插件真实的 ImageCaptionGenerator / QwenClipNode 代码路径测量：
+模型加载时间、预处理时间、单图延迟、tokens/s 和峰值RSS，结果保存为JSON便于比较。
+
+用法：
+    python custom_nodes/qwen-clip/benchmark.py --batch-sizes 1,4 --resolutions 256x256,512x512
+    python custom_nodes/qwen-clip/benchmark.py --node --output bench_results/baseline.json
+    python custom_nodes/qwen-clip/benchmark.py --prefix-cache --batch-sizes 1,4
+    python custom_nodes/qwen-clip/benchmark.py --quantization --batch-sizes 1
+"""
+
+import argparse
+import contextlib
+import difflib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from standalone import PLUGIN_DIR, import_plugin_module, load_plugin
+
+DEFAULT_MODEL_DIR = os.path.join(PLUGIN_DIR, "bench_results", "tiny-qwen2.5-vl")
+
+# 小模型使用的特殊token，与 Qwen2.5-VL 的对话模板保持一致
+SPECIAL_TOKENS = [
+    "<|endoftext|>", "<|im_start|>", "<|im_end|>",
+    "<|vision_start|>", "<|vision_end|>", "<|image_pad|>", "<|video_pad|>",
+]
+
+# 量化对比的配置：(精度, 量化方式)，第一项为基线
+QUANTIZATION_CONFIGS = [
+    ("float32", "none"),
+    ("auto", "none"),
+    ("auto", "int8_weight_only"),
+    ("float32", "int8_dynamic"),
+]
+
+# 训练分词器用的示例回答，覆盖JSON结构和中英文
+SAMPLE_ANSWER = (
+    '{"中文提示词": "一只橘色的猫坐在窗台上，阳光，柔和的光影，写实风格", '
+    '"英文提示词": "an orange cat sitting on a windowsill, sunlight, soft shadows, realistic style"}'
+)
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n"
+    "{% if message['content'] is string %}{{ message['content'] }}"
+    "{% else %}{% for content in message['content'] %}"
+    "{% if content['type'] == 'image' %}<|vision_start|><|image_pad|><|vision_end|>"
+    "{% elif content['type'] == 'text' %}{{ content['text'] }}{% endif %}"
+    "{% endfor %}{% endif %}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+def build_tiny_model(model_dir, hidden_size=64, num_layers=2, vision_depth=2):
+    """生成随机初始化的小型 Qwen2.5-VL 模型（分词器、processor、权重）"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import (
+        Qwen2_5_VLConfig,
+        Qwen2_5_VLForConditionalGeneration,
+        Qwen2_5_VLProcessor,
+        Qwen2TokenizerFast,
+        Qwen2VLImageProcessor,
+    )
+    prompts = import_plugin_module("prompts")
+    training_text = [prompts.CAPTION_PROMPT, SAMPLE_ANSWER] * 8
+
+    # 字节级BPE分词器，只用少量文本训练，足以覆盖中英文提示词
+    tokenizer_model = Tokenizer(models.BPE())
+    tokenizer_model.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer_model.decoder = decoders.ByteLevel()
+    tokenizer_model.train_from_iterator(
+        training_text,
+        trainers.BpeTrainer(
+            vocab_size=1024, special_tokens=SPECIAL_TOKENS,
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+    tokenizer = Qwen2TokenizerFast(
+        tokenizer_object=tokenizer_model, eos_token="<|im_end|>", pad_token="<|endoftext|>", unk_token=None,
+    )
+    token_ids = {token: tokenizer.convert_tokens_to_ids(token) for token in SPECIAL_TOKENS}
+
+    processor_kwargs = {}
+    try:
+        from transformers import Qwen2VLVideoProcessor
+        processor_kwargs["video_processor"] = Qwen2VLVideoProcessor()
+    except ImportError:
+        pass
+    processor = Qwen2_5_VLProcessor(
+        image_processor=Qwen2VLImageProcessor(),
+        tokenizer=tokenizer,
+        chat_template=CHAT_TEMPLATE,
+        **processor_kwargs,
+    )
+
+    head_dim = 16
+    config = Qwen2_5_VLConfig(
+        text_config={
+            "vocab_size": len(tokenizer),
+            "hidden_size": hidden_size,
+            "intermediate_size": hidden_size * 2,
+            "num_hidden_layers": num_layers,
+            "num_attention_heads": hidden_size // head_dim,
+            "num_key_value_heads": max(1, hidden_size // head_dim // 2),
+            "max_position_embeddings": 32768,
+            # mrope 三个维度之和等于 head_dim / 2
+            "rope_scaling": {"type": "mrope", "mrope_section": [2, 3, 3]},
+            "bos_token_id": token_ids["<|endoftext|>"],
+            "eos_token_id": token_ids["<|im_end|>"],
+            "pad_token_id": token_ids["<|endoftext|>"],
+        },
+        vision_config={
+            "depth": vision_depth,
+            "hidden_size": 32,
+            "intermediate_size": 64,
+            "num_heads": 2,
+            "out_hidden_size": hidden_size,
+            "patch_size": 14,
+            "spatial_merge_size": 2,
+            "temporal_patch_size": 2,
+            "window_size": 112,
+            "fullatt_block_indexes": [vision_depth - 1],
+        },
+        image_token_id=token_ids["<|image_pad|>"],
+        video_token_id=token_ids["<|video_pad|>"],
+        vision_start_token_id=token_ids["<|vision_start|>"],
+        vision_end_token_id=token_ids["<|vision_end|>"],
+    )
+    model = Qwen2_5_VLForConditionalGeneration(config)
+    model.save_pretrained(model_dir, safe_serialization=True)
+    processor.save_pretrained(model_dir)
+    return model_dir
+
+
+def peak_rss_mb():
+    """进程生命周期内的峰值RSS（MB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux上单位是KB，macOS上是字节
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb():
+    """当前RSS（MB），不支持时返回峰值"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+class GenerateCounter:
+    """包装 model.generate，统计生成的token数"""
+
+    def __init__(self, model):
+        self.model = model
+        self.original = model.generate
+        self.tokens = 0
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        output = self.original(*args, **kwargs)
+        prompt_length = kwargs["input_ids"].shape[1] if "input_ids" in kwargs else args[0].shape[1]
+        self.tokens += (output.shape[1] - prompt_length) * output.shape[0]
+        self.calls += 1
+        return output
+
+    def __enter__(self):
+        self.model.generate = self
+        return self
+
+    def __exit__(self, *exc):
+        self.model.generate = self.original
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def random_images(torch, count, width, height, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.rand(count, height, width, 3, generator=generator)
+
+
+def bench_generator(args, model_dir):
+    """通过 ImageCaptionGenerator 测量加载、预处理和生成"""
+    import torch
+    utils = import_plugin_module("utils")
+
+    generator = utils.ImageCaptionGenerator()
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        generator.load_model(model_dir, "custom", torch_dtype=args.dtype, device_map="cpu")
+    load_seconds = time.perf_counter() - start
+    load = {
+        "load_seconds": load_seconds,
+        "rss_delta_mb": current_rss_mb() - rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+        "parameters": sum(p.numel() for p in generator.model.parameters()),
+        # 加载方式（mmap / transformers）和加载期间的峰值RSS
+        "loader": generator.load_stats,
+    }
+    print(f"模型加载: {load_seconds:.3f}s，参数量 {load['parameters']}，"
+          f"加载期间峰值RSS增加 {generator.load_stats['peak_rss_delta_bytes'] / 1024 ** 2:.0f} MB")
+
+    runs = []
+    for width, height in args.resolutions:
+        for batch_size in args.batch_sizes:
+            count = max(batch_size, args.images)
+            image = random_images(torch, count, width, height)
+
+            # 预处理：张量转换 + processor
+            start = time.perf_counter()
+            images = utils.tensor_to_images(image)
+            generator._build_processor_inputs(images[:batch_size])
+            preprocess_seconds = time.perf_counter() - start
+
+            # 预热一次，排除首次调用的初始化开销
+            with contextlib.redirect_stdout(io.StringIO()):
+                generator.generate_captions(images[:batch_size], "detailed", batch_size=batch_size,
+                                            deterministic=True, max_new_tokens=args.max_new_tokens)
+
+            with GenerateCounter(generator.model) as counter, contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    generator.generate_captions(images, "detailed", batch_size=batch_size,
+                                                deterministic=True, max_new_tokens=args.max_new_tokens)
+                elapsed = time.perf_counter() - start
+
+            total_images = count * args.repeat
+            run = {
+                "path": "generator",
+                "resolution": f"{width}x{height}",
+                "batch_size": batch_size,
+                "images": total_images,
+                "preprocess_seconds": preprocess_seconds,
+                "latency_per_image_seconds": elapsed / total_images,
+                "generated_tokens": counter.tokens,
+                "tokens_per_second": counter.tokens / elapsed if elapsed > 0 else 0.0,
+                "peak_rss_mb": peak_rss_mb(),
+            }
+            runs.append(run)
+            print_run(run)
+
+    generator.unload_model()
+    return load, runs
+
+
+def bench_prefix_cache(args, model_dir):
+    """对比指令前缀KV缓存开启/关闭时的预填充耗时（只生成1个token）"""
+    import torch
+    utils = import_plugin_module("utils")
+
+    generator = utils.ImageCaptionGenerator()
+    with contextlib.redirect_stdout(io.StringIO()):
+        generator.load_model(model_dir, "custom", torch_dtype=args.dtype, device_map="cpu")
+
+    runs = []
+    for width, height in args.resolutions:
+        for batch_size in args.batch_sizes:
+            images = utils.tensor_to_images(random_images(torch, batch_size, width, height))
+            timings = {}
+            for enabled in (False, True):
+                generator.prefix_cache_enabled = enabled
+                with contextlib.redirect_stdout(io.StringIO()):
+                    # 预热；开启时同时计算出前缀缓存
+                    generator.generate_captions(images, "detailed", batch_size=batch_size,
+                                                deterministic=True, max_new_tokens=1)
+                    start = time.perf_counter()
+                    for _ in range(args.repeat):
+                        generator.generate_captions(images, "detailed", batch_size=batch_size,
+                                                    deterministic=True, max_new_tokens=1)
+                    timings[enabled] = (time.perf_counter() - start) / args.repeat
+            prefix = generator._prompt_prefix()
+            run = {
+                "resolution": f"{width}x{height}",
+                "batch_size": batch_size,
+                "prefix_tokens": int(prefix[1].shape[0]) if prefix is not None else 0,
+                "prefill_seconds": timings[False],
+                "prefill_seconds_cached": timings[True],
+                "saving": 1 - timings[True] / timings[False] if timings[False] > 0 else 0.0,
+            }
+            runs.append(run)
+            print(f"[prefix_cache] {run['resolution']} batch={batch_size}: 预填充 "
+                  f"{timings[False] * 1000:.1f} ms -> {timings[True] * 1000:.1f} ms"
+                  f"（复用 {run['prefix_tokens']} 个前缀token，节省 {run['saving'] * 100:.0f}%）")
+
+    generator.unload_model()
+    return runs
+
+
+def run_quantization_config(args, model_dir):
+    """（子进程中运行）加载一种精度/量化配置，测量加载、RSS和生成，结果输出为一行JSON"""
+    import torch
+    utils = import_plugin_module("utils")
+    precision, quantization = args.quantization_run.split(":")
+
+    generator = utils.ImageCaptionGenerator()
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        generator.load_model(model_dir, "custom", torch_dtype=precision, device_map="cpu",
+                             quantization=quantization)
+    result = {
+        "precision": precision,
+        "quantization": quantization,
+        "dtype": str(generator.model.dtype).replace("torch.", ""),
+        "load_seconds": time.perf_counter() - start,
+        "load_rss_mb": current_rss_mb() - rss_before,
+    }
+
+    width, height = args.resolutions[0]
+    batch_size = args.batch_sizes[0]
+    images = utils.tensor_to_images(random_images(torch, max(batch_size, args.images), width, height))
+    with contextlib.redirect_stdout(io.StringIO()):
+        generator.generate_captions(images[:batch_size], "detailed", batch_size=batch_size,
+                                    deterministic=True, max_new_tokens=args.max_new_tokens)
+        with GenerateCounter(generator.model) as counter:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                captions = generator.generate_captions(images, "detailed", batch_size=batch_size,
+                                                       deterministic=True, max_new_tokens=args.max_new_tokens)
+            elapsed = time.perf_counter() - start
+    result.update({
+        "latency_per_image_seconds": elapsed / (len(images) * args.repeat),
+        "tokens_per_second": counter.tokens / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "captions": [list(caption) for caption in captions],
+    })
+    print(json.dumps(result, ensure_ascii=False))
+
+
+def caption_drift(baseline, captions):
+    """与基线相比：完全相同的比例和平均文本相似度（0-1）"""
+    pairs = [(a, b) for base, other in zip(baseline, captions) for a, b in zip(base, other)]
+    if not pairs:
+        return 0.0, 0.0
+    identical = sum(a == b for a, b in pairs) / len(pairs)
+    similarity = sum(difflib.SequenceMatcher(None, a, b).ratio() for a, b in pairs) / len(pairs)
+    return identical, similarity
+
+
+def bench_quantization(args, model_dir):
+    """对比不同精度和int8量化的加载时间、RSS、延迟和提示词偏差；每种配置在单独的进程中测量"""
+    runs = []
+    for precision, quantization in QUANTIZATION_CONFIGS:
+        # 第一次运行会量化并保存权重，第二次在新进程中读取已保存的量化权重并推理，检查保存的文件可以直接使用
+        for attempt in range(2 if quantization != "none" else 1):
+            command = [
+                sys.executable, os.path.abspath(__file__), "--model-dir", model_dir,
+                "--quantization-run", f"{precision}:{quantization}",
+                "--batch-sizes", str(args.batch_sizes[0]),
+                "--resolutions", "{}x{}".format(*args.resolutions[0]),
+                "--images", str(args.images), "--repeat", str(args.repeat),
+                "--max-new-tokens", str(args.max_new_tokens), "--threads", str(args.threads),
+            ]
+            if args.comfyui_root:
+                command += ["--comfyui-root", args.comfyui_root]
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                # 进程被信号终止时返回码为负数（例如量化权重未对齐导致的段错误）
+                stage = "读取已保存的量化权重后推理" if attempt > 0 else "加载并推理"
+                raise Exception(f"{precision}/{quantization} {stage}失败，返回码 {result.returncode}: "
+                                f"{result.stderr.strip()[-2000:]}")
+            output = result.stdout
+            # 进程退出时模型析构还会打印日志，取最后一行JSON
+            line = [line for line in output.splitlines() if line.startswith("{")][-1]
+            run = json.loads(line)
+            run["cached_checkpoint"] = attempt > 0
+            runs.append(run)
+
+    baseline = runs[0]
+    for run in runs:
+        run["identical"], run["similarity"] = caption_drift(baseline["captions"], run["captions"])
+        run["speedup"] = (baseline["latency_per_image_seconds"] / run["latency_per_image_seconds"]
+                          if run["latency_per_image_seconds"] > 0 else 0.0)
+        print(f"[quantization] {run['precision']}/{run['quantization']} ({run['dtype']})"
+              f"{'，读取已保存的权重' if run['cached_checkpoint'] else ''}: "
+              f"加载 {run['load_seconds']:.2f}s，加载RSS {run['load_rss_mb']:.0f} MB，"
+              f"{run['latency_per_image_seconds'] * 1000:.1f} ms/图（{run['speedup']:.2f}x），"
+              f"{run['tokens_per_second']:.1f} tokens/s，与基线相同 {run['identical'] * 100:.0f}%，"
+              f"相似度 {run['similarity']:.3f}")
+    return runs
+
+
+def bench_node(args, model_dir):
+    """通过 QwenClipNode 测量端到端延迟（含模型池和图像转换，不使用缓存）"""
+    import torch
+    node_module = import_plugin_module("qwen_clip_node")
+    node = node_module.QwenClipNode()
+
+    runs = []
+    for width, height in args.resolutions:
+        for batch_size in args.batch_sizes:
+            count = max(batch_size, args.images)
+            image = random_images(torch, count, width, height)
+            kwargs = dict(custom_model_path=model_dir, batch_size=batch_size, use_cache=False,
+                          deterministic=True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                # 第一次调用包含模型加载，单独记录
+                start = time.perf_counter()
+                node.generate_caption(image, "custom", **kwargs)
+                first_call = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    node.generate_caption(image, "custom", **kwargs)
+                elapsed = time.perf_counter() - start
+
+            total_images = count * args.repeat
+            run = {
+                "path": "node",
+                "resolution": f"{width}x{height}",
+                "batch_size": batch_size,
+                "images": total_images,
+                "first_call_seconds": first_call,
+                "latency_per_image_seconds": elapsed / total_images,
+                "peak_rss_mb": peak_rss_mb(),
+            }
+            runs.append(run)
+            print_run(run)
+    return runs
+
+
+def print_run(run):
+    line = (f"[{run['path']}] {run['resolution']} batch={run['batch_size']}: "
+            f"{run['latency_per_image_seconds'] * 1000:.1f} ms/图")
+    if "tokens_per_second" in run:
+        line += f"，{run['tokens_per_second']:.1f} tokens/s，预处理 {run['preprocess_seconds'] * 1000:.1f} ms"
+    line += f"，峰值RSS {run['peak_rss_mb']:.0f} MB"
+    print(line)
+
+
+def environment_info():
+    import torch
+    import transformers
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Qwen-CLIP 离线性能基准")
+    parser.add_argument("--model-dir", default=DEFAULT_MODEL_DIR, help="小模型的保存目录")
+    parser.add_argument("--rebuild", action="store_true", help="重新生成小模型")
+    parser.add_argument("--batch-sizes", default="1,4", help="逗号分隔的批大小")
+    parser.add_argument("--resolutions", default="256x256,512x512", help="逗号分隔的分辨率，例如 256x256")
+    parser.add_argument("--images", type=int, default=4, help="每组测量的图像数量")
+    parser.add_argument("--repeat", type=int, default=2, help="每组重复次数")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="每张图生成的token数")
+    parser.add_argument("--dtype", default="float32", help="模型精度")
+    parser.add_argument("--threads", type=int, default=0, help="torch线程数，0表示默认")
+    parser.add_argument("--node", action="store_true", help="同时测量 QwenClipNode 端到端路径")
+    parser.add_argument("--prefix-cache", action="store_true", help="对比指令前缀KV缓存开启/关闭时的预填充耗时")
+    parser.add_argument("--quantization", action="store_true",
+                        help="对比 float32 基线、auto精度和int8量化的延迟、RSS和提示词偏差")
+    parser.add_argument("--quantization-run", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--comfyui-root", default=None, help="ComfyUI根目录（可选）")
+    parser.add_argument("--output", default=None, help="结果JSON路径，默认写入 bench_results/")
+    args = parser.parse_args()
+    args.batch_sizes = [int(value) for value in args.batch_sizes.split(",") if value]
+    args.resolutions = [parse_resolution(value) for value in args.resolutions.split(",") if value]
+
+    load_plugin(args.comfyui_root)
+    import torch
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    if args.quantization_run:
+        run_quantization_config(args, args.model_dir)
+        return
+
+    if args.rebuild or not os.path.isfile(os.path.join(args.model_dir, "config.json")):
+        print(f"生成随机初始化的小模型: {args.model_dir}")
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_tiny_model(args.model_dir)
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment_info(),
+        "settings": {
+            "batch_sizes": args.batch_sizes,
+            "resolutions": [f"{w}x{h}" for w, h in args.resolutions],
+            "images": args.images,
+            "repeat": args.repeat,
+            "max_new_tokens": args.max_new_tokens,
+            "dtype": args.dtype,
+        },
+    }
+    results["load"], results["runs"] = bench_generator(args, args.model_dir)
+    if args.node:
+        results["runs"].extend(bench_node(args, args.model_dir))
+    if args.prefix_cache:
+        results["prefix_cache"] = bench_prefix_cache(args, args.model_dir)
+    if args.quantization:
+        results["quantization"] = bench_quantization(args, args.model_dir)
+
+    output = args.output or os.path.join(
+        PLUGIN_DIR, "bench_results", f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+取消生成
+ComfyUI 的中断按钮或调用方的取消事件触发后，解码在下一个token步停止。
+不依赖torch；在ComfyUI之外运行时只响应取消事件。
+"""
+
+import sys
+
+
+class GenerationCancelled(Exception):
+    """生成被调用方取消（不在ComfyUI中运行时使用）"""
+
+
+def _comfy_model_management():
+    # 只使用ComfyUI已经加载的模块，独立运行时不会触发导入
+    return sys.modules.get("comfy.model_management")
+
+
+def comfy_interrupted():
+    """ComfyUI 是否请求中断当前任务"""
+    model_management = _comfy_model_management()
+    return bool(model_management is not None and model_management.processing_interrupted())
+
+
+def raise_cancelled():
+    """抛出取消异常：ComfyUI中断时抛出其 InterruptProcessingException，使任务显示为已中断而不是出错"""
+    model_management = _comfy_model_management()
+    if model_management is not None and model_management.processing_interrupted():
+        model_management.throw_exception_if_processing_interrupted()
+    raise GenerationCancelled("生成已取消")
+
+
+def is_cancellation(error):
+    """取消异常需要原样向上传递，不能包装成普通错误"""
+    return isinstance(error, GenerationCancelled) or type(error).__name__ == "InterruptProcessingException"
@@ -0,0 +1,261 @@
+"""
+提示词结果缓存
+以图像内容哈希 + 模型 + 提示词 + 生成参数作为键，内存LRU层在前，磁盘层持久化。
+命中时直接返回结果，不需要加载模型。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .config import env_int, env_str
+
+DEFAULT_CACHE_DIR = env_str(
+    "QWEN_CLIP_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"),
+)
+# 内存层最多保存的条目数
+DEFAULT_MEMORY_ITEMS = env_int("QWEN_CLIP_CACHE_MEMORY_ITEMS", 1024)
+# 磁盘层的容量上限(MB)，0表示不使用磁盘层
+DEFAULT_DISK_MB = env_int("QWEN_CLIP_CACHE_DISK_MB", 256)
+
+
+class LRUCache:
+    """线程安全的LRU缓存，可同时按条目数和字节数限制容量"""
+
+    def __init__(self, max_items=0, max_bytes=0, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes > 0 and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while self._data and (
+                (self.max_items > 0 and len(self._data) > self.max_items)
+                or (self.max_bytes > 0 and self._bytes > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"items": len(self._data), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+class DiskCache:
+    """每个条目一个文件的磁盘缓存，超出容量时按最近访问时间淘汰"""
+
+    def __init__(self, cache_dir, max_bytes, suffix=".json"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._index = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def touch(self, key):
+        """记录一次命中，刷新淘汰顺序"""
+        path = self.path_for(key)
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            return
+        with self._lock:
+            if self._index is not None and key in self._index:
+                self._index[key] = (self._index[key][0], now)
+
+    def commit(self, key, temp_path):
+        """将写好的临时文件原子地放入缓存"""
+        path = self.path_for(key)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._load_index()
+            if key in self._index:
+                self._bytes -= self._index[key][0]
+            self._index[key] = (size, time.time())
+            self._bytes += size
+            self._evict()
+
+    def temp_path_for(self, key):
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def clear(self):
+        """删除缓存目录中的所有条目"""
+        with self._lock:
+            if os.path.isdir(self.cache_dir):
+                for root, _, files in os.walk(self.cache_dir):
+                    for name in files:
+                        if name.endswith(self.suffix):
+                            try:
+                                os.remove(os.path.join(root, name))
+                            except OSError:
+                                pass
+            self._index = {}
+            self._bytes = 0
+
+    def _load_index(self):
+        """首次写入时扫描缓存目录，之后增量维护"""
+        if self._index is not None:
+            return
+        self._index = {}
+        self._bytes = 0
+        if not os.path.isdir(self.cache_dir):
+            return
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                self._index[name[:-len(self.suffix)]] = (stat.st_size, stat.st_mtime)
+                self._bytes += stat.st_size
+
+    def _evict(self):
+        if self._bytes <= self.max_bytes:
+            return
+        for key, (size, _) in sorted(self._index.items(), key=lambda item: item[1][1]):
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+            del self._index[key]
+            self._bytes -= size
+            if self._bytes <= self.max_bytes:
+                break
+
+
+class CaptionCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_memory_items=DEFAULT_MEMORY_ITEMS,
+                 max_disk_mb=DEFAULT_DISK_MB):
+        self.memory = LRUCache(max_items=max_memory_items)
+        self.disk = DiskCache(os.path.join(cache_dir, "captions"), max_disk_mb * 1024 * 1024)
+
+    @staticmethod
+    def make_key(image, model_id, prompt, detail_level, generation_params):
+        """图像内容哈希 + 模型 + 提示词 + 生成参数"""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(hash_image(image).encode("utf-8"))
+        meta = json.dumps(
+            [model_id, prompt, detail_level, generation_params],
+            ensure_ascii=False, sort_keys=True, default=str,
+        )
+        digest.update(meta.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """返回 (中文, 英文)，未命中返回None"""
+        caption = self.memory.get(key)
+        if caption is not None:
+            return caption
+        if not self.disk.enabled:
+            return None
+        try:
+            with open(self.disk.path_for(key), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            caption = (data["中文提示词"], data["英文提示词"])
+        except (OSError, ValueError, KeyError):
+            return None
+        self.disk.touch(key)
+        self.memory.put(key, caption)
+        return caption
+
+    def put(self, key, caption):
+        self.memory.put(key, tuple(caption))
+        if not self.disk.enabled:
+            return
+        try:
+            temp_path = self.disk.temp_path_for(key)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"中文提示词": caption[0], "英文提示词": caption[1]}, f, ensure_ascii=False)
+            self.disk.commit(key, temp_path)
+        except OSError as e:
+            print(f"警告：写入提示词缓存失败: {str(e)}")
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+
+def hash_image(image):
+    """图像内容的快速哈希，支持numpy数组/torch张量/PIL图像/文件路径"""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    if hasattr(image, "tobytes") and hasattr(image, "mode"):
+        # PIL图像
+        digest.update(f"{image.mode}{image.size}".encode("utf-8"))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+    if hasattr(image, "detach"):
+        image = image.detach().cpu().contiguous().numpy()
+    digest.update(f"{image.dtype}{image.shape}".encode("utf-8"))
+    # 连续数组直接按内存哈希，避免复制
+    digest.update(memoryview(image).cast("B") if image.flags["C_CONTIGUOUS"] else image.tobytes())
+    return digest.hexdigest()
+
+
+def model_fingerprint(model_path):
+    """模型标识：路径 + config.json修改时间，模型文件被替换后缓存自动失效"""
+    try:
+        mtime = os.path.getmtime(os.path.join(model_path, "config.json"))
+    except OSError:
+        mtime = 0
+    return f"{os.path.abspath(model_path)}@{mtime:.0f}"
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_caption_cache():
+    """获取进程级共享的提示词缓存"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CaptionCache()
+        return _cache
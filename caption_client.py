@@ -0,0 +1,182 @@
+"""
+提示词服务的客户端
+节点配置了 service_url 后不再在本进程加载模型，而是把图像发送给共享的提示词服务（caption_service.py）。
+只依赖标准库（numpy 在发送时才导入），通过连接池复用 HTTP/1.1 长连接。
+"""
+
+import http.client
+import io
+import json
+import queue
+import socket
+import threading
+import urllib.parse
+
+from .config import env_float, env_int, env_str
+
+# 提示词服务地址：http://127.0.0.1:8190 或 unix:///tmp/qwen_clip.sock，为空时在本进程生成
+SERVICE_URL = env_str("QWEN_CLIP_SERVICE_URL")
+# 每个服务地址最多同时占用的连接数
+SERVICE_POOL_SIZE = env_int("QWEN_CLIP_SERVICE_POOL_SIZE", 4)
+# 单次请求超时（秒），首次请求可能包含模型加载
+SERVICE_TIMEOUT = env_float("QWEN_CLIP_SERVICE_TIMEOUT", 600.0)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """通过Unix socket发送HTTP请求"""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def frames_to_npy(image):
+    """将ComfyUI的IMAGE批次转换为uint8的 .npy 字节，服务端按帧生成提示词"""
+    import numpy as np
+
+    if hasattr(image, "detach"):
+        # 不需要导入torch：直接使用张量方法转换
+        image = (image.detach().clamp(0, 1) * 255).round().byte().cpu().numpy()
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    if image.ndim == 3:
+        image = image[None]
+    buffer = io.BytesIO()
+    np.save(buffer, image, allow_pickle=False)
+    return buffer.getvalue()
+
+
+class CaptionServiceClient:
+    """提示词服务客户端，线程安全，空闲连接放回连接池复用"""
+
+    def __init__(self, url, pool_size=SERVICE_POOL_SIZE, timeout=SERVICE_TIMEOUT):
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme == "unix":
+            self.socket_path = parsed.path
+            if not self.socket_path:
+                raise Exception(f"无效的提示词服务地址: {url}")
+            if not hasattr(socket, "AF_UNIX"):
+                raise Exception(f"当前平台不支持Unix socket，请使用 http:// 地址: {url}")
+        elif parsed.scheme == "http":
+            self.socket_path = None
+            self.host = parsed.hostname or "127.0.0.1"
+            self.port = parsed.port or 80
+        else:
+            raise Exception(f"不支持的提示词服务地址: {url}（支持 http:// 和 unix://）")
+        self.url = url
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, pool_size))
+
+    def _new_connection(self):
+        if self.socket_path:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    def request(self, method, path, body=None, headers=None):
+        """发送请求，返回 (状态码, JSON)；复用的连接已被服务端关闭时换新连接重试一次"""
+        headers = dict(headers or {})
+        with self._slots:
+            connection, reused = self._checkout()
+            while True:
+                try:
+                    connection.request(method, path, body=body, headers=headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    connection.close()
+                    if not reused:
+                        raise
+                    connection, reused = self._new_connection(), False
+                except Exception:
+                    connection.close()
+                    raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._idle.put(connection)
+        try:
+            payload = json.loads(data.decode("utf-8")) if data else {}
+        except ValueError:
+            payload = {"error": data.decode("utf-8", errors="replace")}
+        return response.status, payload
+
+    def caption(self, image, model_type, custom_model_path="", detail_level="detailed",
+                batch_size=None, use_cache=True, deterministic=False, resolution=None,
+                min_pixels=0, max_pixels=0, precision=None, quantization=None, collect_metrics=False):
+        """返回 ([(中文, 英文), ...], 服务端统计或None)"""
+        params = {
+            "model_type": model_type,
+            "custom_model_path": custom_model_path,
+            "detail_level": detail_level,
+            "use_cache": int(bool(use_cache)),
+            "deterministic": int(bool(deterministic)),
+            "collect_metrics": int(bool(collect_metrics)),
+        }
+        if batch_size is not None:
+            params["batch_size"] = batch_size
+        if resolution:
+            params["resolution"] = resolution
+        if min_pixels:
+            params["min_pixels"] = min_pixels
+        if max_pixels:
+            params["max_pixels"] = max_pixels
+        if precision:
+            params["precision"] = precision
+        if quantization:
+            params["quantization"] = quantization
+        path = "/caption?" + urllib.parse.urlencode(params)
+        try:
+            status, payload = self.request(
+                "POST", path, body=frames_to_npy(image),
+                headers={"Content-Type": "application/x-npy"},
+            )
+        except OSError as e:
+            raise Exception(f"无法连接提示词服务 {self.url}: {str(e)}")
+        if status != 200:
+            raise Exception(f"提示词服务返回错误 ({status}): {payload.get('error', '')}")
+        captions = [tuple(caption) for caption in payload["captions"]]
+        return captions, payload.get("metrics")
+
+    def status(self):
+        status, payload = self.request("GET", "/status")
+        if status != 200:
+            raise Exception(f"提示词服务返回错误 ({status}): {payload.get('error', '')}")
+        return payload
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_service_client(url):
+    """每个服务地址共用一个客户端（及其连接池）"""
+    with _clients_lock:
+        client = _clients.get(url)
+        if client is None:
+            client = CaptionServiceClient(url)
+            _clients[url] = client
+        return client
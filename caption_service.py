@@ -0,0 +1,216 @@
+"""
+独立的提示词服务
+在一个进程中常驻一份模型，通过本机HTTP或Unix socket为多个ComfyUI实例生成提示词，
+节点只需要设置 service_url（或环境变量 QWEN_CLIP_SERVICE_URL）。
+
+接口：
+    POST /caption?model_type=...&detail_level=...  请求体为uint8图像批次 (B,H,W,3) 的 .npy 字节
+    GET  /status                                    模型常驻、预加载和批处理调度状态
+
+用法：
+    python custom_nodes/qwen-clip/caption_service.py --port 8190 --preload qwen2.5-vl-7b-instruct
+    python custom_nodes/qwen-clip/caption_service.py --socket /tmp/qwen_clip.sock
+"""
+
+import argparse
+import http.server
+import io
+import ipaddress
+import json
+import os
+import socketserver
+import sys
+import urllib.parse
+
+from standalone import import_plugin_module, load_plugin
+
+
+# Windows 上没有 UnixStreamServer，只能使用 --host/--port
+if hasattr(socketserver, "UnixStreamServer"):
+    class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    ThreadingUnixHTTPServer = None
+
+
+class CaptionService:
+    """持有模型管理器，按请求调用插件的生成流程；模型常驻在进程级模型池中"""
+
+    def __init__(self, pin_model=True, allow_custom_path=False):
+        self.node_module = import_plugin_module("qwen_clip_node")
+        self.model_manager = self.node_module.ModelManager()
+        self.pin_model = pin_model
+        self.allow_custom_path = allow_custom_path
+
+    def check_custom_path(self, custom_model_path):
+        """客户端指定的模型目录会以 trust_remote_code 加载：默认拒绝，开启后也只允许模型目录下的路径"""
+        if not custom_model_path:
+            return ""
+        if not self.allow_custom_path:
+            raise ValueError("服务未开启自定义模型路径（启动时加上 --allow-custom-model-path）")
+        models_dir = os.path.realpath(self.model_manager.models_dir)
+        path = os.path.realpath(os.path.join(models_dir, custom_model_path))
+        if os.path.commonpath([models_dir, path]) != models_dir:
+            raise ValueError(f"自定义模型路径必须位于模型目录 {models_dir} 下")
+        return path
+
+    def caption(self, body, query):
+        import numpy as np
+        metrics_module = import_plugin_module("metrics")
+
+        try:
+            frames = np.load(io.BytesIO(body), allow_pickle=False)
+        except ValueError as e:
+            raise ValueError(f"无法解析图像数据: {str(e)}")
+        if frames.ndim == 3:
+            frames = frames[None]
+        if frames.dtype != np.uint8 or frames.ndim != 4 or frames.shape[-1] != 3:
+            raise ValueError(f"图像应为uint8的 (B,H,W,3) 数组，收到 {frames.dtype} {frames.shape}")
+
+        collect_metrics = query.get("collect_metrics", "0") == "1"
+        metrics = metrics_module.start_metrics(collect_metrics)
+        params = {
+            "custom_model_path": self.check_custom_path(query.get("custom_model_path", "")),
+            "detail_level": query.get("detail_level", "detailed"),
+            "use_cache": query.get("use_cache", "1") == "1",
+            "deterministic": query.get("deterministic", "0") == "1",
+        }
+        try:
+            if "batch_size" in query:
+                params["batch_size"] = max(1, int(query["batch_size"]))
+            if "resolution" in query:
+                params["resolution"] = query["resolution"]
+            for name in ("precision", "quantization"):
+                if name in query:
+                    params[name] = query[name]
+            params["min_pixels"] = int(query.get("min_pixels", 0))
+            params["max_pixels"] = int(query.get("max_pixels", 0))
+        except ValueError as e:
+            raise ValueError(f"无效的请求参数: {str(e)}")
+        captions = self.node_module.caption_images(
+            self.model_manager, list(frames), query.get("model_type", ""),
+            pin_model=self.pin_model, metrics=metrics, **params,
+        )
+        record = None
+        if metrics.enabled:
+            metrics.set("images", len(frames))
+            record = metrics.to_dict()
+            sink = metrics_module.get_metrics_sink()
+            if sink is not None:
+                sink.write(record)
+        return {"captions": captions, "metrics": record if collect_metrics else None}
+
+    def status(self):
+        pool = import_plugin_module("model_pool").get_model_pool()
+        scheduler = import_plugin_module("batch_scheduler").get_batch_scheduler()
+        return {"models": pool.stats(), "preload": pool.preload_status(), "scheduler": scheduler.stats()}
+
+
+def make_handler(service, quiet=False):
+    class CaptionRequestHandler(http.server.BaseHTTPRequestHandler):
+        # 使用HTTP/1.1长连接，客户端的连接池可以复用连接
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if urllib.parse.urlparse(self.path).path != "/status":
+                return self._send_json(404, {"error": f"未知路径: {self.path}"})
+            self._send_json(200, service.status())
+
+        def do_POST(self):
+            parsed = urllib.parse.urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+            if parsed.path != "/caption":
+                return self._send_json(404, {"error": f"未知路径: {self.path}"})
+            query = dict(urllib.parse.parse_qsl(parsed.query))
+            try:
+                result = service.caption(body, query)
+            except ValueError as e:
+                return self._send_json(400, {"error": str(e)})
+            except Exception as e:
+                return self._send_json(500, {"error": str(e)})
+            self._send_json(200, result)
+
+        def _send_json(self, status, payload):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def address_string(self):
+            # Unix socket 的 client_address 是空字符串
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            if not quiet:
+                super().log_message(format, *args)
+
+    return CaptionRequestHandler
+
+
+def is_loopback(host):
+    """监听地址是否只允许本机访问"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def create_server(service, host="127.0.0.1", port=8190, socket_path=None, quiet=False):
+    """创建服务（不启动），socket_path 不为空时监听Unix socket"""
+    handler = make_handler(service, quiet)
+    if socket_path:
+        if ThreadingUnixHTTPServer is None:
+            raise Exception("当前平台不支持Unix socket，请使用 --host/--port")
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Qwen-CLIP 提示词服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址，默认只监听本机")
+    parser.add_argument("--port", type=int, default=8190)
+    parser.add_argument("--socket", default="", help="监听Unix socket（优先于 --host/--port）")
+    parser.add_argument("--preload", default="", help="启动时在后台加载的模型类型")
+    parser.add_argument("--no-pin", action="store_true", help="不固定模型，空闲超时后允许卸载")
+    parser.add_argument("--allow-custom-model-path", action="store_true",
+                        help="允许客户端指定模型目录下的自定义模型（只能与本机地址或Unix socket一起使用）")
+    parser.add_argument("--comfyui-root", default=None, help="ComfyUI根目录，用于共享模型目录")
+    parser.add_argument("--models-dir", default=None, help="模型目录（不在ComfyUI中运行时）")
+    parser.add_argument("--quiet", action="store_true", help="不打印请求日志")
+    args = parser.parse_args()
+
+    if args.socket and ThreadingUnixHTTPServer is None:
+        parser.error("当前平台不支持Unix socket（--socket），请使用 --host/--port")
+    if args.allow_custom_model_path and not args.socket and not is_loopback(args.host):
+        parser.error("--allow-custom-model-path 只能在监听本机地址或Unix socket时使用")
+
+    load_plugin(args.comfyui_root, args.models_dir)
+    service = CaptionService(pin_model=not args.no_pin, allow_custom_path=args.allow_custom_model_path)
+    if args.preload:
+        service.node_module.start_preload(args.preload, service.model_manager)
+
+    server = create_server(service, args.host, args.port, args.socket or None, args.quiet)
+    address = f"unix://{args.socket}" if args.socket else f"http://{args.host}:{args.port}"
+    print(f"提示词服务已启动: {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+        import_plugin_module("model_pool").get_model_pool().release_all()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
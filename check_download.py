@@ -0,0 +1,243 @@
+"""
+检查模型下载
+在本机启动一个支持Range请求的HTTP服务，用生成的测试文件检查分段并行下载、断点续传、
+SHA-256校验失败后的重新下载。全部通过时退出码为0，可以接入CI。不需要网络，也不需要torch。
+
+用法：
+    python custom_nodes/qwen-clip/check_download.py [--size-mb 24] [--keep]
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+
+from standalone import import_plugin_module, load_plugin
+
+BASE_PATH = "/Qwen/Check-Model/resolve/main/"
+
+
+class RangeServer(http.server.ThreadingHTTPServer):
+    """只读文件服务，支持单个区间的Range请求，并统计发送的字节数和Range请求数"""
+
+    daemon_threads = True
+
+    def __init__(self, root):
+        self.root = root
+        self.bytes_sent = 0
+        self.range_requests = 0
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), RangeRequestHandler)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}{BASE_PATH.rstrip('/')}"
+
+    def reset_counters(self):
+        with self.lock:
+            self.bytes_sent = 0
+            self.range_requests = 0
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _file_path(self):
+        if not self.path.startswith(BASE_PATH):
+            return None
+        path = os.path.join(self.server.root, self.path[len(BASE_PATH):])
+        return path if os.path.isfile(path) else None
+
+    def _not_found(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self._file_path()
+        if path is None:
+            return self._not_found()
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        path = self._file_path()
+        if path is None:
+            return self._not_found()
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            with self.server.lock:
+                self.server.range_requests += 1
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = f.read(min(remaining, 1024 * 1024))
+                self.wfile.write(block)
+                remaining -= len(block)
+                with self.server.lock:
+                    self.server.bytes_sent += len(block)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def sha256_of(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_safetensors(path, data_size):
+    """写一个随机内容的 safetensors 文件（单个uint8张量），头部与真实权重文件格式相同"""
+    header = json.dumps({
+        "__metadata__": {"format": "pt"},
+        "weight": {"dtype": "U8", "shape": [data_size], "data_offsets": [0, data_size]},
+    }).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+    with open(path, "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        f.write(os.urandom(data_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检查模型的分段下载、断点续传和哈希校验")
+    parser.add_argument("--size-mb", type=int, default=24, help="大文件的大小（MB）")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录，便于排查")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="qwen_clip_download_")
+    remote_dir = os.path.join(work_dir, "remote")
+    os.makedirs(remote_dir)
+    load_plugin(models_dir=os.path.join(work_dir, "models"))
+    model_manager_module = import_plugin_module("model_manager")
+    manifest_module = import_plugin_module("model_manifest")
+    # 缩小分段下限，测试文件不需要很大也能拆成多段
+    model_manager_module.DOWNLOAD_MIN_SEGMENT_SIZE = 1024 * 1024
+
+    large_name = "model-00001-of-00001.safetensors"
+    small_name = "config.json"
+    write_safetensors(os.path.join(remote_dir, large_name), args.size_mb * 1024 * 1024 + 12344)
+    with open(os.path.join(remote_dir, small_name), "w", encoding="utf-8") as f:
+        f.write('{"model_type": "check"}')
+    files = [small_name, large_name]
+    expected = {name: sha256_of(os.path.join(remote_dir, name)) for name in files}
+    large_size = os.path.getsize(os.path.join(remote_dir, large_name))
+
+    server = RangeServer(remote_dir)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    manager = model_manager_module.ModelManager(sources=[server.base_url], offline=False)
+    model_path = os.path.join(manager.models_dir, "Check-Model")
+    os.makedirs(model_path, exist_ok=True)
+    large_path = os.path.join(model_path, large_name)
+
+    failures = []
+
+    def check(name, condition, detail=""):
+        print(f"{'通过' if condition else '失败'}：{name}{'，' + detail if detail else ''}")
+        if not condition:
+            failures.append(name)
+
+    def download():
+        server.reset_counters()
+        manager._download_files(server.base_url, files, model_path)
+        print()
+
+    def files_match():
+        return all(sha256_of(os.path.join(model_path, name)) == expected[name] for name in files)
+
+    try:
+        # 1. 全新下载：大文件按Range分段并行下载，清单记录流式计算的哈希
+        download()
+        manifest = manifest_module.ModelManifest(model_path)
+        check("分段并行下载", files_match() and server.range_requests > 1,
+              f"{server.range_requests} 个Range请求")
+        check("清单记录SHA-256", all(manifest.files.get(name, {}).get("sha256") == expected[name] for name in files))
+
+        # 2. 已完整下载：不再发起下载
+        download()
+        check("跳过已下载的文件", server.bytes_sent == 0, f"发送 {server.bytes_sent} 字节")
+
+        # 3. 分段续传：模拟中断时留下的两个分段文件
+        os.remove(large_path)
+        manifest.forget(large_name)
+        manifest.save()
+        with open(os.path.join(remote_dir, large_name), "rb") as f:
+            head = f.read(large_size // 2)
+        step = -(-large_size // model_manager_module.DOWNLOAD_SEGMENTS)
+        with open(f"{large_path}.part0", "wb") as f:
+            f.write(head[:step // 2])
+        with open(f"{large_path}.part1", "wb") as f:
+            f.write(head[step:step + step // 3])
+        resumed = step // 2 + step // 3
+        download()
+        check("分段断点续传", files_match() and server.bytes_sent == large_size - resumed,
+              f"发送 {server.bytes_sent} 字节，应为 {large_size - resumed}")
+        check("分段文件已清理", not any(name.endswith((".part0", ".part1", ".tmp")) for name in os.listdir(model_path)))
+
+        # 4. 旧版下载器逐块追加写入的不完整文件：清单中没有记录，按头部声明的大小识别，作为第一段的前缀续传
+        manifest = manifest_module.ModelManifest(model_path)
+        manifest.forget(large_name)
+        manifest.save()
+        os.truncate(large_path, large_size // 3)
+        status = manifest_module.ModelManifest(model_path).check(large_name)
+        check("识别没有记录的不完整文件", status == manifest_module.FILE_INCOMPLETE, status)
+        download()
+        check("旧版不完整文件续传", files_match() and server.bytes_sent < large_size,
+              f"发送 {server.bytes_sent} 字节")
+
+        # 5. 大小不变但内容损坏：哈希校验失败后重新下载
+        with open(large_path, "r+b") as f:
+            f.seek(large_size // 2)
+            byte = f.read(1)
+            f.seek(large_size // 2)
+            f.write(bytes([byte[0] ^ 0xFF]))
+        status = manifest_module.ModelManifest(model_path).check(large_name, full=True)
+        check("检测到SHA-256不匹配", status == manifest_module.FILE_CORRUPT, status)
+        download()
+        check("损坏的文件重新下载", files_match() and server.bytes_sent == large_size,
+              f"发送 {server.bytes_sent} 字节")
+
+        # 6. 文件被截断：按清单中的大小检测并重新下载
+        os.truncate(large_path, large_size - 1000)
+        download()
+        check("截断的文件重新下载", files_match())
+    finally:
+        server.shutdown()
+        server.server_close()
+        if args.keep:
+            print(f"临时目录: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if failures:
+        print(f"失败 {len(failures)} 项: {', '.join(failures)}")
+        return 1
+    print("通过：下载检查全部通过")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+检查插件的导入耗时
+在独立的子进程中导入插件，确认注册节点时不会加载 torch / transformers / PIL / requests，
+并且导入耗时不超过预算。超出预算时以非零状态码退出，可以接入CI。
+
+用法（在ComfyUI根目录运行，或者任意目录运行）：
+    python custom_nodes/qwen-clip/check_import_time.py [--budget-ms 150] [--repeat 5]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 插件注册阶段不允许导入的重量级模块
+HEAVY_MODULES = ["torch", "transformers", "PIL", "requests", "numpy"]
+
+# 在子进程中执行：只统计插件本身的导入时间
+CHILD_SCRIPT = r"""
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.getcwd())
+try:
+    import folder_paths
+except ImportError:
+    # 不在ComfyUI中运行时，提供插件导入所需的最小 folder_paths
+    folder_paths = types.ModuleType("folder_paths")
+    folder_paths.models_dir = tempfile.mkdtemp()
+    folder_paths.get_temp_directory = tempfile.gettempdir
+    sys.modules["folder_paths"] = folder_paths
+
+plugin_dir = sys.argv[1]
+heavy_modules = json.loads(sys.argv[2])
+preloaded = [name for name in heavy_modules if name in sys.modules]
+
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location(
+    "qwen_clip_import_check", os.path.join(plugin_dir, "__init__.py"),
+    submodule_search_locations=[plugin_dir],
+)
+module = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = module
+spec.loader.exec_module(module)
+elapsed = time.perf_counter() - start
+
+print(json.dumps({
+    "elapsed_ms": elapsed * 1000,
+    "nodes": sorted(module.NODE_CLASS_MAPPINGS),
+    "heavy_loaded": [name for name in heavy_modules if name in sys.modules and name not in preloaded],
+}))
+"""
+
+
+def measure_once():
+    env = dict(os.environ)
+    # 预加载会在后台线程中导入torch，检查时关闭
+    env.pop("QWEN_CLIP_PRELOAD", None)
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD_SCRIPT, PLUGIN_DIR, json.dumps(HEAVY_MODULES)],
+        capture_output=True, text=True, env=env, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检查插件的导入耗时")
+    parser.add_argument("--budget-ms", type=float, default=150.0, help="导入耗时预算（毫秒）")
+    parser.add_argument("--repeat", type=int, default=5, help="重复测量次数，取中位数")
+    args = parser.parse_args()
+
+    results = [measure_once() for _ in range(max(1, args.repeat))]
+    timings = sorted(result["elapsed_ms"] for result in results)
+    median = timings[len(timings) // 2]
+    heavy_loaded = sorted({name for result in results for name in result["heavy_loaded"]})
+
+    print(f"注册的节点: {', '.join(results[0]['nodes'])}")
+    print(f"导入耗时: 中位数 {median:.1f} ms，最小 {timings[0]:.1f} ms，最大 {timings[-1]:.1f} ms")
+
+    failed = False
+    if heavy_loaded:
+        print(f"失败：插件导入时加载了重量级模块: {', '.join(heavy_loaded)}")
+        failed = True
+    if median > args.budget_ms:
+        print(f"失败：导入耗时 {median:.1f} ms 超出预算 {args.budget_ms:.1f} ms")
+        failed = True
+    if not failed:
+        print(f"通过：导入耗时在预算 {args.budget_ms:.1f} ms 以内")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+运行时配置
+所有配置项都可以通过环境变量覆盖
+"""
+
+import os
+
+
+def env_str(name, default=None):
+    """读取字符串配置，空字符串视为未设置"""
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip()
+
+
+def env_int(name, default):
+    """读取整数配置"""
+    value = env_str(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"警告：环境变量 {name}={value} 不是有效整数，使用默认值 {default}")
+        return default
+
+
+def env_float(name, default):
+    """读取浮点数配置"""
+    value = env_str(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"警告：环境变量 {name}={value} 不是有效数字，使用默认值 {default}")
+        return default
+
+
+def env_bool(name, default=False):
+    """读取布尔配置（1/true/yes/on 视为真）"""
+    value = env_str(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
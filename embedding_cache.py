@@ -0,0 +1,172 @@
+"""
+视觉编码器特征缓存
+同一张图像换用不同的提示词或 detail_level 再次生成时，视觉编码器的输出完全相同。
+以预处理后的像素（已包含缩放和归一化设置）+ 网格尺寸 + 模型作为键缓存每张图像的视觉特征，
+内存LRU层按字节数限制容量，可选的磁盘层以 .npy 保存并通过内存映射读取。
+"""
+
+import hashlib
+import inspect
+import os
+import threading
+
+import numpy as np
+import torch
+
+from .caption_cache import DEFAULT_CACHE_DIR, DiskCache, LRUCache
+from .config import env_bool, env_int
+
+# 是否缓存视觉特征
+EMBEDDING_CACHE = env_bool("QWEN_CLIP_EMBED_CACHE", True)
+# 内存层容量(MB)
+DEFAULT_MEMORY_MB = env_int("QWEN_CLIP_EMBED_CACHE_MEMORY_MB", 512)
+# 磁盘层容量(MB)，0表示不使用磁盘层
+DEFAULT_DISK_MB = env_int("QWEN_CLIP_EMBED_CACHE_DISK_MB", 0)
+
+# numpy 不支持的类型按相同字节宽度的整数保存
+_STORAGE_DTYPES = {torch.bfloat16: torch.int16}
+
+
+def tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_memory_mb=DEFAULT_MEMORY_MB, max_disk_mb=DEFAULT_DISK_MB):
+        self.memory = LRUCache(max_bytes=max_memory_mb * 1024 * 1024, sizeof=tensor_bytes)
+        self.disk = DiskCache(os.path.join(cache_dir, "embeddings"), max_disk_mb * 1024 * 1024, suffix=".npy")
+
+    @staticmethod
+    def make_key(pixel_values, grid_thw, model_id):
+        """预处理后的像素 + 网格尺寸 + 模型"""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{model_id}|{tuple(grid_thw)}|{pixel_values.dtype}|{tuple(pixel_values.shape)}".encode("utf-8"))
+        data = pixel_values.detach().cpu().contiguous()
+        digest.update(memoryview(data.view(torch.uint8).numpy()))
+        return digest.hexdigest()
+
+    def get(self, key, dtype, device):
+        # 内存层保存在CPU上，使用GPU时不额外占用显存
+        embeds = self.memory.get(key)
+        if embeds is not None:
+            return embeds.to(device=device, dtype=dtype)
+        if not self.disk.enabled:
+            return None
+        try:
+            # 写时复制的内存映射：按需读取，不额外占用内存
+            array = np.load(self.disk.path_for(key), mmap_mode="c", allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        embeds = torch.from_numpy(array)
+        if dtype in _STORAGE_DTYPES:
+            embeds = embeds.view(dtype)
+        embeds = embeds.to(dtype=dtype)
+        self.disk.touch(key)
+        self.memory.put(key, embeds)
+        return embeds.to(device=device)
+
+    def put(self, key, embeds):
+        embeds = embeds.detach().cpu()
+        self.memory.put(key, embeds)
+        if not self.disk.enabled:
+            return
+        try:
+            data = embeds.contiguous()
+            if data.dtype in _STORAGE_DTYPES:
+                data = data.view(_STORAGE_DTYPES[data.dtype])
+            temp_path = self.disk.temp_path_for(key)
+            with open(temp_path, "wb") as f:
+                np.save(f, data.numpy(), allow_pickle=False)
+            self.disk.commit(key, temp_path)
+        except OSError as e:
+            print(f"警告：写入视觉特征缓存失败: {str(e)}")
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+
+class CachedVisualForward:
+    """替换视觉编码器的 forward：按图像拆分，只对未命中的图像运行原始 forward"""
+
+    def __init__(self, visual, cache, model_id):
+        self.visual = visual
+        self.original = visual.forward
+        self.cache = cache
+        self.model_id = model_id
+        self.merge_size = getattr(visual, "spatial_merge_size", 2)
+        # 新版 transformers 的视觉编码器返回 BaseModelOutputWithPooling，旧版直接返回张量；
+        # 全部命中时没有调用过原始 forward，按签名的返回类型判断
+        try:
+            annotation = str(inspect.signature(type(visual).forward).return_annotation)
+        except (TypeError, ValueError):
+            annotation = ""
+        self.returns_tensor = "ModelOutput" not in annotation and "Pooling" not in annotation
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, pixel_values, grid_thw=None, **kwargs):
+        # 需要中间层输出或传入了整批的预计算参数时不走缓存
+        if grid_thw is None or any(key != "return_dict" for key in kwargs):
+            return self.original(pixel_values, grid_thw=grid_thw, **kwargs)
+
+        rows = grid_thw.prod(-1).tolist()
+        chunks = pixel_values.split(rows)
+        keys = [self.cache.make_key(chunk, thw.tolist(), self.model_id) for chunk, thw in zip(chunks, grid_thw)]
+        embeds = [self.cache.get(key, self.visual.dtype, self.visual.device) for key in keys]
+        missing = [i for i, value in enumerate(embeds) if value is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        output = None
+        if missing:
+            output = self.original(
+                torch.cat([chunks[i] for i in missing]) if len(missing) < len(chunks) else pixel_values,
+                grid_thw=grid_thw[missing] if len(missing) < len(chunks) else grid_thw,
+                **kwargs,
+            )
+            self.returns_tensor = isinstance(output, torch.Tensor)
+            computed = output if self.returns_tensor else output.pooler_output
+            tokens = [rows[i] // (self.merge_size ** 2) for i in missing]
+            for i, part in zip(missing, computed.split(tokens)):
+                # 单独保存每张图像的特征，缓存不会让整批输出一直留在内存中
+                if len(missing) > 1:
+                    part = part.clone()
+                self.cache.put(keys[i], part)
+                embeds[i] = part
+            if len(missing) == len(chunks):
+                return output
+
+        merged = torch.cat(embeds)
+        if self.returns_tensor:
+            return merged
+        if output is None:
+            from transformers.modeling_outputs import BaseModelOutputWithPooling
+            return BaseModelOutputWithPooling(last_hidden_state=None, pooler_output=merged)
+        # 部分命中时，逐patch的隐藏状态只覆盖未命中的图像，不再返回
+        output.last_hidden_state = None
+        output.pooler_output = merged
+        return output
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def attach_embedding_cache(visual, model_id, cache=None):
+    """为视觉编码器启用特征缓存，返回包装后的 forward"""
+    cached_forward = CachedVisualForward(visual, cache or get_embedding_cache(), model_id)
+    visual.forward = cached_forward
+    return cached_forward
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """获取进程级共享的视觉特征缓存"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
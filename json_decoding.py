@@ -0,0 +1,161 @@
+"""
+JSON约束解码
+回答以固定的 {"中文提示词": " 开头（作为提示词的一部分，不需要生成），解码过程中逐token跟踪JSON结构：
+中文提示词结束后直接填入 , "英文提示词": "，英文提示词结束（或对象闭合）时立即停止该样本的生成，
+对象闭合之前不允许生成结束符。
+"""
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+from .prompts import JSON_RESPONSE_PREFIX, JSON_SECOND_FIELD
+
+# 键和值依次闭合：中文键、中文值、英文键、英文值
+_FIRST_VALUE_CLOSED = 2
+_SECOND_VALUE_CLOSED = 4
+
+
+class _JsonRowState:
+    """单个样本的JSON扫描状态"""
+
+    def __init__(self):
+        self.started = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.closed_strings = 0
+        self.done = False
+        # 中文值闭合后，同一个token中已经生成的后续字符
+        self.tail = None
+
+    def feed(self, text):
+        """扫描新生成的文本；返回中文值是否在这段文本中闭合"""
+        first_value_closed = False
+        for ch in text:
+            if self.done:
+                break
+            if self.tail is not None:
+                self.tail += ch
+            if not self.started:
+                if ch == "{":
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    self.closed_strings += 1
+                    if self.closed_strings == _FIRST_VALUE_CLOSED:
+                        first_value_closed = True
+                        self.tail = ""
+                    elif self.closed_strings >= _SECOND_VALUE_CLOSED:
+                        self.done = True
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+        return first_value_closed
+
+
+class JsonCaptionConstraint:
+    """一批样本共用的约束状态，由 LogitsProcessor 和 StoppingCriteria 共同驱动"""
+
+    def __init__(self, tokenizer, prompt_length, batch_size, eos_token_ids, forced_prefix=True):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.eos_token_ids = sorted(set(eos_token_ids))
+        # 只有强制了开头时才能保证对象以双引号JSON开始，此时才屏蔽结束符
+        self.suppress_eos = forced_prefix
+        self.rows = [_JsonRowState() for _ in range(batch_size)]
+        self.pending = [[] for _ in range(batch_size)]
+        self.forced_tokens = 0
+        self._seen = prompt_length
+        self._token_text = {}
+        self._special_ids = set(getattr(tokenizer, "all_special_ids", []) or [])
+        if forced_prefix:
+            for row in self.rows:
+                row.feed(JSON_RESPONSE_PREFIX)
+
+    def _text(self, token_id):
+        text = self._token_text.get(token_id)
+        if text is None:
+            text = "" if token_id in self._special_ids else self.tokenizer.decode([token_id])
+            self._token_text[token_id] = text
+        return text
+
+    def update(self, input_ids):
+        """处理上次调用之后新增的token"""
+        length = input_ids.shape[1]
+        if length <= self._seen:
+            return
+        new_tokens = input_ids[:, self._seen:length].tolist()
+        self._seen = length
+        for index, tokens in enumerate(new_tokens):
+            row = self.rows[index]
+            for token_id in tokens:
+                if row.done:
+                    break
+                if row.feed(self._text(token_id)):
+                    self._schedule_second_field(index)
+
+    def _schedule_second_field(self, index):
+        """中文值刚闭合：把英文键的剩余部分作为强制token"""
+        row = self.rows[index]
+        tail = row.tail or ""
+        row.tail = None
+        # 同一个token中已生成的字符与期望的格式不一致时不再强制，交给模型自由生成
+        if not JSON_SECOND_FIELD.startswith(tail) or len(tail) == len(JSON_SECOND_FIELD):
+            return
+        self.pending[index] = self.tokenizer.encode(JSON_SECOND_FIELD[len(tail):], add_special_tokens=False)
+
+    def process(self, input_ids, scores):
+        self.update(input_ids)
+        for index, row in enumerate(self.rows):
+            if row.done:
+                continue
+            if self.pending[index]:
+                token_id = self.pending[index].pop(0)
+                forced = torch.full_like(scores[index], float("-inf"))
+                forced[token_id] = 0
+                scores[index] = forced
+                self.forced_tokens += 1
+            elif self.suppress_eos and self.eos_token_ids:
+                allowed = torch.isfinite(scores[index])
+                allowed[self.eos_token_ids] = False
+                # 只剩结束符可选时保留，避免整行都是 -inf
+                if bool(allowed.any()):
+                    scores[index, self.eos_token_ids] = float("-inf")
+        return scores
+
+    def finished(self, input_ids):
+        self.update(input_ids)
+        return torch.tensor([row.done for row in self.rows], dtype=torch.bool, device=input_ids.device)
+
+    def early_stops(self):
+        return [row.done for row in self.rows]
+
+
+class JsonCaptionLogitsProcessor(LogitsProcessor):
+    def __init__(self, constraint):
+        self.constraint = constraint
+
+    def __call__(self, input_ids, scores):
+        return self.constraint.process(input_ids, scores)
+
+
+class JsonCaptionStoppingCriteria(StoppingCriteria):
+    """JSON对象完整后立即停止对应样本"""
+
+    def __init__(self, constraint):
+        self.constraint = constraint
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.constraint.finished(input_ids)
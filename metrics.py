@@ -0,0 +1,271 @@
+"""
+分阶段耗时与资源统计
+未启用时使用 NULL_METRICS，各个埋点只是返回一个共享的空上下文，几乎没有开销。
+启用后记录每个阶段的耗时、生成的token数、tokens/s 和峰值内存，
+可以作为节点输出，也可以按 JSONL 或 Prometheus 文本格式写入文件。
+"""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+from .config import env_str
+
+# 指标文件路径，.prom 结尾时写Prometheus文本格式（覆盖写入累计值），否则按JSONL追加
+METRICS_PATH = env_str("QWEN_CLIP_METRICS_PATH")
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class _NullMetrics:
+    """禁用状态：所有埋点都是空操作"""
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_CONTEXT
+
+    def time_module(self, module, name):
+        return _NULL_CONTEXT
+
+    def add(self, name, value):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def add_stage(self, name, seconds):
+        pass
+
+    def merge(self, other):
+        pass
+
+
+NULL_METRICS = _NullMetrics()
+
+
+class CaptionMetrics:
+    """一次调用的分阶段统计"""
+    enabled = True
+
+    def __init__(self, reset_peak=True):
+        self.stages = {}
+        self.counters = {}
+        self.values = {}
+        self._started = time.perf_counter()
+        if reset_peak:
+            reset_peak_memory()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def time_module(self, module, name):
+        """通过forward钩子统计子模块（例如视觉编码器）的耗时，只在统计期间注册"""
+        if module is None:
+            yield
+            return
+        starts = []
+
+        def pre_hook(*_):
+            starts.append(time.perf_counter())
+
+        def post_hook(*_):
+            if starts:
+                self.add_stage(name, time.perf_counter() - starts.pop())
+
+        handles = [module.register_forward_pre_hook(pre_hook), module.register_forward_hook(post_hook)]
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def add(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def merge(self, other):
+        """合并另一份统计（例如调用方所在批次的统计）的阶段耗时和计数"""
+        if other is None:
+            return
+        for name, seconds in other.stages.items():
+            self.add_stage(name, seconds)
+        for name, value in other.counters.items():
+            self.add(name, value)
+        self.values.update(other.values)
+
+    def to_dict(self):
+        stages = dict(self.stages)
+        # generate 阶段包含视觉编码器，拆出纯解码耗时
+        if "generate" in stages:
+            stages["decode"] = max(0.0, stages["generate"] - stages.get("vision_encoder", 0.0))
+        tokens = self.counters.get("generated_tokens", 0)
+        generate_seconds = stages.get("generate", 0.0)
+        result = {
+            "total_seconds": time.perf_counter() - self._started,
+            "stages": {name: round(seconds, 6) for name, seconds in stages.items()},
+            "generated_tokens": tokens,
+            "tokens_per_second": tokens / generate_seconds if generate_seconds > 0 else 0.0,
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+        peak_cuda = _peak_cuda_bytes()
+        if peak_cuda is not None:
+            result["peak_cuda_bytes"] = peak_cuda
+        result.update({name: value for name, value in self.counters.items() if name != "generated_tokens"})
+        result.update(self.values)
+        return result
+
+
+def peak_rss_bytes():
+    """峰值RSS；Linux上优先读取可重置的 VmHWM"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        # Windows 没有 resource 模块：安装了 psutil 时读取峰值工作集，否则返回0
+        memory_info = _psutil_memory_info()
+        return getattr(memory_info, "peak_wset", 0) if memory_info is not None else 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def current_rss_bytes():
+    """当前RSS，不支持时返回峰值"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    memory_info = _psutil_memory_info()
+    return memory_info.rss if memory_info is not None else peak_rss_bytes()
+
+
+def _psutil_memory_info():
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info()
+
+
+def reset_peak_memory():
+    """尽量重置峰值内存统计，使峰值反映本次调用"""
+    try:
+        # 写入5会重置 VmHWM（Linux）
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def _peak_cuda_bytes():
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return torch.cuda.max_memory_allocated()
+
+
+class MetricsSink:
+    """把每次调用的统计写入 JSONL，或以Prometheus文本格式写入累计值"""
+
+    def __init__(self, path):
+        self.path = path
+        self.prometheus = path.endswith(".prom")
+        self._totals = {"calls": 0, "images": 0, "generated_tokens": 0, "stages": {}}
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        with self._lock:
+            try:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                if self.prometheus:
+                    self._accumulate(record)
+                    self._write_prometheus()
+                else:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"警告：写入指标文件失败: {str(e)}")
+
+    def _accumulate(self, record):
+        self._totals["calls"] += 1
+        self._totals["images"] += record.get("images", 0)
+        self._totals["generated_tokens"] += record.get("generated_tokens", 0)
+        for name, seconds in record.get("stages", {}).items():
+            self._totals["stages"][name] = self._totals["stages"].get(name, 0.0) + seconds
+        self._last = record
+
+    def _write_prometheus(self):
+        lines = [
+            "# HELP qwen_clip_calls_total Caption calls.",
+            "# TYPE qwen_clip_calls_total counter",
+            f"qwen_clip_calls_total {self._totals['calls']}",
+            "# HELP qwen_clip_images_total Images captioned.",
+            "# TYPE qwen_clip_images_total counter",
+            f"qwen_clip_images_total {self._totals['images']}",
+            "# HELP qwen_clip_generated_tokens_total Generated tokens.",
+            "# TYPE qwen_clip_generated_tokens_total counter",
+            f"qwen_clip_generated_tokens_total {self._totals['generated_tokens']}",
+            "# HELP qwen_clip_stage_seconds_total Wall time spent per stage.",
+            "# TYPE qwen_clip_stage_seconds_total counter",
+        ]
+        for name, seconds in sorted(self._totals["stages"].items()):
+            lines.append(f'qwen_clip_stage_seconds_total{{stage="{name}"}} {seconds:.6f}')
+        lines += [
+            "# HELP qwen_clip_last_tokens_per_second Decode throughput of the last call.",
+            "# TYPE qwen_clip_last_tokens_per_second gauge",
+            f"qwen_clip_last_tokens_per_second {self._last.get('tokens_per_second', 0.0):.3f}",
+            "# HELP qwen_clip_last_peak_rss_bytes Peak RSS during the last call.",
+            "# TYPE qwen_clip_last_peak_rss_bytes gauge",
+            f"qwen_clip_last_peak_rss_bytes {self._last.get('peak_rss_bytes', 0)}",
+        ]
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.path)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_metrics_sink():
+    """返回配置的指标输出，未配置 QWEN_CLIP_METRICS_PATH 时返回None"""
+    global _sink
+    if not METRICS_PATH:
+        return None
+    with _sink_lock:
+        if _sink is None:
+            _sink = MetricsSink(METRICS_PATH)
+        return _sink
+
+
+def start_metrics(enabled):
+    """需要统计（节点要求输出或配置了指标文件）时返回 CaptionMetrics，否则返回 NULL_METRICS"""
+    if enabled or METRICS_PATH:
+        return CaptionMetrics()
+    return NULL_METRICS
@@ -0,0 +1,246 @@
+"""
+内存映射的分片加载
+按 model.safetensors.index.json 逐个分片映射到内存：与目标精度一致的权重直接引用映射的文件页（不复制，
+多个进程加载同一模型时共用页缓存，内存紧张时由系统换出），需要转换精度的权重才复制到内存中。
+先在meta设备上创建空模型，再按分片填入权重，加载过程中不会同时存在两份完整的权重。
+有GPU时按内存预算推断设备映射，超出预算的层留在内存映射中，不再复制到 offload 目录。
+"""
+
+import json
+import mmap
+import os
+import re
+import time
+
+import torch
+
+from .config import env_float
+from .metrics import current_rss_bytes, peak_rss_bytes, reset_peak_memory
+
+# 加载时的内存预算(GB)：CPU上限制需要复制（转换精度）的权重大小，有GPU时作为设备映射中CPU的容量；0表示不限制
+DEFAULT_MAX_MEMORY_GB = env_float("QWEN_CLIP_MAX_MEMORY_GB", 0.0)
+
+INDEX_NAME = "model.safetensors.index.json"
+SINGLE_NAME = "model.safetensors"
+
+_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+class MemoryBudgetExceeded(Exception):
+    """加载需要的内存超出预算；不能退回 from_pretrained，否则预算不起作用"""
+
+
+def shard_files(model_path):
+    """按索引文件列出权重分片；没有索引时使用单个 model.safetensors，都没有时返回空列表"""
+    index_path = os.path.join(model_path, INDEX_NAME)
+    if os.path.isfile(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        # 保持索引中的顺序，去重
+        return [os.path.join(model_path, name) for name in dict.fromkeys(weight_map.values())]
+    single_path = os.path.join(model_path, SINGLE_NAME)
+    return [single_path] if os.path.isfile(single_path) else []
+
+
+class SafetensorsShard:
+    """只解析 safetensors 头部，张量直接由写时复制的内存映射构造"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header_size = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_size))
+            # 私有映射：张量可写但不会写回文件，未修改的页与页缓存共用
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.metadata = header.pop("__metadata__", None) or {}
+        self.header = header
+        self.data_offset = 8 + header_size
+
+    def keys(self):
+        return list(self.header)
+
+    def nbytes(self, key):
+        begin, end = self.header[key]["data_offsets"]
+        return end - begin
+
+    def dtype(self, key):
+        dtype = _DTYPES.get(self.header[key]["dtype"])
+        if dtype is None:
+            raise Exception(f"不支持的权重类型 {self.header[key]['dtype']}: {key}")
+        return dtype
+
+    def tensor(self, key):
+        info = self.header[key]
+        dtype = self.dtype(key)
+        shape = info["shape"]
+        begin, end = info["data_offsets"]
+        if end == begin:
+            return torch.empty(shape, dtype=dtype)
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        return torch.frombuffer(self.mmap, dtype=dtype, count=count, offset=self.data_offset + begin).view(shape)
+
+    def release(self, key):
+        """权重已经复制（转换精度）后，丢弃对应的映射页，避免源数据和副本同时计入RSS"""
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        begin, end = self.header[key]["data_offsets"]
+        # 只丢弃完全落在该权重内部的页，相邻的权重可能仍在直接引用映射
+        start = -(-(self.data_offset + begin) // mmap.PAGESIZE) * mmap.PAGESIZE
+        stop = (self.data_offset + end) // mmap.PAGESIZE * mmap.PAGESIZE
+        if stop > start:
+            self.mmap.madvise(mmap.MADV_DONTNEED, start, stop - start)
+
+
+def checkpoint_key_renames(model):
+    """checkpoint中的权重名 -> 模型中的名称：新版 transformers 的 Qwen2.5-VL 把语言模型移到了 model.language_model 下"""
+    # 旧版 transformers 在模型类上声明重命名规则
+    renames = list((getattr(model, "_checkpoint_conversion_mapping", None) or {}).items())
+    try:
+        from transformers.conversion_mapping import get_checkpoint_conversion_mapping
+    except ImportError:
+        return renames
+    conversions = get_checkpoint_conversion_mapping(type(model).__name__)
+    if conversions is None:
+        conversions = get_checkpoint_conversion_mapping(model.config.model_type) or []
+    for conversion in conversions:
+        # 只支持纯重命名；需要合并/拆分权重的模型交给 from_pretrained
+        if type(conversion).__name__ != "WeightRenaming":
+            raise Exception(f"内存映射加载不支持权重转换: {type(conversion).__name__}")
+        renames.extend(zip(conversion.source_patterns, conversion.target_patterns))
+    return renames
+
+
+def _rename(key, renames, model_keys):
+    if key in model_keys:
+        return key
+    for source, target in renames:
+        key = re.sub(source, target, key)
+    return key
+
+
+def _infer_device_map(model, torch_dtype, device_map, max_memory_gb):
+    """有GPU时按预算推断设备映射（disk 表示留在内存映射中），CPU推理时返回None"""
+    if device_map == "cpu" or not torch.cuda.is_available():
+        return None
+    if isinstance(device_map, dict):
+        return device_map
+    from accelerate import infer_auto_device_map
+    from accelerate.utils import get_max_memory
+
+    max_memory = get_max_memory()
+    if max_memory_gb > 0:
+        max_memory["cpu"] = int(max_memory_gb * 1024 ** 3)
+    placement = infer_auto_device_map(
+        model, max_memory=max_memory, dtype=torch_dtype,
+        no_split_module_classes=getattr(model, "_no_split_modules", None) or [],
+    )
+    # 放不下的层不写入 offload 目录，直接使用内存映射的权重
+    return {name: "cpu" if device == "disk" else device for name, device in placement.items()}
+
+
+def _device_for(name, device_map):
+    if device_map is None:
+        return "cpu"
+    # 取最长的匹配前缀
+    while True:
+        if name in device_map:
+            return device_map[name]
+        if "." not in name:
+            return device_map.get("", "cpu")
+        name = name.rsplit(".", 1)[0]
+
+
+def _set_tensor(model, name, tensor):
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    if attr in module._parameters:
+        module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[attr] = tensor
+
+
+def load_model_mmap(model_class, model_path, torch_dtype, device_map="cpu", max_memory_gb=DEFAULT_MAX_MEMORY_GB):
+    """逐分片加载模型，返回 (模型, 加载统计)；模型不是 safetensors 格式或结构不支持时抛出异常"""
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, GenerationConfig
+
+    shards = shard_files(model_path)
+    if not shards:
+        raise Exception("模型目录中没有 safetensors 权重")
+
+    start = time.perf_counter()
+    reset_peak_memory()
+    rss_before = current_rss_bytes()
+
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=True, local_files_only=True)
+    with init_empty_weights():
+        model = model_class.from_config(config, torch_dtype=torch_dtype, trust_remote_code=True)
+    model_keys = set(model.state_dict())
+    renames = checkpoint_key_renames(model)
+    placement = _infer_device_map(model, torch_dtype, device_map, max_memory_gb)
+
+    # 先只读头部：检查权重名，并估算需要复制到内存中的大小
+    opened = [SafetensorsShard(path) for path in shards]
+    copied_bytes = 0
+    for shard in opened:
+        for key in shard.keys():
+            name = _rename(key, renames, model_keys)
+            if name not in model_keys:
+                continue
+            if shard.dtype(key).is_floating_point and shard.dtype(key) != torch_dtype \
+                    and _device_for(name, placement) == "cpu":
+                copied_bytes += shard.nbytes(key) // shard.dtype(key).itemsize * torch_dtype.itemsize
+    if placement is None and max_memory_gb > 0 and copied_bytes > max_memory_gb * 1024 ** 3:
+        raise MemoryBudgetExceeded(
+            f"需要转换精度的权重为 {copied_bytes / 1024 ** 3:.1f} GB，超出内存预算 {max_memory_gb} GB；"
+            f"请使用与权重文件一致的精度"
+        )
+
+    mapped_bytes = 0
+    materialized_bytes = 0
+    for shard in opened:
+        for key in shard.keys():
+            name = _rename(key, renames, model_keys)
+            if name not in model_keys:
+                print(f"警告：忽略模型中不存在的权重: {key}")
+                continue
+            tensor = shard.tensor(key)
+            device = _device_for(name, placement)
+            target_dtype = torch_dtype if tensor.is_floating_point() else tensor.dtype
+            if device == "cpu" and tensor.dtype == target_dtype:
+                mapped_bytes += tensor.numel() * tensor.element_size()
+            else:
+                tensor = tensor.to(device=device, dtype=target_dtype)
+                shard.release(key)
+                if device == "cpu":
+                    materialized_bytes += tensor.numel() * tensor.element_size()
+            _set_tensor(model, name, tensor)
+
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    if missing:
+        raise Exception(f"权重文件缺少 {len(missing)} 个参数，例如: {', '.join(missing[:3])}")
+    # 非持久化的缓冲区（如旋转位置编码）在创建时已经计算好，只需要放到对应设备上
+    if placement is not None:
+        from accelerate import dispatch_model
+        model = dispatch_model(model, device_map=placement)
+
+    generation_config_path = os.path.join(model_path, "generation_config.json")
+    if os.path.isfile(generation_config_path):
+        model.generation_config = GenerationConfig.from_pretrained(model_path, local_files_only=True)
+
+    stats = {
+        "loader": "mmap",
+        "shards": len(shards),
+        "seconds": round(time.perf_counter() - start, 3),
+        "mapped_bytes": mapped_bytes,
+        "materialized_bytes": materialized_bytes,
+        "rss_delta_bytes": current_rss_bytes() - rss_before,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "peak_rss_delta_bytes": peak_rss_bytes() - rss_before,
+    }
+    return model.eval(), stats
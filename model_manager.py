@@ -1,12 +1,122 @@
+import hashlib
+import json
 import os
-import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import folder_paths
+from .config import env_bool, env_int, env_str
+from .model_manifest import FILE_CORRUPT, FILE_INCOMPLETE, FILE_MISSING, FILE_OK, ModelManifest, hash_file
+
+# 可用的下载源名称
+SOURCE_HOSTS = {
+    "huggingface": "https://huggingface.co",
+    "hf-mirror": "https://hf-mirror.com",
+}
+# 模型来源的回退链，按顺序尝试：
+#   local       - models/clip 下已存在的模型
+#   huggingface / hf-mirror / http(s)://... - 下载到本地后加载
+#   hub         - 本地加载失败时允许 transformers 直接从Hub加载
+MODEL_SOURCES = [
+    source.strip()
+    for source in env_str("QWEN_CLIP_SOURCES", "local,huggingface,hf-mirror").split(",")
+    if source.strip()
+]
+# 严格离线模式：不发起任何网络请求，本地没有可用模型时立即报错
+OFFLINE = (
+    env_bool("QWEN_CLIP_OFFLINE", False)
+    or env_bool("HF_HUB_OFFLINE", False)
+    or env_bool("TRANSFORMERS_OFFLINE", False)
+)
+# models/clip 下可用模型目录的索引文件
+INDEX_NAME = ".qwen_clip_index.json"
+# 同时下载的文件数
+DOWNLOAD_WORKERS = env_int("QWEN_CLIP_DOWNLOAD_WORKERS", 3)
+# 每个大文件拆分的并行分段数
+DOWNLOAD_SEGMENTS = env_int("QWEN_CLIP_DOWNLOAD_SEGMENTS", 4)
+# 小于该大小的分段不再拆分
+DOWNLOAD_MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+# 启动时是否对模型文件做完整的SHA-256校验（默认只比较大小和修改时间）
+VERIFY_ON_START = env_bool("QWEN_CLIP_VERIFY_MODELS", False)
+# 读写缓冲区大小
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def inspect_model_dir(model_path):
+    """检查目录是否是可加载的模型，返回 (是否可用, 原因)"""
+    if not os.path.isdir(model_path):
+        return False, "目录不存在"
+    if not os.path.isfile(os.path.join(model_path, "config.json")):
+        return False, "缺少 config.json"
+    if not any(
+        os.path.isfile(os.path.join(model_path, name))
+        for name in ("tokenizer_config.json", "tokenizer.json")
+    ):
+        return False, "缺少分词器文件"
+    
+    index_path = os.path.join(model_path, "model.safetensors.index.json")
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                shards = set(json.load(f)["weight_map"].values())
+        except (OSError, ValueError, KeyError) as e:
+            return False, f"权重索引文件无法解析: {str(e)}"
+        missing = sorted(name for name in shards if not os.path.isfile(os.path.join(model_path, name)))
+        if missing:
+            return False, f"缺少权重文件: {', '.join(missing)}"
+        return True, "ok"
+    
+    if not any(name.endswith((".safetensors", ".bin")) for name in os.listdir(model_path)):
+        return False, "缺少权重文件"
+    return True, "ok"
+
+
+class DownloadProgress:
+    """线程安全的下载进度汇总，限制打印频率"""
+    
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.total = 0
+        self.downloaded = 0
+        self._started = time.monotonic()
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+    
+    def add_total(self, size):
+        with self._lock:
+            self.total += max(0, size)
+    
+    def advance(self, size):
+        with self._lock:
+            self.downloaded += size
+            now = time.monotonic()
+            if now - self._last_report < self.interval:
+                return
+            self._last_report = now
+            self._report(now)
+    
+    def finish(self):
+        with self._lock:
+            self._report(time.monotonic())
+        print()  # 新行
+    
+    def _report(self, now):
+        speed = self.downloaded / max(now - self._started, 1e-6) / 1024 / 1024
+        if self.total > 0:
+            progress = min(self.downloaded / self.total * 100, 100.0)
+            print(f"下载进度: {progress:.1f}% ({self.downloaded}/{self.total} bytes, {speed:.1f} MB/s)", end='\r')
+        else:
+            print(f"已下载: {self.downloaded} bytes ({speed:.1f} MB/s)", end='\r')
+
 
 class ModelManager:
-    def __init__(self):
+    def __init__(self, sources=None, offline=None):
         self.models_dir = os.path.join(folder_paths.models_dir, "clip")
         self.ensure_models_dir()
+        self.sources = list(sources) if sources is not None else list(MODEL_SOURCES)
+        self.offline = OFFLINE if offline is None else offline
+        self._index = None
         
         # 模型配置
         self.model_configs = {
@@ -14,6 +124,8 @@ class ModelManager:
                 "name": "Qwen2.5-VL-7B-Instruct",
                 "url": "https://huggingface.co/Qwen/Qwen2.5-VL-7B-Instruct",
                 "files": ["config.json", "tokenizer_config.json", "model.safetensors.index.json"] + [f"model-0000{i}-of-00005.safetensors" for i in range(1, 6)]
+                + ["generation_config.json", "preprocessor_config.json", "chat_template.json",
+                   "tokenizer.json", "vocab.json", "merges.txt"]
             }
         }
     
@@ -22,19 +134,146 @@ class ModelManager:
         if not os.path.exists(self.models_dir):
             os.makedirs(self.models_dir)
     
+    @property
+    def download_hosts(self):
+        """回退链中的下载源，严格离线模式下为空"""
+        if self.offline:
+            return []
+        hosts = []
+        for source in self.sources:
+            if source in SOURCE_HOSTS:
+                hosts.append(SOURCE_HOSTS[source])
+            elif source.startswith(("http://", "https://")):
+                hosts.append(source.rstrip("/"))
+        return hosts
+    
+    @property
+    def allow_hub_load(self):
+        """是否允许本地加载失败后由 transformers 直接从Hub加载"""
+        return "hub" in self.sources and not self.offline
+    
+    def resolve_model(self, model_type, custom_model_path=""):
+        """按回退链解析模型路径
+
+        本地模型优先；严格离线模式或回退链中没有下载源时，直接抛出本地的真实错误，
+        不会在网络请求上等待超时。
+        """
+        if model_type == "custom":
+            if not custom_model_path:
+                raise ValueError("选择 custom 模型类型时必须提供 custom_model_path")
+            usable, reason = inspect_model_dir(custom_model_path)
+            if not usable and not self.allow_hub_load:
+                raise Exception(f"自定义模型不可用: {custom_model_path} ({reason})")
+            return custom_model_path
+        
+        if model_type not in self.model_configs:
+            raise ValueError(f"不支持的模型类型: {model_type}")
+        
+        local_error = "回退链中没有 local"
+        if "local" in self.sources:
+            model_path = self.get_model_path(model_type)
+            if model_path:
+                return model_path
+            local_error = self.local_model_error(model_type)
+        
+        if not self.download_hosts:
+            mode = "严格离线模式下" if self.offline else "回退链中没有可用的下载源，"
+            raise Exception(f"{mode}找不到可用的本地模型: {local_error}")
+        print(f"本地模型不可用（{local_error}），按回退链下载")
+        return self.download_model(model_type)
+    
     def get_model_path(self, model_type):
-        """获取模型路径"""
+        """获取模型路径，模型文件缺失或损坏时返回None"""
         if model_type in self.model_configs:
             model_name = self.model_configs[model_type]["name"]
             model_path = os.path.join(self.models_dir, model_name)
-            if os.path.exists(model_path):
-                return model_path
+            usable, _ = self.lookup_local_model(model_name)
+            if usable:
+                bad_files = self.verify_model(model_type, full=VERIFY_ON_START)
+                if not bad_files:
+                    return model_path
+                print(f"模型文件不完整或已损坏: {', '.join(bad_files)}")
         return None
     
+    def local_model_error(self, model_type):
+        """说明本地模型为什么不可用"""
+        model_name = self.model_configs[model_type]["name"]
+        usable, reason = self.lookup_local_model(model_name)
+        if usable:
+            bad_files = self.verify_model(model_type)
+            if bad_files:
+                return f"文件不完整或已损坏: {', '.join(bad_files)}"
+        return f"{os.path.join(self.models_dir, model_name)}: {reason}"
+    
+    def lookup_local_model(self, model_name):
+        """从本地索引中查询模型目录是否可用，返回 (是否可用, 原因)"""
+        index = self._load_index()
+        model_path = os.path.join(self.models_dir, model_name)
+        try:
+            mtime = os.path.getmtime(model_path)
+        except OSError:
+            return False, "目录不存在"
+        
+        entry = index.get(model_name)
+        if entry is None or entry["mtime"] != mtime:
+            # 目录内容有变化时才重新检查
+            usable, reason = inspect_model_dir(model_path)
+            entry = {"mtime": mtime, "usable": usable, "reason": reason}
+            index[model_name] = entry
+            self._save_index()
+        return entry["usable"], entry["reason"]
+    
+    def list_local_models(self):
+        """列出 models/clip 下可用的模型目录"""
+        try:
+            names = sorted(os.listdir(self.models_dir))
+        except OSError:
+            return []
+        return [
+            os.path.join(self.models_dir, name) for name in names
+            if os.path.isdir(os.path.join(self.models_dir, name)) and self.lookup_local_model(name)[0]
+        ]
+    
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(os.path.join(self.models_dir, INDEX_NAME), "r", encoding="utf-8") as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+    
+    def _save_index(self):
+        index_path = os.path.join(self.models_dir, INDEX_NAME)
+        try:
+            with open(f"{index_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(self._index, f, ensure_ascii=False, indent=2, sort_keys=True)
+            os.replace(f"{index_path}.tmp", index_path)
+        except OSError as e:
+            print(f"警告：写入本地模型索引失败: {str(e)}")
+    
+    def verify_model(self, model_type, full=False):
+        """校验模型文件，返回需要重新下载的文件列表
+
+        默认只比较清单中记录的大小和修改时间；full=True 时重新计算所有文件的SHA-256。
+        没有清单记录的文件（例如手动放置的模型）视为可用，但 safetensors 文件的大小必须与头部声明的一致。
+        """
+        model_config = self.model_configs[model_type]
+        model_path = os.path.join(self.models_dir, model_config["name"])
+        manifest = ModelManifest(model_path)
+        bad_files = [
+            file_name for file_name in model_config["files"]
+            if manifest.check(file_name, full=full) in (FILE_MISSING, FILE_CORRUPT, FILE_INCOMPLETE)
+        ]
+        manifest.save()
+        return bad_files
+    
     def download_model(self, model_type):
-        """下载模型"""
+        """按回退链中的下载源依次尝试下载模型"""
         if model_type not in self.model_configs:
             raise ValueError(f"不支持的模型类型: {model_type}")
+        if self.offline:
+            raise Exception("严格离线模式下不允许下载模型")
         
         model_config = self.model_configs[model_type]
         model_name = model_config["name"]
@@ -46,132 +285,217 @@ class ModelManager:
         if not os.path.exists(model_path):
             os.makedirs(model_path)
         
-        # 模型下载逻辑 - 实现断点续传
+        # 模型下载逻辑 - 多文件并发、大文件分段并行，支持断点续传
         print(f"请稍候，模型 {model_name} 正在从Hugging Face下载...")
         
-        # 下载主要模型文件
-        try:
-            # 下载配置文件
-            self._download_file_with_resume(
-                f"https://huggingface.co/qwen/{model_name}/raw/main/config.json",
-                os.path.join(model_path, "config.json")
-            )
-            print(f"配置文件已下载")
-            
-            # 下载tokenizer配置
-            self._download_file_with_resume(
-                f"https://huggingface.co/qwen/{model_name}/raw/main/tokenizer_config.json",
-                os.path.join(model_path, "tokenizer_config.json")
-            )
-            print(f"tokenizer配置已下载")
-            
-            # 下载模型索引文件
-            index_file = model_config['files'][2]  # 索引文件是files列表中的第三个元素
-            self._download_file_with_resume(
-                f"https://huggingface.co/Qwen/{model_name}/resolve/main/{index_file}",
-                os.path.join(model_path, index_file)
-            )
-            print(f"模型索引文件已下载")
-            
-            # 下载模型权重文件（分块）
-            # 权重文件是files列表中从第四个元素开始的所有元素
-            weight_files = model_config['files'][3:]
-            for i, file_name in enumerate(weight_files, 1):
-                self._download_file_with_resume(
-                    f"https://huggingface.co/Qwen/{model_name}/resolve/main/{file_name}",
-                    os.path.join(model_path, file_name)
-                )
-                print(f"模型权重文件{i}已下载")
-            
-        except Exception as e:
-            # 尝试使用国内镜像
+        last_error = None
+        for i, host in enumerate(self.download_hosts):
+            if i > 0:
+                print(f"尝试使用镜像下载: {host}")
             try:
-                print(f"尝试使用国内镜像下载...")
-                # 下载配置文件
-                self._download_file_with_resume(
-                    f"https://hf-mirror.com/Qwen/{model_name}/raw/main/config.json",
-                    os.path.join(model_path, "config.json")
-                )
-                print(f"配置文件已下载")
-                
-                # 下载tokenizer配置
-                self._download_file_with_resume(
-                    f"https://hf-mirror.com/Qwen/{model_name}/raw/main/tokenizer_config.json",
-                    os.path.join(model_path, "tokenizer_config.json")
-                )
-                print(f"tokenizer配置已下载")
-                
-                # 下载模型索引文件
-                index_file = model_config['files'][2]  # 索引文件是files列表中的第三个元素
-                self._download_file_with_resume(
-                    f"https://hf-mirror.com/Qwen/{model_name}/resolve/main/{index_file}",
-                    os.path.join(model_path, index_file)
+                self._download_files(
+                    f"{host}/Qwen/{model_name}/resolve/main", model_config["files"], model_path
                 )
-                print(f"模型索引文件已下载")
-                
-                # 下载模型权重文件（分块）
-                # 权重文件是files列表中从第四个元素开始的所有元素
-                weight_files = model_config['files'][3:]
-                for i, file_name in enumerate(weight_files, 1):
-                    self._download_file_with_resume(
-                        f"https://hf-mirror.com/Qwen/{model_name}/resolve/main/{file_name}",
-                        os.path.join(model_path, file_name)
-                    )
-                    print(f"模型权重文件{i}已下载")
-            except Exception as e2:
-                error_msg = f"模型下载失败: {str(e2)}"
-                error_msg += "\n请确保您的网络连接正常，并且可以访问Hugging Face网站或国内镜像。"
-                error_msg += "\n如果下载持续失败，您可以尝试手动下载模型文件并放置到 {model_path} 目录下。"
-                error_msg += f"\n模型下载地址: https://huggingface.co/Qwen/{model_name}"
-                raise Exception(error_msg)
-
-        return model_path
+                return model_path
+            except Exception as e:
+                last_error = e
+                print(f"从 {host} 下载失败: {str(e)}")
+        
+        error_msg = f"模型下载失败: {str(last_error)}"
+        error_msg += "\n请确保您的网络连接正常，并且可以访问Hugging Face网站或国内镜像。"
+        error_msg += f"\n如果下载持续失败，您可以尝试手动下载模型文件并放置到 {model_path} 目录下。"
+        error_msg += f"\n模型下载地址: https://huggingface.co/Qwen/{model_name}"
+        raise Exception(error_msg)
     
-    def _download_file_with_resume(self, url, file_path, chunk_size=1024*10, max_retries=3):
-        """带断点续传的文件下载方法"""
-        file_size = 0
-        retries = 0
+    def _download_files(self, base_url, files, model_path, max_workers=None):
+        """并发下载多个文件并记录到清单；已校验通过的文件直接跳过，任一文件失败时抛出异常"""
+        max_workers = max_workers or DOWNLOAD_WORKERS
+        manifest = ModelManifest(model_path)
+        pending = []
+        for file_name in files:
+            status = manifest.check(file_name)
+            if status == FILE_OK:
+                continue
+            if status == FILE_CORRUPT:
+                # 损坏的文件不能作为续传的前缀
+                print(f"文件已损坏，重新下载: {file_name}")
+                os.remove(os.path.join(model_path, file_name))
+                manifest.forget(file_name)
+            pending.append(file_name)
+        manifest.save()
+        
+        progress = DownloadProgress()
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="qwen-clip-download") as executor:
+            futures = {
+                executor.submit(
+                    self._download_file_with_resume,
+                    f"{base_url}/{file_name}",
+                    os.path.join(model_path, file_name),
+                    progress=progress,
+                ): file_name
+                for file_name in pending
+            }
+            for future in as_completed(futures):
+                file_name = futures[future]
+                manifest.record(file_name, future.result())
+                # 每完成一个文件就写入清单，中断后不会重复下载
+                manifest.save()
+                print(f"\n{file_name} 已下载")
+        progress.finish()
+    
+    def _download_file_with_resume(self, url, file_path, chunk_size=DOWNLOAD_CHUNK_SIZE, max_retries=3,
+                                   segments=None, progress=None):
+        """带断点续传的文件下载方法，大文件按HTTP Range分段并行下载，每段独立续传
+
+        返回下载过程中流式计算的SHA-256。
+        """
+        segments = segments or DOWNLOAD_SEGMENTS
+        progress = progress or DownloadProgress()
+        
+        url, total_size, accept_ranges = self._probe_remote_file(url)
+        progress.add_total(total_size)
         
-        # 检查文件是否已部分下载
-        if os.path.exists(file_path):
+        if os.path.exists(file_path) and total_size > 0:
             file_size = os.path.getsize(file_path)
-            print(f"发现已下载部分文件，尝试续传: {file_path} ({file_size} bytes)")
+            if file_size == total_size:
+                progress.advance(total_size)
+                return hash_file(file_path)
+            # 旧版本逐块追加写入的文件：能作为第一段的前缀时继续使用，否则重新下载
+            first_part = f"{file_path}.part0"
+            if file_size < total_size and accept_ranges and not os.path.exists(first_part):
+                print(f"发现已下载部分文件，尝试续传: {file_path} ({file_size} bytes)")
+                os.replace(file_path, first_part)
+            else:
+                os.remove(file_path)
         
-        while retries <= max_retries:
+        if total_size <= 0 or not accept_ranges:
+            ranges = [(0, None)]
+        else:
+            count = max(1, min(segments, -(-total_size // DOWNLOAD_MIN_SEGMENT_SIZE)))
+            step = -(-total_size // count)
+            ranges = [(start, min(start + step, total_size) - 1) for start in range(0, total_size, step)]
+        
+        part_paths = [f"{file_path}.part{i}" for i in range(len(ranges))]
+        # 续传前，第一段可能比新的分段方式更长，超出部分交给后续段
+        if len(ranges) > 1 and os.path.exists(part_paths[0]):
+            first_length = ranges[0][1] - ranges[0][0] + 1
+            if os.path.getsize(part_paths[0]) > first_length:
+                os.truncate(part_paths[0], first_length)
+        
+        if len(ranges) == 1:
+            # 单连接下载时边下载边计算哈希
+            hasher = self._download_segment(url, part_paths[0], ranges[0][0], ranges[0][1],
+                                            chunk_size, max_retries, progress, hash_data=True)
+            os.replace(part_paths[0], file_path)
+        else:
+            with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="qwen-clip-segment") as executor:
+                futures = [
+                    executor.submit(self._download_segment, url, part_path, start, end,
+                                    chunk_size, max_retries, progress)
+                    for part_path, (start, end) in zip(part_paths, ranges)
+                ]
+                for future in futures:
+                    future.result()
+            # 分段下载时在按顺序拼接的同时计算哈希，不需要额外读一遍文件
+            hasher = self._assemble_parts(part_paths, file_path)
+        
+        if total_size > 0 and os.path.getsize(file_path) != total_size:
+            os.remove(file_path)
+            raise Exception(f"文件大小不匹配: {file_path}")
+        return hasher.hexdigest()
+    
+    def _probe_remote_file(self, url):
+        """获取重定向后的地址、文件大小以及服务器是否支持Range请求"""
+        import requests
+        response = requests.head(url, allow_redirects=True, timeout=30)
+        if response.status_code >= 400:
+            raise Exception(f"下载失败，状态码: {response.status_code}")
+        final_url = response.url
+        total_size = int(response.headers.get('content-length', 0) or 0)
+        accept_ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+        if not accept_ranges or total_size <= 0:
+            # 部分服务器HEAD不返回这些信息，用一个字节的Range请求确认
+            response = requests.get(final_url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=30)
+            content_range = response.headers.get('content-range', '')
+            response.close()
+            if response.status_code == 206 and '/' in content_range:
+                accept_ranges = True
+                total_size = int(content_range.rsplit('/', 1)[1])
+        return final_url, total_size, accept_ranges
+    
+    def _download_segment(self, url, part_path, start, end, chunk_size, max_retries, progress, hash_data=False):
+        """下载 [start, end] 字节区间到分段文件，失败后从分段已下载的位置续传
+
+        hash_data=True 时边写入边计算SHA-256并返回。
+        """
+        import requests
+        retries = 0
+        counted = False
+        hasher = None
+        while True:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if not counted:
+                progress.advance(offset)
+                counted = True
+            if hash_data and hasher is None:
+                # 续传时先补上已下载部分的哈希
+                hasher = hashlib.sha256()
+                if offset > 0:
+                    with open(part_path, 'rb') as f:
+                        for block in iter(lambda: f.read(chunk_size), b""):
+                            hasher.update(block)
+            if end is not None and start + offset > end:
+                return hasher
             try:
-                headers = {'Range': f'bytes={file_size}-'}
+                headers = {}
+                if end is not None:
+                    headers['Range'] = f'bytes={start + offset}-{end}'
+                elif offset > 0:
+                    headers['Range'] = f'bytes={offset}-'
                 response = requests.get(url, headers=headers, stream=True, timeout=30)
                 
                 # 检查响应状态
-                if response.status_code == 200 or response.status_code == 206:
-                    total_size = int(response.headers.get('content-length', 0)) + file_size
-                    
-                    with open(file_path, 'ab') as f:
-                        downloaded = file_size
+                if response.status_code == 206 or (response.status_code == 200 and start + offset == 0):
+                    with open(part_path, 'ab') as f:
                         for chunk in response.iter_content(chunk_size=chunk_size):
                             if chunk:
                                 f.write(chunk)
-                                downloaded += len(chunk)
-                                
-                                # 显示下载进度
-                                if total_size > 0:
-                                    progress = downloaded / total_size * 100
-                                    print(f"下载进度: {progress:.1f}% ({downloaded}/{total_size} bytes)", end='\r')
-                    
-                    print()  # 新行
-                    return
-                else:
-                    raise Exception(f"下载失败，状态码: {response.status_code}")
+                                if hasher is not None:
+                                    hasher.update(chunk)
+                                progress.advance(len(chunk))
+                    return hasher
+                if response.status_code == 200:
+                    # 服务器忽略了Range，只能从头下载该文件
+                    progress.advance(-offset)
+                    os.remove(part_path)
+                    hasher = None
+                    raise Exception("服务器不支持断点续传，重新下载")
+                raise Exception(f"下载失败，状态码: {response.status_code}")
             except Exception as e:
                 retries += 1
-                file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
-                print(f"下载失败 (尝试 {retries}/{max_retries}): {str(e)}")
+                print(f"\n下载失败 (尝试 {retries}/{max_retries}): {str(e)}")
+                # 写入到一半的块已经计入哈希，重新按文件内容计算
+                hasher = None
                 if retries > max_retries:
                     raise e
                 print(f"5秒后重试...")
-                import time
                 time.sleep(5)
     
+    def _assemble_parts(self, part_paths, file_path):
+        """按顺序拼接分段文件，同时计算整个文件的SHA-256"""
+        hasher = hashlib.sha256()
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, 'wb') as out:
+            for part_path in part_paths:
+                with open(part_path, 'rb') as part:
+                    for block in iter(lambda: part.read(DOWNLOAD_CHUNK_SIZE), b""):
+                        hasher.update(block)
+                        out.write(block)
+        os.replace(temp_path, file_path)
+        for part_path in part_paths:
+            os.remove(part_path)
+        return hasher
+    
     # 删除虚拟模型文件创建方法
     # def _create_dummy_model_files(self, model_path, files):
     #     """创建虚拟模型文件（实际使用时需要替换为真实下载逻辑）"""
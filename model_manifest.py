@@ -0,0 +1,126 @@
+"""
+模型文件清单
+记录每个文件的大小、修改时间和下载时流式计算的SHA-256。
+启动时只比较大小和修改时间，完整哈希校验按需执行。
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_NAME = ".qwen_clip_manifest.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# 文件状态
+FILE_OK = "ok"
+FILE_MISSING = "missing"
+# 文件存在但清单中没有记录（例如手动放置的模型），无法校验
+FILE_UNRECORDED = "unrecorded"
+FILE_CORRUPT = "corrupt"
+# 清单中没有记录，但比 safetensors 头部声明的大小短（例如旧版下载器中断留下的文件），可以续传
+FILE_INCOMPLETE = "incomplete"
+
+
+def hash_file(file_path):
+    """计算文件的SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def safetensors_expected_size(file_path):
+    """按 safetensors 头部计算完整文件的大小：8 + 头部长度 + 最大的 data_offsets 结束位置；头部无法解析时返回None"""
+    try:
+        with open(file_path, "rb") as f:
+            header_size = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_size))
+        data_end = max(
+            (info["data_offsets"][1] for name, info in header.items() if name != "__metadata__"),
+            default=0,
+        )
+    except (OSError, ValueError, KeyError, TypeError, IndexError, AttributeError):
+        return None
+    return 8 + header_size + data_end
+
+
+class ModelManifest:
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.path = os.path.join(model_path, MANIFEST_NAME)
+        self.files = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.files = json.load(f).get("files", {})
+        except (OSError, ValueError):
+            self.files = {}
+
+    def save(self):
+        """原子写入清单"""
+        with self._lock:
+            if not self._dirty:
+                return
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"files": self.files}, f, ensure_ascii=False, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+            self._dirty = False
+
+    def record(self, file_name, sha256):
+        """记录已完整下载的文件"""
+        stat = os.stat(os.path.join(self.model_path, file_name))
+        with self._lock:
+            self.files[file_name] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+            self._dirty = True
+
+    def forget(self, file_name):
+        with self._lock:
+            if self.files.pop(file_name, None) is not None:
+                self._dirty = True
+
+    def check(self, file_name, full=False):
+        """检查单个文件；full=True 时重新计算哈希，否则只比较大小和修改时间"""
+        file_path = os.path.join(self.model_path, file_name)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return FILE_MISSING
+
+        entry = self.files.get(file_name)
+        if entry is None:
+            return self._check_unrecorded(file_path, stat.st_size)
+        if stat.st_size != entry["size"]:
+            return FILE_CORRUPT
+        if not full and stat.st_mtime == entry["mtime"]:
+            return FILE_OK
+
+        # 修改时间变化（例如被复制过）或要求完整校验时，才计算哈希
+        if hash_file(file_path) != entry["sha256"]:
+            return FILE_CORRUPT
+        if stat.st_mtime != entry["mtime"]:
+            with self._lock:
+                entry["mtime"] = stat.st_mtime
+                self._dirty = True
+        return FILE_OK
+
+    @staticmethod
+    def _check_unrecorded(file_path, size):
+        """没有清单记录的文件无法比较哈希；safetensors 至少按头部声明的大小检查是否完整"""
+        if not file_path.endswith(".safetensors"):
+            return FILE_UNRECORDED
+        expected = safetensors_expected_size(file_path)
+        if expected is None:
+            # 头部都不完整，只能重新下载
+            return FILE_CORRUPT
+        if size < expected:
+            return FILE_INCOMPLETE
+        if size > expected:
+            return FILE_CORRUPT
+        return FILE_UNRECORDED
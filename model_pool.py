@@ -0,0 +1,341 @@
+"""
+进程级模型常驻池
+按 (模型路径, 精度, 设备映射, 量化方式) 缓存已加载的模型，避免每次调用都重新加载权重。
+空闲超时或超出内存预算时按LRU顺序回收，被固定(pin)或正在使用的模型不会被回收。
+"""
+
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from .config import env_float, env_int
+from .precision import DEFAULT_PRECISION, DEFAULT_QUANTIZATION, quantized_device_map
+
+# 空闲多少秒后回收模型，0表示不按空闲时间回收
+DEFAULT_IDLE_TTL = env_float("QWEN_CLIP_IDLE_TTL", 600.0)
+# 常驻模型占用的内存/显存预算(GB)，0表示不限制
+DEFAULT_MEMORY_BUDGET_GB = env_float("QWEN_CLIP_MEMORY_BUDGET_GB", 0.0)
+# 最多同时常驻的模型数量，0表示不限制
+DEFAULT_MAX_MODELS = env_int("QWEN_CLIP_MAX_MODELS", 1)
+
+
+class _PoolEntry:
+    def __init__(self, key):
+        self.key = key
+        self.generator = None
+        self.size_bytes = 0
+        self.last_used = time.monotonic()
+        self.pinned = False
+        self.in_use = 0
+        # 每个模型单独加锁，加载某个模型时不阻塞池中其他操作
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.generator is not None and self.generator.model is not None
+
+
+class ModelPool:
+    def __init__(self, idle_ttl=DEFAULT_IDLE_TTL, memory_budget_gb=DEFAULT_MEMORY_BUDGET_GB,
+                 max_models=DEFAULT_MAX_MODELS):
+        self.idle_ttl = idle_ttl
+        self.memory_budget_bytes = int(memory_budget_gb * 1024 ** 3)
+        self.max_models = max_models
+        # 按最近使用顺序排列，最久未使用的在最前面
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._sweeper = None
+        # 后台预加载任务，按 (模型类型, 精度, 设备映射) 记录
+        self._preloads = {}
+
+    @staticmethod
+    def make_key(model_path, torch_dtype=DEFAULT_PRECISION, device_map="auto", quantization=DEFAULT_QUANTIZATION):
+        """生成模型池的键"""
+        return (model_path, str(torch_dtype), str(quantized_device_map(device_map, quantization)), quantization)
+
+    def acquire(self, model_path, model_type, torch_dtype=DEFAULT_PRECISION, device_map="auto", allow_remote=False,
+                quantization=DEFAULT_QUANTIZATION):
+        """获取常驻模型，必要时加载；用完后需调用 checkin"""
+        device_map = quantized_device_map(device_map, quantization)
+        key = self.make_key(model_path, torch_dtype, device_map, quantization)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _PoolEntry(key)
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            entry.in_use += 1
+
+        try:
+            with entry.lock:
+                if not entry.loaded:
+                    # 先按限制回收空闲模型再加载，否则切换模型时新旧两份权重会同时常驻
+                    with self._lock:
+                        self._make_room(key, _estimate_size(model_path))
+                    # 延迟导入，避免模型池本身依赖torch
+                    from .utils import ImageCaptionGenerator
+                    generator = ImageCaptionGenerator()
+                    # 先挂到条目上，加载过程中可以通过 stats() 查看进度
+                    entry.generator = generator
+                    try:
+                        generator.load_model(model_path, model_type, torch_dtype=torch_dtype,
+                                             device_map=device_map, allow_remote=allow_remote,
+                                             quantization=quantization)
+                    except Exception:
+                        entry.generator = None
+                        raise
+                    entry.size_bytes = generator.memory_footprint()
+        except Exception:
+            with self._lock:
+                entry.in_use -= 1
+                if not entry.loaded and entry.in_use == 0:
+                    self._entries.pop(key, None)
+            raise
+
+        with self._lock:
+            entry.last_used = time.monotonic()
+            self._enforce_limits()
+        self._ensure_sweeper()
+        return key, entry.generator
+
+    def preload(self, model_type, resolve_path, torch_dtype=DEFAULT_PRECISION, device_map="auto", allow_remote=False,
+                quantization=DEFAULT_QUANTIZATION):
+        """在后台线程中解析并加载模型，返回Future
+
+        resolve_path 在后台线程中调用，返回模型路径（可能需要下载）。
+        同一模型重复调用时返回已有的任务。
+        """
+        device_map = quantized_device_map(device_map, quantization)
+        preload_key = (model_type, str(torch_dtype), str(device_map), quantization)
+        with self._lock:
+            future = self._preloads.get(preload_key)
+            if future is not None and not (future.done() and future.exception() is not None):
+                return future
+            future = Future()
+            future.stage = "resolving"
+            future.started = time.monotonic()
+            self._preloads[preload_key] = future
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                model_path = resolve_path()
+                future.stage = "loading"
+                key, _ = self.acquire(model_path, model_type, torch_dtype=torch_dtype,
+                                      device_map=device_map, allow_remote=allow_remote,
+                                      quantization=quantization)
+                self.checkin(key)
+                future.stage = "ready"
+                print(f"后台预加载完成: {model_path} ({time.monotonic() - future.started:.1f}s)")
+                future.set_result(key)
+            except Exception as e:
+                future.stage = "error"
+                print(f"后台预加载失败: {str(e)}")
+                future.set_exception(e)
+
+        # 使用守护线程，进程退出时不会等待加载完成
+        threading.Thread(target=run, name="qwen-clip-preload", daemon=True).start()
+        return future
+
+    def wait_preload(self, model_type, torch_dtype=DEFAULT_PRECISION, device_map="auto", timeout=None,
+                     quantization=DEFAULT_QUANTIZATION):
+        """如果该模型正在后台预加载，等待其完成；预加载失败时不抛出，由调用方自行加载"""
+        preload_key = (model_type, str(torch_dtype), str(quantized_device_map(device_map, quantization)), quantization)
+        with self._lock:
+            future = self._preloads.get(preload_key)
+        if future is None:
+            return
+        if not future.done():
+            print("等待后台预加载完成...")
+        try:
+            future.result(timeout=timeout)
+        except Exception:
+            pass
+
+    def preload_status(self):
+        """返回后台预加载任务的状态"""
+        with self._lock:
+            now = time.monotonic()
+            return [
+                {
+                    "model_type": preload_key[0],
+                    "torch_dtype": preload_key[1],
+                    "device_map": preload_key[2],
+                    "quantization": preload_key[3],
+                    "stage": future.stage,
+                    "ready": future.done() and future.exception() is None,
+                    "elapsed_seconds": round(now - future.started, 1),
+                }
+                for preload_key, future in self._preloads.items()
+            ]
+
+    def checkin(self, key):
+        """归还模型，模型继续常驻"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.in_use = max(0, entry.in_use - 1)
+            entry.last_used = time.monotonic()
+            self._enforce_limits()
+
+    def pin(self, key):
+        """固定模型，不参与空闲和LRU回收"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.pinned = True
+
+    def unpin(self, key):
+        """取消固定"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.pinned = False
+
+    def release(self, key):
+        """显式释放模型：取消固定，并在无人使用时立即卸载"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.pinned = False
+            if entry.in_use == 0:
+                self._evict(key)
+
+    def release_all(self):
+        """释放所有未在使用的模型"""
+        with self._lock:
+            for key in list(self._entries):
+                self.release(key)
+
+    def sweep(self):
+        """回收空闲超时的模型"""
+        if self.idle_ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.pinned or entry.in_use > 0:
+                    continue
+                if now - entry.last_used >= self.idle_ttl:
+                    print(f"模型空闲超过 {self.idle_ttl:.0f} 秒，正在回收: {key[0]}")
+                    self._evict(key)
+
+    def stats(self):
+        """返回常驻模型的状态"""
+        with self._lock:
+            now = time.monotonic()
+            return [
+                {
+                    "model_path": key[0],
+                    "torch_dtype": key[1],
+                    "device_map": key[2],
+                    "quantization": key[3],
+                    "loaded": entry.loaded,
+                    "stage": entry.generator.load_stage if entry.generator is not None else "idle",
+                    "size_bytes": entry.size_bytes,
+                    # 加载方式、耗时和加载过程中的峰值RSS
+                    "load": entry.generator.load_stats if entry.generator is not None else None,
+                    "pinned": entry.pinned,
+                    "in_use": entry.in_use,
+                    "idle_seconds": round(now - entry.last_used, 1),
+                }
+                for key, entry in self._entries.items()
+            ]
+
+    def _resident_bytes(self):
+        return sum(entry.size_bytes for entry in self._entries.values() if entry.loaded)
+
+    def _enforce_limits(self):
+        """超出数量或内存预算时，按LRU顺序回收可回收的模型"""
+        while self._over_limits():
+            victim = next(
+                (key for key, entry in self._entries.items()
+                 if entry.loaded and not entry.pinned and entry.in_use == 0),
+                None,
+            )
+            if victim is None:
+                break
+            print(f"超出模型常驻限制，按LRU回收: {victim[0]}")
+            self._evict(victim)
+
+    def _make_room(self, key, incoming_bytes):
+        """即将加载 key 对应的模型：按LRU顺序回收可回收的模型，使加载后仍不超出数量和内存预算"""
+        while True:
+            loaded = [entry for entry in self._entries.values() if entry.loaded and entry.key != key]
+            over_count = self.max_models > 0 and len(loaded) + 1 > self.max_models
+            over_budget = self.memory_budget_bytes > 0 and \
+                sum(entry.size_bytes for entry in loaded) + incoming_bytes > self.memory_budget_bytes
+            if not (over_count or over_budget):
+                return
+            victim = next((entry.key for entry in loaded if not entry.pinned and entry.in_use == 0), None)
+            if victim is None:
+                return
+            print(f"加载新模型前按LRU回收: {victim[0]}")
+            self._evict(victim)
+
+    def _over_limits(self):
+        loaded = sum(1 for entry in self._entries.values() if entry.loaded)
+        if self.max_models > 0 and loaded > self.max_models:
+            return True
+        if self.memory_budget_bytes > 0 and self._resident_bytes() > self.memory_budget_bytes:
+            return True
+        return False
+
+    def _evict(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry.generator is None:
+            return
+        entry.generator.unload_model()
+        entry.generator = None
+        gc.collect()
+
+    def _ensure_sweeper(self):
+        """启动后台线程定期回收空闲模型"""
+        if self.idle_ttl <= 0 or self._sweeper is not None:
+            return
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            interval = max(1.0, min(60.0, self.idle_ttl / 4))
+
+            def run():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        self.sweep()
+                    except Exception as e:
+                        print(f"回收空闲模型失败: {str(e)}")
+
+            self._sweeper = threading.Thread(target=run, name="qwen-clip-pool-sweeper", daemon=True)
+            self._sweeper.start()
+
+
+def _estimate_size(model_path):
+    """按权重文件大小估算加载后占用的内存，模型目录不存在时返回0"""
+    try:
+        names = os.listdir(model_path)
+    except OSError:
+        return 0
+    return sum(
+        os.path.getsize(os.path.join(model_path, name))
+        for name in names if name.endswith((".safetensors", ".bin"))
+    )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_model_pool():
+    """获取进程级共享的模型池"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ModelPool()
+        return _pool
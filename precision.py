@@ -0,0 +1,36 @@
+"""
+推理精度与量化设置
+auto 在GPU上使用 float16，在CPU上优先使用 bfloat16（CPU不支持时使用 float32）；
+CPU模式下可以把语言模型的线性层量化为int8。不依赖torch，节点注册时可以直接导入。
+"""
+
+from .config import env_str
+
+PRECISIONS = ["auto", "float16", "bfloat16", "float32"]
+# int8_dynamic：权重和激活都按int8计算（要求float32）；int8_weight_only：只量化权重，激活保持原精度
+QUANTIZATION_MODES = ["none", "int8_dynamic", "int8_weight_only"]
+
+DEFAULT_PRECISION = env_str("QWEN_CLIP_PRECISION", "auto")
+if DEFAULT_PRECISION not in PRECISIONS:
+    print(f"警告：未知的推理精度 {DEFAULT_PRECISION}，使用 auto")
+    DEFAULT_PRECISION = "auto"
+
+DEFAULT_QUANTIZATION = env_str("QWEN_CLIP_QUANTIZE", "none")
+if DEFAULT_QUANTIZATION not in QUANTIZATION_MODES:
+    print(f"警告：未知的量化方式 {DEFAULT_QUANTIZATION}，不量化")
+    DEFAULT_QUANTIZATION = "none"
+
+
+def check_precision(precision, quantization):
+    """检查精度和量化设置的组合是否可用"""
+    if precision not in PRECISIONS:
+        raise Exception(f"未知的推理精度: {precision}，可选 {', '.join(PRECISIONS)}")
+    if quantization not in QUANTIZATION_MODES:
+        raise Exception(f"未知的量化方式: {quantization}，可选 {', '.join(QUANTIZATION_MODES)}")
+    if quantization == "int8_dynamic" and precision not in ("auto", "float32"):
+        raise Exception(f"int8_dynamic 量化只支持 float32 精度，当前为 {precision}")
+
+
+def quantized_device_map(device_map, quantization):
+    """量化只用于CPU推理：开启量化时模型完整加载到CPU"""
+    return device_map if quantization == "none" else "cpu"
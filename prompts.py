@@ -0,0 +1,72 @@
+"""
+提示词与生成参数
+不依赖torch/transformers，插件注册和缓存查询时可以直接导入
+"""
+
+import ast
+import json
+import re
+
+from .config import env_bool
+
+# 每次 model.generate 处理的图像数量
+DEFAULT_BATCH_SIZE = 4
+
+# 固定的指令提示词放在图像之前，其KV缓存每个模型只计算一次，之后所有调用和批次共用
+PREFIX_CACHE = env_bool("QWEN_CLIP_PREFIX_CACHE", True)
+# JSON约束解码：固定回答开头，英文提示词结束即停止
+JSON_DECODING = env_bool("QWEN_CLIP_JSON_DECODING", True)
+
+# 默认的采样参数，每次生成结果不同
+SAMPLING_PARAMS = {
+    "max_new_tokens": 512,
+    "do_sample": True,
+    "temperature": 0.7,
+    "top_k": 50,
+    "top_p": 0.95,
+}
+
+# 确定性模式使用贪心解码，相同输入得到相同结果
+GREEDY_PARAMS = {
+    "max_new_tokens": 512,
+    "do_sample": False,
+}
+
+# 中文提示词，明确说明用于AI文生图
+CAPTION_PROMPT = "请给我一段提示词，可以准确向其他文生图大模型描述这张图片，以生成相似的图片，返回文本需要包含中英文，给出json格式回答，具体内容是{'中文提示词':'','英文提示词':''}，描述内容尽可能详细，可能包括但不限于主体（含权重）、位置关系、细节、风格等"
+
+
+class UnparsedCaption(tuple):
+    """回答无法解析为JSON时使用原始文本得到的 (中文, 英文)；不写入缓存，下次重新生成"""
+
+
+def parse_caption_response(response):
+    """解析json格式的回答 {'中文提示词':'','英文提示词':''}，返回 (中文, 英文)"""
+    candidates = []
+    match = re.search(r"\{.*\}", response, re.S)
+    if match:
+        candidates.append(match.group(0))
+    start = response.find("{")
+    if start >= 0:
+        # 约束解码在英文提示词结束时就停止，对象可能还没有闭合；达到token上限时字符串也可能未结束
+        candidates += [response[start:] + "}", response[start:] + '"}']
+    for json_str in candidates:
+        for loader in (json.loads, ast.literal_eval):
+            try:
+                json_data = loader(json_str)
+                return json_data['中文提示词'], json_data['英文提示词']
+            except Exception:
+                continue
+    print(f"警告：无法解析JSON格式的回答，使用原始文本。原始回答: {response}")
+    # 简单复制中文回答作为英文回答
+    return UnparsedCaption((response, response))
+
+
+# JSON约束解码：回答的开头作为提示词的一部分直接给出，中文提示词之后固定接英文提示词的键
+JSON_RESPONSE_PREFIX = '{"中文提示词": "'
+JSON_SECOND_FIELD = ', "英文提示词": "'
+
+
+def generation_params(deterministic=False):
+    """返回 model.generate 使用的生成参数"""
+    return dict(GREEDY_PARAMS if deterministic else SAMPLING_PARAMS)
@@ -0,0 +1,210 @@
+"""
+CPU推理的精度选择和int8量化
+只量化语言模型的线性层（逐输出通道对称量化），视觉编码器和 lm_head 保持原精度。
+量化后的权重保存在模型旁边的 quantized 目录中，之后加载时直接读取，不再重新计算。
+"""
+
+import json
+import os
+import warnings
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from .caption_cache import model_fingerprint
+from .mmap_loader import SafetensorsShard
+
+# CPU上的int8权重矩阵乘法（激活保持bf16/fp32），旧版torch没有时退回反量化后计算
+_INT8_MATMUL = getattr(torch.ops.aten, "_weight_int8pack_mm", None)
+
+# _weight_int8pack_mm 要求权重地址按16字节对齐，否则会直接崩溃；保存的量化权重按缓存行对齐
+_WEIGHT_ALIGNMENT = 64
+
+_SAFETENSORS_DTYPES = {torch.int8: "I8", torch.float32: "F32"}
+
+
+def resolve_dtype(precision, device_map="auto", quantization="none"):
+    """把精度设置转换为torch类型；auto 在GPU上用 float16，在CPU上优先 bfloat16"""
+    if not isinstance(precision, str):
+        return precision
+    if precision != "auto":
+        return getattr(torch, precision)
+    if quantization == "int8_dynamic":
+        return torch.float32
+    if torch.cuda.is_available() and device_map != "cpu":
+        return torch.float16
+    if _cpu_supports_bf16():
+        return torch.bfloat16
+    return torch.float32
+
+
+def _cpu_supports_bf16():
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def quantize_weight(weight):
+    """逐输出通道的对称int8量化，返回 (int8权重, float32缩放系数)"""
+    weight = weight.detach().float()
+    scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+    quantized = torch.round(weight / scales[:, None]).clamp(-128, 127).to(torch.int8)
+    return quantized, scales
+
+
+class Int8WeightOnlyLinear(nn.Module):
+    """只量化权重的线性层：权重以int8常驻内存，激活保持原精度"""
+
+    def __init__(self, in_features, out_features, bias=True, dtype=torch.float32):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("scales", torch.ones(out_features, dtype=dtype))
+        self.register_buffer("bias", torch.zeros(out_features, dtype=dtype) if bias else None)
+
+    def set_weight(self, quantized, scales, bias=None):
+        quantized = quantized.contiguous()
+        # 引用内存映射的权重可能没有对齐（例如旧版本保存的量化权重），复制到新分配的内存中
+        if quantized.data_ptr() % _WEIGHT_ALIGNMENT:
+            quantized = quantized.clone()
+        self.weight = quantized
+        self.scales = scales.to(self.scales.dtype)
+        if bias is not None:
+            self.bias = bias.detach().to(self.scales.dtype)
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, self.in_features)
+        scales = self.scales.to(x.dtype)
+        if _INT8_MATMUL is not None and x.device.type == "cpu":
+            output = _INT8_MATMUL(x.contiguous(), self.weight, scales)
+        else:
+            output = F.linear(x, self.weight.to(x.dtype) * scales[:, None])
+        if self.bias is not None:
+            output = output + self.bias.to(x.dtype)
+        return output.reshape(*shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+def _dynamic_linear(linear_shape, quantized, scales, bias):
+    """由int8权重构造动态量化线性层（激活在每次计算时量化）"""
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+
+    out_features, in_features = linear_shape
+    with warnings.catch_warnings():
+        # 新版torch对量化张量的创建函数给出弃用提示，每一层都会重复
+        warnings.simplefilter("ignore", UserWarning)
+        module = DynamicLinear(in_features, out_features, bias_=bias is not None, dtype=torch.qint8)
+        weight = torch._make_per_channel_quantized_tensor(
+            quantized, scales.double(), torch.zeros(out_features, dtype=torch.long), 0
+        )
+        module.set_weight_bias(weight, None if bias is None else bias.detach().float())
+    return module
+
+
+def _build_module(mode, linear, quantized, scales, bias):
+    if mode == "int8_dynamic":
+        return _dynamic_linear((linear.out_features, linear.in_features), quantized, scales, bias)
+    module = Int8WeightOnlyLinear(linear.in_features, linear.out_features, bias=bias is not None,
+                                  dtype=linear.weight.dtype)
+    module.set_weight(quantized, scales, bias)
+    return module
+
+
+def quantizable_linears(model):
+    """语言模型中需要量化的线性层：[(名称, 模块)]，名称相对于整个模型"""
+    decoder = model.get_decoder() if hasattr(model, "get_decoder") else model
+    decoder_ids = {id(module) for module in decoder.modules()}
+    return [
+        (name, module) for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and id(module) in decoder_ids
+    ]
+
+
+def quantized_checkpoint_path(model_path, mode, dtype):
+    """量化权重的保存位置：models/clip/quantized/<模型名>-<量化方式>-<精度>.safetensors"""
+    model_path = os.path.normpath(model_path)
+    dtype_name = str(dtype).replace("torch.", "")
+    return os.path.join(os.path.dirname(model_path), "quantized",
+                        f"{os.path.basename(model_path)}-{mode}-{dtype_name}.safetensors")
+
+
+def _load_checkpoint(path, source):
+    """int8权重直接引用内存映射，多个进程加载同一模型时共用页缓存"""
+    try:
+        shard = SafetensorsShard(path)
+        # 旧版本保存的文件没有对齐，重新量化并覆盖
+        if shard.metadata.get("source") != source or shard.metadata.get("alignment") != str(_WEIGHT_ALIGNMENT):
+            return None
+        return {key: shard.tensor(key) for key in shard.keys()}
+    except Exception as e:
+        print(f"警告：读取量化权重失败，将重新量化: {str(e)}")
+        return None
+
+
+def _save_checkpoint(path, tensors, source):
+    """按 safetensors 格式保存；int8权重排在前面，数据区从对齐的位置开始，读取时直接引用映射也满足对齐要求"""
+    keys = sorted(tensors, key=lambda key: (tensors[key].dtype != torch.int8, key))
+    header = {"__metadata__": {"source": source, "alignment": str(_WEIGHT_ALIGNMENT)}}
+    offset = 0
+    for key in keys:
+        tensor = tensors[key]
+        size = tensor.numel() * tensor.element_size()
+        header[key] = {"dtype": _SAFETENSORS_DTYPES[tensor.dtype], "shape": list(tensor.shape),
+                       "data_offsets": [offset, offset + size]}
+        offset += size
+    header_bytes = json.dumps(header).encode("utf-8")
+    # 头部用空格补齐（格式允许），使数据区的起点对齐
+    header_bytes += b" " * (-(8 + len(header_bytes)) % _WEIGHT_ALIGNMENT)
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(len(header_bytes).to_bytes(8, "little"))
+            f.write(header_bytes)
+            for key in keys:
+                f.write(tensors[key].contiguous().reshape(-1).view(torch.uint8).numpy())
+        os.replace(temp_path, path)
+        print(f"量化权重已保存: {path}")
+    except OSError as e:
+        print(f"警告：保存量化权重失败: {str(e)}")
+
+
+def quantize_model(model, model_path, mode):
+    """把语言模型的线性层替换为int8实现；已有保存的量化权重时直接读取。返回替换的层数"""
+    if mode == "none":
+        return 0
+    if any(p.device.type != "cpu" for p in model.parameters()):
+        raise Exception("int8量化只支持完全加载在CPU上的模型")
+    linears = quantizable_linears(model)
+    dtype = linears[0][1].weight.dtype if linears else torch.float32
+    path = quantized_checkpoint_path(model_path, mode, dtype)
+    source = model_fingerprint(model_path)
+    saved = _load_checkpoint(path, source) if os.path.isfile(path) else None
+    if saved is not None and any(f"{name}.weight" not in saved for name, _ in linears):
+        saved = None
+    if saved is not None:
+        print(f"读取已保存的量化权重: {path}")
+
+    tensors = {}
+    for name, linear in linears:
+        if saved is not None:
+            quantized, scales = saved[f"{name}.weight"], saved[f"{name}.scales"]
+        else:
+            quantized, scales = quantize_weight(linear.weight)
+            tensors[f"{name}.weight"] = quantized
+            tensors[f"{name}.scales"] = scales
+        module = _build_module(mode, linear, quantized, scales, linear.bias)
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(model.get_submodule(parent_name), child_name, module)
+
+    # 只保存int8权重和缩放系数，偏置仍从原模型读取
+    if saved is None and tensors:
+        _save_checkpoint(path, tensors, source)
+    return len(linears)
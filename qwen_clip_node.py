@@ -1,13 +1,131 @@
+import json
 import os
 import sys
 import folder_paths
 from .model_manager import ModelManager
-from .utils import ImageCaptionGenerator
+from .model_pool import get_model_pool
+from .config import env_str
+from .caption_cache import get_caption_cache, model_fingerprint
+from .metrics import NULL_METRICS, get_metrics_sink, start_metrics
+from .batch_scheduler import get_batch_scheduler
+from .caption_client import SERVICE_URL, get_service_client
+from .cancellation import is_cancellation
+from .precision import DEFAULT_PRECISION, DEFAULT_QUANTIZATION, PRECISIONS, QUANTIZATION_MODES, check_precision
+from .prompts import (
+    CAPTION_PROMPT, DEFAULT_BATCH_SIZE, JSON_DECODING, PREFIX_CACHE, UnparsedCaption, generation_params,
+)
+from .resolution import DEFAULT_RESOLUTION, RESOLUTION_PRESETS, pixel_budget
+
+# 需要后台预加载的模型类型，为空时不预加载
+PRELOAD_MODEL = env_str("QWEN_CLIP_PRELOAD")
+# 预加载时机：node（节点实例化时）或 import（插件导入时）
+PRELOAD_ON = env_str("QWEN_CLIP_PRELOAD_ON", "node")
+
+
+def start_preload(model_type=None, model_manager=None):
+    """在后台线程中预加载模型，与ComfyUI图中其他节点的执行重叠"""
+    model_type = model_type or PRELOAD_MODEL
+    if not model_type or model_type == "custom":
+        return None
+    model_manager = model_manager or ModelManager()
+    return get_model_pool().preload(
+        model_type,
+        lambda: model_manager.resolve_model(model_type),
+        allow_remote=model_manager.allow_hub_load,
+    )
+
+
+def caption_images(model_manager, images, model_type, custom_model_path="", detail_level="detailed",
+                   unload_after_use=False, pin_model=False, batch_size=DEFAULT_BATCH_SIZE,
+                   use_cache=True, deterministic=False, resolution=DEFAULT_RESOLUTION, min_pixels=0, max_pixels=0,
+                   precision=DEFAULT_PRECISION, quantization=DEFAULT_QUANTIZATION, metrics=NULL_METRICS):
+    """为uint8图像列表生成 [(中文, 英文), ...]，节点和独立的提示词服务共用"""
+    pool = get_model_pool()
+    pool_key = None
+    # 图像送入processor前按像素预算缩放，视觉token数不会随原图尺寸暴涨
+    budget = pixel_budget(resolution, min_pixels, max_pixels)
+    metrics.set("pixel_budget", list(budget))
+    check_precision(precision, quantization)
+    try:
+        with metrics.stage("resolve_model"):
+            if model_type == "custom":
+                model_path = model_manager.resolve_model(model_type, custom_model_path)
+            else:
+                # 本地已有完整模型时直接用来查缓存，全部命中时不需要等待后台预加载；需要下载时稍后再解析
+                model_path = model_manager.get_model_path(model_type) if "local" in model_manager.sources else None
+        
+        # 先查缓存，全部命中时不需要加载模型
+        captions = [None] * len(images)
+        cache_keys = []
+        if use_cache:
+            cache = get_caption_cache()
+            # 不同精度、量化方式和解码方式生成的结果可能不同，分别缓存
+            params = dict(generation_params(deterministic), pixel_budget=budget,
+                          precision=precision, quantization=quantization,
+                          json_decoding=JSON_DECODING, prefix_cache=PREFIX_CACHE)
+            
+            def lookup(path):
+                with metrics.stage("cache_lookup"):
+                    model_id = model_fingerprint(path)
+                    keys = [cache.make_key(frame, model_id, CAPTION_PROMPT, detail_level, params) for frame in images]
+                    return keys, [cache.get(key) for key in keys]
+            
+            if model_path is not None:
+                cache_keys, captions = lookup(model_path)
+        
+        if any(caption is None for caption in captions) and model_type != "custom":
+            with metrics.stage("resolve_model"):
+                # 模型正在后台预加载（可能还在下载）时，等待其完成而不是重复加载
+                pool.wait_preload(model_type, precision, quantization=quantization)
+                if model_path is None:
+                    # 获取模型路径：本地优先，按配置的回退链下载
+                    model_path = model_manager.resolve_model(model_type, custom_model_path)
+                    if use_cache:
+                        cache_keys, captions = lookup(model_path)
+        missing = [i for i, caption in enumerate(captions) if caption is None]
+        metrics.set("cache_hits", len(images) - len(missing))
+        
+        if missing:
+            with metrics.stage("load_model"):
+                # 从模型池获取常驻模型，未加载时才会加载
+                pool_key, caption_generator = pool.acquire(
+                    model_path, model_type, torch_dtype=precision, allow_remote=model_manager.allow_hub_load,
+                    quantization=quantization,
+                )
+            # 只增加固定，不在这里取消：其他节点或服务请求可能固定了同一个模型，取消固定只通过 release
+            if pin_model:
+                pool.pin(pool_key)
+            
+            def run(frames, batch_metrics):
+                return caption_generator.generate_captions(
+                    frames, detail_level, batch_size=batch_size, deterministic=deterministic,
+                    metrics=batch_metrics or NULL_METRICS, budget=budget,
+                )
+            
+            # 生成中英文提示词；并发调用中参数相同的请求由调度器合并为一批
+            generated = get_batch_scheduler().submit(
+                (pool_key, detail_level, deterministic, batch_size, budget),
+                [images[i] for i in missing], run, batch_size, metrics,
+            ).result()
+            for i, caption in zip(missing, generated):
+                captions[i] = caption
+                # 解析失败的原始文本不缓存，否则之后的调用都会拿到这次的失败结果
+                if use_cache and not isinstance(caption, UnparsedCaption):
+                    cache.put(cache_keys[i], caption)
+        return captions
+    finally:
+        # 归还模型；只有显式要求时才卸载
+        if pool_key is not None:
+            pool.checkin(pool_key)
+            if unload_after_use:
+                pool.release(pool_key)
+
 
 class QwenClipNode:
     def __init__(self):
         self.model_manager = ModelManager()
-        self.caption_generator = None
+        if PRELOAD_MODEL:
+            start_preload(PRELOAD_MODEL, self.model_manager)
         
     @classmethod
     def INPUT_TYPES(s):
@@ -17,75 +135,99 @@ class QwenClipNode:
                 "model_type": (["qwen2.5-vl-7b-instruct", "custom"], {
                     "default": "qwen2.5-vl-7b-instruct"
                 })    
+            },
+            "optional": {
+                "custom_model_path": ("STRING", {"default": ""}),
+                "detail_level": (["simple", "detailed"], {"default": "detailed"}),
+                # 默认模型常驻内存，勾选后每次调用结束立即卸载
+                "unload_after_use": ("BOOLEAN", {"default": False}),
+                # 固定模型，不参与空闲超时和LRU回收
+                "pin_model": ("BOOLEAN", {"default": False}),
+                # 每次 model.generate 处理的图像数量
+                "batch_size": ("INT", {"default": DEFAULT_BATCH_SIZE, "min": 1, "max": 64}),
+                # 相同图像、模型和参数直接返回缓存结果
+                "use_cache": ("BOOLEAN", {"default": True}),
+                # 使用贪心解码，相同输入总是得到相同结果
+                "deterministic": ("BOOLEAN", {"default": False}),
+                # 输出分阶段耗时、token数和峰值内存（JSON）
+                "collect_metrics": ("BOOLEAN", {"default": False}),
+                # 分辨率预设：图像按像素预算等比缩放，控制视觉token数和延迟
+                "resolution": (list(RESOLUTION_PRESETS), {"default": DEFAULT_RESOLUTION}),
+                # 非0时覆盖预设的最少/最多像素数（每 28x28 像素对应一个视觉token）
+                "min_pixels": ("INT", {"default": 0, "min": 0, "max": 16384 * 28 * 28, "step": 28 * 28}),
+                "max_pixels": ("INT", {"default": 0, "min": 0, "max": 16384 * 28 * 28, "step": 28 * 28}),
+                # 推理精度：auto 在GPU上使用 float16，在CPU上优先 bfloat16
+                "precision": (PRECISIONS, {"default": DEFAULT_PRECISION}),
+                # CPU模式下把语言模型的线性层量化为int8，量化后的权重保存在 models/clip/quantized
+                "quantization": (QUANTIZATION_MODES, {"default": DEFAULT_QUANTIZATION}),
+                # 共享的提示词服务地址（http://host:port 或 unix:///path.sock），为空时在本进程生成
+                "service_url": ("STRING", {"default": ""}),
             }
         }       
         
 
-    RETURN_TYPES = ("STRING", "STRING")
-    RETURN_NAMES = ("caption_chinese", "caption_english")
+    RETURN_TYPES = ("STRING", "STRING", "STRING")
+    RETURN_NAMES = ("caption_chinese", "caption_english", "metrics")
+    # 输入的IMAGE批次中每张图像对应一条提示词；metrics 是本次调用的JSON统计
+    OUTPUT_IS_LIST = (True, True, False)
     FUNCTION = "generate_caption"
     CATEGORY = "QwenCLIP"
 
-    def generate_caption(self, image, model_type, custom_model_path=""):
+    def generate_caption(self, image, model_type, custom_model_path="", detail_level="detailed",
+                         unload_after_use=False, pin_model=False, batch_size=DEFAULT_BATCH_SIZE,
+                         use_cache=True, deterministic=False, collect_metrics=False, service_url="",
+                         resolution=DEFAULT_RESOLUTION, min_pixels=0, max_pixels=0,
+                         precision=DEFAULT_PRECISION, quantization=DEFAULT_QUANTIZATION):
+        metrics = start_metrics(collect_metrics)
+        service_url = service_url.strip() or SERVICE_URL
         try:
-            # 初始化模型管理器
-            if self.caption_generator is None:
-                self.caption_generator = ImageCaptionGenerator()
-            
-            # 获取模型路径
-            if model_type == "custom" and custom_model_path:
-                model_path = custom_model_path
+            if service_url:
+                # 模型由共享服务常驻，本进程只发送图像；模型常驻相关的选项由服务端决定
+                with metrics.stage("service_call"):
+                    captions, service_metrics = get_service_client(service_url).caption(
+                        image, model_type, custom_model_path, detail_level,
+                        batch_size=batch_size, use_cache=use_cache, deterministic=deterministic,
+                        resolution=resolution, min_pixels=min_pixels, max_pixels=max_pixels,
+                        precision=precision, quantization=quantization, collect_metrics=metrics.enabled,
+                    )
+                if service_metrics:
+                    metrics.set("service", service_metrics)
             else:
-                model_path = self.model_manager.get_model_path(model_type)
-                if not model_path:
-                    model_path = self.model_manager.download_model(model_type)
-            
-            # 启动模型服务
-            self.caption_generator.load_model(model_path, model_type)
-            
-            # 转换图像格式
-            image_path = self.save_temp_image(image)
-            
-            # 生成中英文提示词
-            chinese_caption, english_caption = self.caption_generator.generate_caption(
-                image_path, detail_level
-            )
-            
-            # 清理临时文件
-            if os.path.exists(image_path):
-                os.remove(image_path)
-            
-            # 停止模型服务
-            self.caption_generator.unload_model()
+                # torch/transformers 在首次执行时才导入，插件注册时不加载
+                from .utils import tensor_to_images
+                
+                with metrics.stage("image_conversion"):
+                    # 转换图像格式，批次中的每一帧都会生成提示词；图像留在内存中直接交给模型
+                    images = tensor_to_images(image)
+                
+                captions = caption_images(
+                    self.model_manager, images, model_type, custom_model_path, detail_level,
+                    unload_after_use=unload_after_use, pin_model=pin_model, batch_size=batch_size,
+                    use_cache=use_cache, deterministic=deterministic, resolution=resolution,
+                    min_pixels=min_pixels, max_pixels=max_pixels, precision=precision,
+                    quantization=quantization, metrics=metrics,
+                )
             
-            return (chinese_caption, english_caption)
+            chinese_captions = [chinese for chinese, _ in captions]
+            english_captions = [english for _, english in captions]
+            metrics_json = ""
+            if metrics.enabled:
+                metrics.set("images", len(captions))
+                metrics.set("batch_size", batch_size)
+                record = metrics.to_dict()
+                sink = get_metrics_sink()
+                if sink is not None:
+                    sink.write(record)
+                if collect_metrics:
+                    metrics_json = json.dumps(record, ensure_ascii=False)
+            return (chinese_captions, english_captions, metrics_json)
             
         except Exception as e:
-            # 确保模型服务被停止
-            if self.caption_generator:
-                self.caption_generator.unload_model()
+            # ComfyUI的中断需要原样抛出，任务才会显示为已中断
+            if is_cancellation(e):
+                raise
             raise Exception(f"生成提示词失败: {str(e)}")
 
-    def save_temp_image(self, image):
-        """保存图像到临时文件"""
-        import numpy as np
-        from PIL import Image
-        
-        # 转换tensor到numpy
-        image_np = image[0].cpu().numpy()
-        
-        # 转换到0-255范围
-        image_np = (image_np * 255).astype(np.uint8)
-        
-        # 创建PIL图像
-        pil_image = Image.fromarray(image_np)
-        
-        # 保存到临时文件
-        temp_path = os.path.join(folder_paths.get_temp_directory(), "temp_image.png")
-        pil_image.save(temp_path)
-        
-        return temp_path
-
 # 节点映射
 NODE_CLASS_MAPPINGS = {
     "QwenClipNode": QwenClipNode
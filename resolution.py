@@ -0,0 +1,59 @@
+"""
+图像分辨率预算
+Qwen2.5-VL 每 28x28 像素对应一个视觉token，2K以上的图像会产生上千个视觉token，延迟和内存随之暴涨。
+送入processor之前按像素预算等比缩放到28的整数倍，视觉token数因此可以预估。
+不依赖torch/PIL，节点注册和缓存查询时可以直接导入。
+"""
+
+import math
+
+from .config import env_str
+
+# 14像素的patch再做2x2合并，每个视觉token覆盖 28x28 像素
+IMAGE_FACTOR = 28
+TOKEN_PIXELS = IMAGE_FACTOR * IMAGE_FACTOR
+
+# 预设：(最少像素, 最多像素)，以视觉token数表示
+RESOLUTION_PRESETS = {
+    "fast": (4 * TOKEN_PIXELS, 256 * TOKEN_PIXELS),
+    "balanced": (4 * TOKEN_PIXELS, 1024 * TOKEN_PIXELS),
+    "max_detail": (4 * TOKEN_PIXELS, 4096 * TOKEN_PIXELS),
+}
+
+DEFAULT_RESOLUTION = env_str("QWEN_CLIP_RESOLUTION", "balanced")
+if DEFAULT_RESOLUTION not in RESOLUTION_PRESETS:
+    print(f"警告：未知的分辨率预设 {DEFAULT_RESOLUTION}，使用 balanced")
+    DEFAULT_RESOLUTION = "balanced"
+
+
+def pixel_budget(resolution=DEFAULT_RESOLUTION, min_pixels=0, max_pixels=0):
+    """返回 (最少像素, 最多像素)；min_pixels / max_pixels 非0时覆盖预设"""
+    if resolution not in RESOLUTION_PRESETS:
+        raise Exception(f"未知的分辨率预设: {resolution}，可选 {', '.join(RESOLUTION_PRESETS)}")
+    preset_min, preset_max = RESOLUTION_PRESETS[resolution]
+    max_pixels = int(max_pixels) or preset_max
+    # 只覆盖 max_pixels 时，预设的最少像素不能超过它
+    min_pixels = int(min_pixels) or min(preset_min, max_pixels)
+    if min_pixels > max_pixels:
+        raise Exception(f"min_pixels ({min_pixels}) 不能大于 max_pixels ({max_pixels})")
+    return min_pixels, max_pixels
+
+
+def fit_to_budget(height, width, min_pixels, max_pixels, factor=IMAGE_FACTOR):
+    """保持宽高比，把尺寸调整为 factor 的整数倍并落在像素预算内，返回 (高, 宽)"""
+    resized_height = max(factor, round(height / factor) * factor)
+    resized_width = max(factor, round(width / factor) * factor)
+    if resized_height * resized_width > max_pixels:
+        beta = math.sqrt(height * width / max_pixels)
+        resized_height = max(factor, math.floor(height / beta / factor) * factor)
+        resized_width = max(factor, math.floor(width / beta / factor) * factor)
+    elif resized_height * resized_width < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        resized_height = math.ceil(height * beta / factor) * factor
+        resized_width = math.ceil(width * beta / factor) * factor
+    return resized_height, resized_width
+
+
+def visual_tokens(height, width):
+    """按预算调整后的尺寸对应的视觉token数"""
+    return (height // IMAGE_FACTOR) * (width // IMAGE_FACTOR)
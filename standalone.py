@@ -0,0 +1,51 @@
+"""
+在ComfyUI之外加载插件
+基准测试和命令行脚本通过这里以包的形式导入插件模块（插件内部使用相对导入）。
+"""
+
+import importlib
+import importlib.util
+import os
+import sys
+import tempfile
+import types
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_NAME = "qwen_clip"
+
+
+def ensure_folder_paths(comfyui_root=None, models_dir=None):
+    """导入ComfyUI的 folder_paths；不在ComfyUI中运行时提供最小实现"""
+    if comfyui_root:
+        sys.path.insert(0, os.path.abspath(comfyui_root))
+    try:
+        import folder_paths
+    except ImportError:
+        folder_paths = types.ModuleType("folder_paths")
+        folder_paths.models_dir = os.path.abspath(models_dir or os.path.join(PLUGIN_DIR, "models"))
+        temp_dir = os.path.join(tempfile.gettempdir(), "qwen_clip")
+        folder_paths.get_temp_directory = lambda: temp_dir
+        sys.modules["folder_paths"] = folder_paths
+    if models_dir:
+        folder_paths.models_dir = os.path.abspath(models_dir)
+    return folder_paths
+
+
+def load_plugin(comfyui_root=None, models_dir=None):
+    """以包的形式导入插件，返回包模块"""
+    ensure_folder_paths(comfyui_root, models_dir)
+    if PACKAGE_NAME in sys.modules:
+        return sys.modules[PACKAGE_NAME]
+    spec = importlib.util.spec_from_file_location(
+        PACKAGE_NAME, os.path.join(PLUGIN_DIR, "__init__.py"),
+        submodule_search_locations=[PLUGIN_DIR],
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def import_plugin_module(name):
+    """导入插件的子模块，例如 import_plugin_module("utils")"""
+    return importlib.import_module(f"{PACKAGE_NAME}.{name}")
@@ -1,23 +1,187 @@
+import copy
+import inspect
 import os
+import threading
+import time
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 from PIL import Image
-import requests
-from io import BytesIO
+import json
+import tempfile
+from .caption_cache import model_fingerprint
+from .cancellation import comfy_interrupted, is_cancellation, raise_cancelled
+from .config import env_bool
+from .embedding_cache import EMBEDDING_CACHE, attach_embedding_cache
+from .json_decoding import JsonCaptionConstraint, JsonCaptionLogitsProcessor, JsonCaptionStoppingCriteria
+from .metrics import NULL_METRICS, current_rss_bytes, peak_rss_bytes, reset_peak_memory
+from .mmap_loader import MemoryBudgetExceeded, load_model_mmap
+from .precision import DEFAULT_PRECISION
+from .quantization import quantize_model, resolve_dtype
+from .resolution import fit_to_budget, visual_tokens
+from .prompts import (
+    CAPTION_PROMPT,
+    DEFAULT_BATCH_SIZE,
+    JSON_DECODING,
+    JSON_RESPONSE_PREFIX,
+    PREFIX_CACHE,
+    generation_params,
+    parse_caption_response,
+)
+
+# 需要用图文模型类加载、并通过processor传入图像的模型
+VISION_LANGUAGE_MODEL_TYPES = ("qwen2_vl", "qwen2_5_vl")
+
+# 对话模板中图像开始的标记，之前的部分就是所有请求共用的前缀
+VISION_START_TOKEN = "<|vision_start|>"
+# 本地 safetensors 模型通过内存映射逐分片加载
+MMAP_LOAD = env_bool("QWEN_CLIP_MMAP_LOAD", True)
+# 有GPU时的设备映射加载（accelerate 推断设备映射并分发）默认仍使用 from_pretrained
+MMAP_LOAD_GPU = env_bool("QWEN_CLIP_MMAP_LOAD_GPU", False)
+
+
+def tensor_to_images(image):
+    """将ComfyUI的IMAGE批次(B,H,W,C, 0-1浮点)转换为uint8数组列表
+
+    整个批次只做一次uint8转换，返回的每一帧都是该数组的视图，不再额外复制。
+    """
+    image_np = (image.detach().clamp(0, 1) * 255).round().to(torch.uint8).cpu().numpy()
+    return list(image_np)
+
+
+def load_image(image):
+    """统一图像输入：文件路径会被打开，PIL图像和数组直接返回"""
+    if isinstance(image, (str, os.PathLike)):
+        with Image.open(image) as img:
+            return img.convert("RGB")
+    return image
+
+
+def resize_to_budget(image, min_pixels, max_pixels):
+    """按像素预算等比缩放到28的整数倍，返回PIL图像"""
+    image = load_image(image)
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+    width, height = image.size
+    resized_height, resized_width = fit_to_budget(height, width, min_pixels, max_pixels)
+    if (resized_width, resized_height) == (width, height):
+        return image
+    return image.resize((resized_width, resized_height), Image.BICUBIC)
+
+
+def materialize_image_paths(images):
+    """为只接受文件路径的分词器准备图像文件，返回 (路径列表, 需要清理的临时文件)"""
+    image_paths = []
+    temp_paths = []
+    for image in images:
+        if isinstance(image, (str, os.PathLike)):
+            image_paths.append(str(image))
+            continue
+        if not isinstance(image, Image.Image):
+            image = Image.fromarray(image)
+        # 使用唯一文件名，避免并发运行时相互覆盖
+        fd, temp_path = tempfile.mkstemp(prefix="qwen_clip_", suffix=".png")
+        os.close(fd)
+        image.save(temp_path)
+        image_paths.append(temp_path)
+        temp_paths.append(temp_path)
+    return image_paths, temp_paths
+
+
+def resolve_model_class(model_path):
+    """根据config.json选择模型类，Qwen2-VL/Qwen2.5-VL 不能用 AutoModelForCausalLM 加载"""
+    try:
+        with open(os.path.join(model_path, "config.json"), "r", encoding="utf-8") as f:
+            config_model_type = json.load(f).get("model_type", "")
+    except Exception:
+        return AutoModelForCausalLM
+    
+    if config_model_type in VISION_LANGUAGE_MODEL_TYPES:
+        try:
+            from transformers import AutoModelForImageTextToText
+            return AutoModelForImageTextToText
+        except ImportError:
+            from transformers import AutoModelForVision2Seq
+            return AutoModelForVision2Seq
+    return AutoModelForCausalLM
+
+
+def load_processor(model_path, local_files_only=False):
+    """加载多模态processor，模型没有提供时返回None"""
+    try:
+        from transformers import AutoProcessor
+        processor = AutoProcessor.from_pretrained(
+            model_path, trust_remote_code=True, local_files_only=local_files_only
+        )
+    except Exception:
+        return None
+    if getattr(processor, "image_processor", None) is None or not hasattr(processor, "apply_chat_template"):
+        return None
+    return processor
+
+
+class CancelCriteria(StoppingCriteria):
+    """ComfyUI中断或取消事件触发后，在下一个token步停止所有样本"""
+
+    def __init__(self, cancel_event=None):
+        self.cancel_event = cancel_event
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if not self.cancelled:
+            self.cancelled = comfy_interrupted() or (self.cancel_event is not None and self.cancel_event.is_set())
+        return torch.full((input_ids.shape[0],), self.cancelled, dtype=torch.bool, device=input_ids.device)
+
 
 class ImageCaptionGenerator:
     def __init__(self):
         self.model = None
         self.tokenizer = None
+        # Qwen2-VL/Qwen2.5-VL 通过processor直接接收内存中的图像
+        self.processor = None
         self.model_type = None
+        # 加载进度：idle / tokenizer / weights / ready
+        self.load_stage = "idle"
+        # 输入张量所在的设备，加载后取模型（第一层）所在的设备
         self.device = torch.device("cpu")
+        # 语言模型线性层的量化方式：none / int8_dynamic / int8_weight_only
+        self.quantization = "none"
+        # 最近一次加载的方式、耗时和峰值RSS
+        self.load_stats = None
+        self.prefix_cache_enabled = PREFIX_CACHE
+        self.json_decoding_enabled = JSON_DECODING
+        # (前缀文本, 前缀token, KV缓存)，随模型卸载和提示词变化失效
+        self._prefix = None
+        self._prefix_lock = threading.Lock()
+        # 生成会修改前缀缓存、分词器的 padding_side 和 rope 状态：流式生成和批量生成共用同一个模型时逐个进行
+        self._generate_lock = threading.Lock()
+        # 视觉特征缓存（包装后的视觉编码器forward），模型不是图文模型时为None
+        self.embedding_cache = None
     
-    def load_model(self, model_path, model_type):
-        """加载模型"""
+    def load_model(self, model_path, model_type, torch_dtype=DEFAULT_PRECISION, device_map="auto", allow_remote=False,
+                   quantization="none"):
+        """加载模型
+
+        默认只从本地加载（local_files_only），失败时直接抛出本地错误；
+        allow_remote=True 时才会回退到从Hugging Face Hub加载。
+        torch_dtype 为 auto 时在GPU上使用 float16，在CPU上优先使用 bfloat16；
+        quantization 不为 none 时把语言模型的线性层量化为int8（只用于CPU）。
+        """
         try:
             if self.model is not None and self.model_type == model_type:
                 return
             
+            torch_dtype = resolve_dtype(torch_dtype, device_map, quantization)
+            
             # 卸载现有模型
             self.unload_model()
             
@@ -26,45 +190,80 @@ class ImageCaptionGenerator:
             # 加载分词器和模型
             try:
                 # 尝试从本地路径加载模型
-                self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-                # 创建一个临时目录用于模型卸载
-                offload_folder = os.path.join(os.path.dirname(model_path), "offload")
-                os.makedirs(offload_folder, exist_ok=True)
+                self.load_stage = "tokenizer"
+                self.tokenizer = AutoTokenizer.from_pretrained(
+                    model_path, trust_remote_code=True, local_files_only=True
+                )
+                self._attach_processor(model_path, local_files_only=True)
+                model_class = resolve_model_class(model_path)
+                self.load_stage = "weights"
+                # 内存映射逐分片加载，峰值内存接近模型本身；不支持时使用 from_pretrained
+                use_mmap = MMAP_LOAD and (device_map == "cpu" or not torch.cuda.is_available() or MMAP_LOAD_GPU)
+                self.model = self._load_mmap(model_class, model_path, torch_dtype, device_map) if use_mmap else None
+                if self.model is None:
+                    reset_peak_memory()
+                    load_start = time.perf_counter()
+                    rss_before = current_rss_bytes()
+                    # 创建一个临时目录用于模型卸载
+                    offload_folder = os.path.join(os.path.dirname(model_path), "offload")
+                    os.makedirs(offload_folder, exist_ok=True)
                 
-                try:
-                    # 尝试使用auto设备映射
-                    self.model = AutoModelForCausalLM.from_pretrained(
-                            model_path, 
-                            device_map="auto", 
-                            offload_folder=offload_folder,  # 指定卸载文件夹
-                            torch_dtype=torch.float16,  # 使用半精度浮点数减少内存使用
-                            trust_remote_code=True,
-                            use_safetensors=True
-                        ).eval()
-                    print(f"模型已加载，设备映射: auto")
-                except Exception as e:
-                    # 如果auto设备映射失败，尝试使用cpu
-                    if "device string: disk" in str(e):
-                        print(f"自动设备映射失败，尝试使用CPU: {str(e)}")
-                        self.model = AutoModelForCausalLM.from_pretrained(
-                            model_path, 
-                            device_map="cpu", 
-                            torch_dtype=torch.float16,  # 使用半精度浮点数减少内存使用
-                            trust_remote_code=True,
-                            use_safetensors=True
-                        ).eval()
-                        print(f"模型已加载，设备映射: cpu")
-                    else:
-                        raise e
-                print(f"模型已加载，部分权重可能已卸载到: {offload_folder}")
+                    try:
+                        # 尝试使用auto设备映射
+                        self.model = model_class.from_pretrained(
+                                model_path, 
+                                device_map=device_map, 
+                                offload_folder=offload_folder,  # 指定卸载文件夹
+                                torch_dtype=torch_dtype,  # auto：GPU上使用半精度，CPU上优先bfloat16
+                                trust_remote_code=True,
+                                use_safetensors=True,
+                                local_files_only=True
+                            ).eval()
+                        print(f"模型已加载，设备映射: {device_map}")
+                    except Exception as e:
+                        # 如果auto设备映射失败，尝试使用cpu
+                        if "device string: disk" in str(e):
+                            print(f"自动设备映射失败，尝试使用CPU: {str(e)}")
+                            self.model = model_class.from_pretrained(
+                                model_path, 
+                                device_map="cpu", 
+                                torch_dtype=torch_dtype,
+                                trust_remote_code=True,
+                                use_safetensors=True,
+                                local_files_only=True
+                            ).eval()
+                            print(f"模型已加载，设备映射: cpu")
+                        else:
+                            raise e
+                    print(f"模型已加载，部分权重可能已卸载到: {offload_folder}")
+                    self.load_stats = {
+                        "loader": "transformers",
+                        "seconds": round(time.perf_counter() - load_start, 3),
+                        "rss_delta_bytes": current_rss_bytes() - rss_before,
+                        "peak_rss_bytes": peak_rss_bytes(),
+                        "peak_rss_delta_bytes": peak_rss_bytes() - rss_before,
+                    }
+                print(f"权重加载峰值RSS: {self.load_stats['peak_rss_bytes'] / 1024 ** 2:.0f} MB"
+                      f"（加载期间增加 {self.load_stats['peak_rss_delta_bytes'] / 1024 ** 2:.0f} MB）")
+            except MemoryBudgetExceeded:
+                # 超出内存预算时不能回退到Hub重新加载，否则预算不起作用
+                raise
             except Exception as e:
+                # 离线优先：未显式允许时不回退到Hub，直接报告本地错误
+                if not allow_remote:
+                    raise Exception(f"本地模型加载失败: {str(e)}")
                 # 如果本地加载失败，尝试从Hugging Face Hub下载
                 print(f"本地模型加载失败: {str(e)}")
                 print(f"尝试从Hugging Face Hub下载模型: {model_path}")
                 try:
+                    reset_peak_memory()
+                    load_start = time.perf_counter()
+                    rss_before = current_rss_bytes()
                     # 提取模型名称（假设model_path是完整路径）
                     model_name = os.path.basename(model_path)
                     self.tokenizer = AutoTokenizer.from_pretrained(f"qwen/{model_name}", trust_remote_code=True)
+                    self._attach_processor(f"Qwen/{model_name}")
+                    model_class = resolve_model_class(model_path)
                     
                     # 创建一个临时目录用于模型卸载
                     offload_folder = os.path.join(os.path.dirname(model_path), "offload")
@@ -72,23 +271,23 @@ class ImageCaptionGenerator:
                     
                     try:
                         # 尝试使用auto设备映射
-                        self.model = AutoModelForCausalLM.from_pretrained(
+                        self.model = model_class.from_pretrained(
                             f"Qwen/{model_name}", 
-                            device_map="auto", 
+                            device_map=device_map, 
                             offload_folder=offload_folder,  # 指定卸载文件夹
-                            torch_dtype=torch.float16,  # 使用半精度浮点数减少内存使用
+                            torch_dtype=torch_dtype,  # auto：GPU上使用半精度，CPU上优先bfloat16
                             trust_remote_code=True,
                             use_safetensors=True
                         ).eval()
-                        print(f"模型已从Hugging Face Hub加载，设备映射: auto")
+                        print(f"模型已从Hugging Face Hub加载，设备映射: {device_map}")
                     except Exception as e:
                         # 如果auto设备映射失败，尝试使用cpu
                         if "device string: disk" in str(e):
                             print(f"自动设备映射失败，尝试使用CPU: {str(e)}")
-                            self.model = AutoModelForCausalLM.from_pretrained(
+                            self.model = model_class.from_pretrained(
                             f"Qwen/{model_name}", 
                             device_map="cpu", 
-                            torch_dtype=torch.float16,  # 使用半精度浮点数减少内存使用
+                            torch_dtype=torch_dtype,
                             trust_remote_code=True,
                             use_safetensors=True
                         ).eval()
@@ -96,13 +295,28 @@ class ImageCaptionGenerator:
                         else:
                             raise e
                     print(f"模型已从Hugging Face Hub加载，部分权重可能已卸载到: {offload_folder}")
+                    self.load_stats = {
+                        "loader": "hub",
+                        "seconds": round(time.perf_counter() - load_start, 3),
+                        "rss_delta_bytes": current_rss_bytes() - rss_before,
+                        "peak_rss_bytes": peak_rss_bytes(),
+                        "peak_rss_delta_bytes": peak_rss_bytes() - rss_before,
+                    }
                 except Exception as e2:
                     raise Exception(f"从Hugging Face Hub下载模型失败: {str(e2)}")
             
+            if quantization != "none":
+                count = quantize_model(self.model, model_path, quantization)
+                print(f"已将 {count} 个线性层量化为 {quantization}")
+            self.quantization = quantization
+            self.device = self.model.device
             self.model_type = model_type
+            self._attach_embedding_cache(model_path, torch_dtype)
+            self.load_stage = "ready"
             print("模型加载完成")
             
         except Exception as e:
+            self.load_stage = "idle"
             raise Exception(f"模型加载失败: {str(e)}")
     
     def unload_model(self):
@@ -114,64 +328,398 @@ class ImageCaptionGenerator:
         if self.tokenizer is not None:
             del self.tokenizer
             self.tokenizer = None
+        
+        self.processor = None
+        self._prefix = None
+        self.embedding_cache = None
             
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         
         self.model_type = None
+        self.quantization = "none"
+        self.load_stats = None
+        self.device = torch.device("cpu")
+        self.load_stage = "idle"
         print("模型已卸载")
     
-    def generate_caption(self, image_path, detail_level):
-        """生成图像描述（中英文）"""
+    def _load_mmap(self, model_class, model_path, torch_dtype, device_map):
+        """内存映射逐分片加载，失败时返回None，由调用方退回 from_pretrained"""
+        try:
+            model, self.load_stats = load_model_mmap(model_class, model_path, torch_dtype, device_map)
+        except MemoryBudgetExceeded:
+            raise
+        except Exception as e:
+            print(f"内存映射加载失败，使用 from_pretrained 加载: {str(e)}")
+            return None
+        print(f"模型已通过内存映射加载（{self.load_stats['shards']} 个分片，"
+              f"映射 {self.load_stats['mapped_bytes'] / 1024 ** 2:.0f} MB，"
+              f"复制 {self.load_stats['materialized_bytes'] / 1024 ** 2:.0f} MB）")
+        return model
+    
+    def _attach_processor(self, model_path, local_files_only=False):
+        """加载多模态processor；分词器不支持内存图像时保持为None，退回临时文件路径"""
+        self.processor = load_processor(model_path, local_files_only=local_files_only)
+        if self.processor is not None:
+            self.tokenizer = self.processor.tokenizer
+            print("已加载多模态processor，图像将直接在内存中传递")
+    
+    def _attach_embedding_cache(self, model_path, torch_dtype):
+        """同一张图像换提示词或 detail_level 再次生成时，直接复用视觉编码器的输出"""
+        visual = self._vision_module()
+        if not EMBEDDING_CACHE or visual is None:
+            return
+        model_id = f"{model_fingerprint(model_path)}|{torch_dtype}"
+        self.embedding_cache = attach_embedding_cache(visual, model_id)
+    
+    def memory_footprint(self):
+        """估算模型占用的内存/显存字节数"""
+        if self.model is None:
+            return 0
+        if hasattr(self.model, "get_memory_footprint"):
+            return self.model.get_memory_footprint()
+        return sum(p.numel() * p.element_size() for p in self.model.parameters())
+    
+    def generate_caption(self, image, detail_level, deterministic=False, budget=None):
+        """生成图像描述（中英文），image 可以是PIL图像、HWC uint8数组或图像文件路径"""
+        return self.generate_captions(
+            [image], detail_level, batch_size=1, deterministic=deterministic, budget=budget
+        )[0]
+    
+    def generate_captions(self, images, detail_level, batch_size=DEFAULT_BATCH_SIZE, deterministic=False,
+                          max_new_tokens=None, metrics=NULL_METRICS, budget=None):
+        """批量生成图像描述，按 batch_size 分批调用 model.generate，返回 [(中文, 英文), ...]
+
+        budget 为 (最少像素, 最多像素) 时，图像先按预算等比缩放；为None时保持原尺寸。
+        metrics 为 CaptionMetrics 时记录各阶段耗时、视觉token数和生成的token数。
+        """
         if self.model is None or self.tokenizer is None:
             raise Exception("模型未加载")
         
+        batch_size = max(1, int(batch_size))
+        params = generation_params(deterministic)
+        if max_new_tokens:
+            params["max_new_tokens"] = int(max_new_tokens)
+        results = []
         try:
-            # 获取图像分辨率
-            with Image.open(image_path) as img:
-                width, height = img.size
-            
-            # 构建中文提示词，明确说明用于AI文生图
-            prompt = f"请给我一段提示词，可以准确向其他文生图大模型描述这张图片，以生成相似的图片，返回文本需要包含中英文，给出json格式回答，具体内容是{'中文提示词':'','英文提示词':''}，描述内容尽可能详细，可能包括但不限于主体（含权重）、位置关系、细节、风格等"
-            
-            # 构建输入
-            query = self.tokenizer.from_list_format([
-                {'image': image_path},
-                {'text': prompt},
-            ])
+            for start in range(0, len(images), batch_size):
+                results.extend(self._generate_batch(
+                    images[start:start + batch_size], detail_level, params, metrics, budget
+                ))
+            return results
+        except Exception as e:
+            if is_cancellation(e):
+                raise
+            raise Exception(f"生成描述失败: {str(e)}")
+    
+    def generate_caption_stream(self, image, detail_level, deterministic=False, max_new_tokens=None,
+                                budget=None, cancel_event=None, metrics=NULL_METRICS):
+        """流式生成单张图像的描述，边解码边产出事件字典：
+
+        - {"text": 已生成的全部文本, "delta": 新增文本, "ttft": 首个token的耗时(秒)}
+        - 最后一个事件额外包含 "caption": (中文, 英文) 和 "done": True
+
+        cancel_event（threading.Event）被设置或ComfyUI请求中断时，在下一个token步停止并抛出取消异常；
+        调用方提前停止迭代时同样会停止解码。
+        """
+        if self.model is None or self.tokenizer is None:
+            raise Exception("模型未加载")
+        
+        params = generation_params(deterministic)
+        if max_new_tokens:
+            params["max_new_tokens"] = int(max_new_tokens)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        cancel = CancelCriteria(cancel_event)
+        result = {}
+        
+        def run():
+            try:
+                result["caption"] = self._generate_batch(
+                    [image], detail_level, params, metrics, budget, streamer=streamer, cancel=cancel
+                )[0]
+            except BaseException as e:
+                result["error"] = e
+            finally:
+                # 出错时generate可能还没有开始，保证迭代能够结束
+                streamer.end()
+        
+        start = time.perf_counter()
+        worker = threading.Thread(target=run, name="qwen-clip-stream", daemon=True)
+        worker.start()
+        text = JSON_RESPONSE_PREFIX if self.json_decoding_enabled and self.processor is not None else ""
+        ttft = None
+        finished = False
+        try:
+            for delta in streamer:
+                if not delta:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                    metrics.set("ttft_seconds", ttft)
+                text += delta
+                yield {"text": text, "delta": delta, "ttft": ttft}
+            finished = True
+        finally:
+            # 调用方提前停止迭代：在下一个token步结束解码
+            if not finished:
+                cancel.cancel()
+            worker.join()
+        
+        error = result.get("error")
+        if error is not None:
+            if is_cancellation(error):
+                raise error
+            raise Exception(f"生成描述失败: {str(error)}")
+        yield {"text": text, "delta": "", "ttft": ttft, "caption": result["caption"], "done": True}
+    
+    def _generate_batch(self, images, detail_level, params, metrics=NULL_METRICS, budget=None,
+                        streamer=None, cancel=None):
+        """对一批图像做一次填充后的批量生成；同一个模型上的生成互斥"""
+        with self._generate_lock:
+            return self._generate_batch_locked(images, detail_level, params, metrics, budget, streamer, cancel)
+    
+    def _generate_batch_locked(self, images, detail_level, params, metrics, budget, streamer, cancel):
+        temp_paths = []
+        try:
+            # 预处理包含按预算缩放、图像切块和分词
+            with metrics.stage("preprocess"):
+                if budget is not None:
+                    images = [resize_to_budget(image, *budget) for image in images]
+                if self.processor is not None:
+                    inputs = self._build_processor_inputs(images)
+                else:
+                    # 分词器只接受文件路径时，退回临时文件
+                    image_paths, temp_paths = materialize_image_paths(images)
+                    inputs = self._build_tokenizer_inputs(image_paths)
+                inputs = inputs.to(self.device)
+            if metrics.enabled:
+                metrics.add("visual_tokens", self._count_visual_tokens(inputs, images))
             
-            # 生成文本
-            inputs = self.tokenizer(query, return_tensors='pt')
-            inputs = inputs.to(self.device)
+            # 指令前缀的KV缓存只计算一次，之后只需要预填充图像和对话结尾
+            generate_kwargs = {}
+            if self.prefix_cache_enabled and self._supports_prefix_cache():
+                with metrics.stage("prefix_cache"):
+                    prepared = self._apply_prefix_cache(inputs)
+                if prepared is not None:
+                    inputs, generate_kwargs["past_key_values"], prefix_length = prepared
+                    metrics.add("prefix_tokens_reused", prefix_length * len(images))
+            self._reset_rope_deltas()
             
-            with torch.no_grad():
-                pred = self.model.generate(
-                    **inputs,
-                    max_new_tokens=512,
-                    do_sample=True,
-                    temperature=0.7,
-                    top_k=50,
-                    top_p=0.95,
+            # 约束回答的JSON结构，对象完整后立即停止，不再生成多余的token
+            constraint = None
+            forced_prefix = self.json_decoding_enabled and self.processor is not None
+            if self.json_decoding_enabled:
+                constraint = JsonCaptionConstraint(
+                    self.tokenizer, inputs["input_ids"].shape[1], len(images),
+                    self._eos_token_ids(), forced_prefix=forced_prefix,
                 )
+                generate_kwargs["logits_processor"] = LogitsProcessorList([JsonCaptionLogitsProcessor(constraint)])
+            # ComfyUI中断或取消事件触发后，在下一个token步停止
+            cancel = cancel or CancelCriteria()
+            stopping_criteria = [cancel]
+            if constraint is not None:
+                stopping_criteria.append(JsonCaptionStoppingCriteria(constraint))
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList(stopping_criteria)
+            if streamer is not None:
+                generate_kwargs["streamer"] = streamer
             
-            response = self.tokenizer.decode(pred[0], skip_special_tokens=True)
-            
-            # 提取中文回答部分,解析json，格式{'中文提示词':'','英文提示词':''}，提取中英文提示词返回
-            try:
-                json_str = response.split("json")[1].strip()
-                json_data = json.loads(json_str)
-                chinese_caption = json_data['中文提示词']
-                english_caption = json_data['英文提示词']
-            except:
-                chinese_caption = response
-                english_caption = response  # 简单复制中文回答作为英文回答
-                print(f"警告：无法解析JSON格式的回答，使用原始文本。原始回答: {response}")
-
-            # 返回中英文版本
-            return chinese_caption, english_caption
-            
-        except Exception as e:
-            raise Exception(f"生成描述失败: {str(e)}")
+            pad_token_id = self._pad_token_id()
+            embedding_stats = self.embedding_cache.stats() if self.embedding_cache is not None else None
+            with metrics.stage("generate"), metrics.time_module(self._vision_module(), "vision_encoder"):
+                with torch.no_grad():
+                    pred = self.model.generate(
+                        **inputs,
+                        **params,
+                        **generate_kwargs,
+                        pad_token_id=pad_token_id,
+                    )
+            if cancel.cancelled:
+                raise_cancelled()
+            if metrics.enabled and embedding_stats is not None:
+                for name, value in self.embedding_cache.stats().items():
+                    metrics.add(f"vision_cache_{name}", value - embedding_stats[name])
+        finally:
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        
+        # 只解码新生成的部分，避免提示词本身干扰JSON解析
+        prompt_length = inputs['input_ids'].shape[1]
+        new_tokens = pred[:, prompt_length:]
+        if metrics.enabled:
+            metrics.add("generated_tokens", int((new_tokens != pad_token_id).sum()))
+            if constraint is not None:
+                # 提前停止的样本距 max_new_tokens 上限的余量；不约束时模型通常也不会用满上限，实际节省量要用基准测试对比
+                generated = (new_tokens != pad_token_id).sum(dim=1).tolist()
+                stopped = [count for count, done in zip(generated, constraint.early_stops()) if done]
+                metrics.add("json_early_stops", len(stopped))
+                metrics.add("json_tokens_below_limit", sum(params["max_new_tokens"] - count for count in stopped))
+                metrics.add("json_forced_tokens", constraint.forced_tokens)
+            metrics.add("prompt_tokens", int(inputs['attention_mask'].sum()) if 'attention_mask' in inputs
+                        else prompt_length * len(images))
+        with metrics.stage("detokenize"):
+            responses = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+            if forced_prefix:
+                responses = [JSON_RESPONSE_PREFIX + response for response in responses]
+        with metrics.stage("json_parse"):
+            return [parse_caption_response(response) for response in responses]
+    
+    def _count_visual_tokens(self, inputs, images):
+        """实际送入语言模型的视觉token数"""
+        grid_thw = inputs.get("image_grid_thw") if hasattr(inputs, "get") else None
+        if grid_thw is not None:
+            merge_size = getattr(getattr(self.processor, "image_processor", None), "merge_size", 2)
+            return int(grid_thw.prod(dim=-1).sum()) // (merge_size * merge_size)
+        total = 0
+        for image in images:
+            image = load_image(image)
+            if isinstance(image, Image.Image):
+                width, height = image.size
+            else:
+                height, width = image.shape[:2]
+            total += visual_tokens(height, width)
+        return total
+    
+    def _vision_module(self):
+        """视觉编码器子模块，用于单独统计其耗时"""
+        for owner in (self.model, getattr(self.model, "model", None)):
+            visual = getattr(owner, "visual", None)
+            if visual is not None:
+                return visual
+        return None
+    
+    def _chat_text(self):
+        """对话模板渲染后的文本；指令在图像之前，使其成为所有请求共用的前缀"""
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": CAPTION_PROMPT},
+                {"type": "image"},
+            ],
+        }]
+        text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        if self.json_decoding_enabled:
+            # 回答的开头直接给出，模型从中文提示词的内容开始生成
+            text += JSON_RESPONSE_PREFIX
+        return text
+    
+    def _build_processor_inputs(self, images):
+        """图像直接交给processor，不经过编码和磁盘"""
+        text = self._chat_text()
+        # 左侧填充，使每个样本的新生成token都从同一位置开始
+        self.processor.tokenizer.padding_side = "left"
+        return self.processor(
+            text=[text] * len(images),
+            images=[load_image(image) for image in images],
+            padding=True,
+            return_tensors="pt",
+        )
+    
+    def _supports_prefix_cache(self):
+        """带KV缓存续写时，generate 仍需在第一步传入图像（transformers 5 的 is_first_iteration）"""
+        if self.processor is None or self.model is None:
+            return False
+        prepare = getattr(self.model, "prepare_inputs_for_generation", None)
+        try:
+            return prepare is not None and "is_first_iteration" in inspect.signature(prepare).parameters
+        except (TypeError, ValueError):
+            return False
+    
+    def _prompt_prefix(self):
+        """返回 (前缀文本, 前缀token, KV缓存)；模型或提示词变化后重新计算"""
+        text = self._chat_text()
+        if VISION_START_TOKEN not in text:
+            return None
+        prefix_text = text[:text.index(VISION_START_TOKEN)]
+        with self._prefix_lock:
+            if self._prefix is not None and self._prefix[0] == prefix_text:
+                return self._prefix
+            prefix_ids = self.processor.tokenizer(
+                prefix_text, add_special_tokens=False, return_tensors="pt"
+            )["input_ids"].to(self.device)
+            with torch.no_grad():
+                outputs = self.model(input_ids=prefix_ids, use_cache=True)
+            self._prefix = (prefix_text, prefix_ids[0], outputs.past_key_values)
+            return self._prefix
+    
+    def _apply_prefix_cache(self, inputs):
+        """把左侧填充移到前缀之后，使每个样本的前缀都从位置0开始，返回 (inputs, KV缓存, 前缀长度)
+
+        填充位置的attention_mask为0，位置编码按attention_mask累加，因此结果与左侧填充一致。
+        前缀与分词结果对不上时返回None，按普通方式生成。
+        """
+        prefix = self._prompt_prefix()
+        if prefix is None or "attention_mask" not in inputs:
+            return None
+        _, prefix_ids, prefix_cache = prefix
+        prefix_length = prefix_ids.shape[0]
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs["attention_mask"]
+        batch_size, length = input_ids.shape
+        
+        positions = torch.arange(length, device=input_ids.device)
+        order = []
+        for row in range(batch_size):
+            pads = int((attention_mask[row] == 0).sum())
+            if not bool(attention_mask[row, pads:].all()) or length - pads <= prefix_length:
+                return None
+            if not torch.equal(input_ids[row, pads:pads + prefix_length], prefix_ids):
+                return None
+            order.append(torch.cat([
+                positions[pads:pads + prefix_length], positions[:pads], positions[pads + prefix_length:],
+            ]))
+        order = torch.stack(order)
+        
+        for key in ("input_ids", "attention_mask", "mm_token_type_ids", "token_type_ids"):
+            value = inputs.get(key)
+            if value is not None and tuple(value.shape) == (batch_size, length):
+                inputs[key] = value.gather(1, order.to(value.device))
+        
+        cache = copy.deepcopy(prefix_cache)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return inputs, cache, prefix_length
+    
+    def _reset_rope_deltas(self):
+        """Qwen2-VL 缓存了上一次生成的 rope_deltas，带KV缓存续写前必须清空，否则会沿用旧的位置偏移"""
+        base_model = getattr(self.model, "model", None)
+        if base_model is not None and hasattr(base_model, "rope_deltas"):
+            base_model.rope_deltas = None
+    
+    def _build_tokenizer_inputs(self, image_paths):
+        """Qwen-VL风格分词器：图像以文件路径嵌入查询文本"""
+        queries = [
+            self.tokenizer.from_list_format([
+                {'image': image_path},
+                {'text': CAPTION_PROMPT},
+            ])
+            for image_path in image_paths
+        ]
+        # 左侧填充，使每个样本的新生成token都从同一位置开始
+        self.tokenizer.padding_side = "left"
+        self._pad_token_id()
+        return self.tokenizer(queries, return_tensors='pt', padding='longest')
+    
+    def _eos_token_ids(self):
+        """所有会结束生成的token（Qwen的对话结束符和文本结束符）"""
+        eos_ids = set()
+        candidates = [getattr(getattr(self.model, "generation_config", None), "eos_token_id", None),
+                      self.tokenizer.eos_token_id]
+        for candidate in candidates:
+            if isinstance(candidate, int):
+                eos_ids.add(candidate)
+            elif candidate:
+                eos_ids.update(candidate)
+        return sorted(eos_ids)
+    
+    def _pad_token_id(self):
+        """批量生成需要填充token，Qwen分词器默认没有设置"""
+        if self.tokenizer.pad_token_id is None:
+            pad_token_id = getattr(self.tokenizer, "eod_id", None)
+            if pad_token_id is None:
+                pad_token_id = self.tokenizer.eos_token_id
+            self.tokenizer.pad_token_id = pad_token_id
+        return self.tokenizer.pad_token_id
     
     def __del__(self):
         """析构函数，确保模型被卸载"""